@@ -1,15 +1,51 @@
 
-import jwt
 import frappe
 from frappe import _
 import json
-from frappe.utils import now
+import inspect
 import math
-from frappe.utils import now_datetime, random_string, get_site_path
-import os
+from datetime import timedelta
+from zoneinfo import ZoneInfo
+from frappe.utils import CallbackManager, add_days, get_datetime, get_system_timezone, now_datetime
 import base64
-import imghdr
 from frappe.utils.file_manager import save_file
+from field_service_management.auth import api_key_auth, decode_token, issue_tokens, revoke_token
+from field_service_management.durations import format_duration, get_duration_seconds
+from field_service_management.location import (
+    MAX_DISTANCE_PAIRS,
+    haversine_matrix,
+    ingest_live_locations,
+    parse_coordinates,
+    parse_location_points,
+)
+from field_service_management.uploads import (
+    UPLOAD_SESSION_CHUNK_SIZE,
+    UploadError,
+    add_thumbnail_urls,
+    append_upload_chunk,
+    create_upload_session,
+    create_visit_attachment,
+    finalize_upload_session,
+    get_upload_session,
+    save_uploaded_image,
+)
+
+DEFAULT_ADDRESS = "Default-Other"
+
+MOBILE_SUB_STEPS_CACHE_KEY = "fsm:mobile_sub_steps:"
+MOBILE_SUB_STEPS_CACHE_TTL = 24 * 60 * 60
+
+MAX_MUTATIONS = 200
+MUTATION_LEDGER_RETENTION_DAYS = 30
+MUTATION_CLOCK_SKEW_SECONDS = 5 * 60
+
+SHIPPING_ADDRESS_CHUNK_SIZE = 500
+SHIPPING_ADDRESS_SOURCE = """
+    FROM `tabSerial No` sn
+    JOIN `tabDelivery Note` dn ON dn.name = sn.delivery_document_no
+    JOIN `tabAddress` addr ON addr.name = dn.shipping_address_name
+    WHERE sn.name > %(last_name)s AND IFNULL(sn.delivery_document_no, '') != ''
+"""
 
 @frappe.whitelist(allow_guest=True)
 def login(email, password):
@@ -41,7 +77,8 @@ def login(email, password):
                     "email": user.email,
                     "full_name": user.full_name,
                     "api_key": user.api_key,
-                    "api_secret": api_secret
+                    "api_secret": api_secret,
+                    **issue_tokens(user.name)
                 }
             }
         else:
@@ -61,141 +98,374 @@ def login(email, password):
         }
 
 @frappe.whitelist(allow_guest=True)
-def get_maintenance():
-    authorization_header = frappe.get_request_header("Authorization")
-    if not authorization_header:
-        return { "status": "error", "message": "Missing Authorization header"}
-    api_key = frappe.get_request_header("Authorization").split(" ")[1].split(":")[0]
-    # Find the user associated with the API key
-    user = frappe.db.get_value("User", {"api_key": api_key}, "name")
-    
-    if not user:
-        return {"status": "failed", "message": "Invalid API key"}
-    
-    maintenance_visits = frappe.get_all(
+def refresh_token(refresh_token):
+    """Exchange a refresh token from `login` for a new access/refresh token pair"""
+    claims = decode_token(refresh_token, token_type="refresh")
+    if not claims:
+        return {"status": "failed", "message": "Invalid or expired refresh token"}
+
+    user = claims["sub"]
+    if not frappe.db.get_value("User", user, "enabled"):
+        return {"status": "failed", "message": "User is disabled"}
+
+    # refresh tokens are single use
+    revoke_token(claims)
+    return {"status": "success", **issue_tokens(user)}
+
+@frappe.whitelist(allow_guest=True)
+def logout(refresh_token=None):
+    """Revoke the bearer access token of the request and, if given, the refresh token"""
+    authorization_header = frappe.get_request_header("Authorization") or ""
+    tokens = [(authorization_header[len("Bearer "):], "access")] if authorization_header.startswith("Bearer ") else []
+    if refresh_token:
+        tokens.append((refresh_token, "refresh"))
+
+    for token, token_type in tokens:
+        claims = decode_token(token, token_type=token_type)
+        if claims:
+            revoke_token(claims)
+
+    return {"status": "success", "message": "Logged out"}
+
+@frappe.whitelist(allow_guest=True)
+@api_key_auth
+def get_maintenance(user):
+    maintenance_visits = get_assigned_visit_names(user)
+    if not maintenance_visits:
+        return []
+
+    return get_maintenance_payloads(maintenance_visits, user)
+
+@frappe.whitelist(allow_guest=True)
+@api_key_auth
+def get_maintenance_changes(user, since=None):
+    """
+    Incremental variant of `get_maintenance`
+
+    Args:
+        since: (Optional) Cursor returned by the previous call; omit it for a full sync
+
+    Returns the visits whose parent, child rows or Assigned Tasks changed after
+    the cursor, tombstones for visits no longer assigned (or cancelled) and
+    the cursor to send on the next call.
+    """
+
+    # Taken before reading so writes racing with this call are sent again next time
+    synced_at = now_datetime()
+    cursor = decode_sync_cursor(since) if since else None
+
+    visit_names = get_assigned_visit_names(user)
+    if cursor:
+        known_visits = set(cursor["visits"])
+        changed = get_changed_visit_names(visit_names, user, cursor["synced_at"])
+        changed.update(name for name in visit_names if name not in known_visits)
+        changed_visits = [name for name in visit_names if name in changed]
+        tombstones = sorted(known_visits.difference(visit_names))
+    else:
+        changed_visits = visit_names
+        tombstones = []
+
+    return {
+        "status": "success",
+        "full_sync": not cursor,
+        "visits": get_maintenance_payloads(changed_visits, user) if changed_visits else [],
+        "tombstones": tombstones,
+        "cursor": encode_sync_cursor(synced_at, visit_names)
+    }
+
+def get_assigned_visit_names(user):
+    return frappe.get_all(
         "Maintenance Visit",
         filters={
             "_assign": ["like", f'%"{user}"%'],
             "status": ["!=", "Cancelled"]
         },
-        fields="name"
+        pluck="name"
     )
-   
-    visits_with_details = []
-    for visit in maintenance_visits:
-        visit_doc = frappe.get_doc("Maintenance Visit", visit.name)
-
-        #visit-start-time
-        latest_visit_start = frappe.db.get_value(
-            "Visit Start Maintenance",
-            {
-                "parent": visit.name,
-                "technician": user,
-            },
-            "visit_start_at",
-            order_by="visit_start_at DESC"
-        )
-        visit_doc.update({
-            "visit_start": latest_visit_start if latest_visit_start else "",
-        })
 
-        #start-end time
-        assigned_task = frappe.get_all(
-            "Assigned Tasks",
-            filters={
-                "technician": user, "status": "Pending", "issue_code": visit.name
-            },
-            limit_page_length=1,
-            order_by='creation desc',
-            fields=['*']
+def get_changed_visit_names(visit_names, user, since):
+    """Names of the given visits modified after `since`, looking at the parent, its child tables and Assigned Tasks"""
+    if not visit_names:
+        return set()
+
+    queries = [
+        "SELECT name FROM `tabMaintenance Visit` WHERE name IN %(visits)s AND modified > %(since)s",
+        """SELECT issue_code FROM `tabAssigned Tasks`
+            WHERE issue_code IN %(visits)s AND technician = %(user)s AND modified > %(since)s"""
+    ]
+    for df in frappe.get_meta("Maintenance Visit").get_table_fields():
+        queries.append(
+            f"""SELECT parent FROM `tab{df.options}`
+            WHERE parent IN %(visits)s AND parenttype = 'Maintenance Visit' AND modified > %(since)s"""
         )
-        visit_data = visit_doc.as_dict()
-        visit_data['start_time'] = assigned_task[0].stime if assigned_task else ""
-        visit_data['end_time'] = assigned_task[0].etime if assigned_task else ""
-
-
-        #punch-in-punch-out
-        latest_punch_in = frappe.db.get_value(
-            "Punch In Punch Out",
-            {
-                "parent": visit.name,
-                "technician": user,
-                "punch_in": ["is", "set"]
-            },
-            "punch_in",
-            order_by="punch_in DESC"
+
+    rows = frappe.db.sql(
+        " UNION ".join(queries),
+        {"visits": tuple(visit_names), "user": user, "since": since}
+    )
+    return {row[0] for row in rows}
+
+def encode_sync_cursor(synced_at, visit_names):
+    payload = json.dumps({"synced_at": str(synced_at), "visits": sorted(visit_names)})
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+def decode_sync_cursor(cursor):
+    """Returns None for a malformed cursor, which makes the caller fall back to a full sync"""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return {"synced_at": payload["synced_at"], "visits": list(payload["visits"])}
+    except (ValueError, TypeError, KeyError):
+        return None
+
+def get_maintenance_payloads(visit_names, user):
+    """
+    Build the mobile payload of `get_maintenance` for a set of visits.
+
+    Every relation is fetched once for the whole set (IN-list / GROUP BY
+    queries), so the number of queries does not grow with the visit count.
+
+    Args:
+        visit_names: List of Maintenance Visit names, in the order to return
+        user: Technician the payload is built for
+    """
+    visit_names = list(visit_names)
+    visit_tuple = tuple(visit_names) or ("",)
+
+    visits_by_name = {
+        visit.name: visit
+        for visit in frappe.get_all(
+            "Maintenance Visit",
+            filters={"name": ["in", visit_tuple]},
+            fields=["*"]
         )
-        latest_punch_out = frappe.db.get_value(
-            "Punch In Punch Out",
-            {
-                "parent": visit.name,
-                "technician": user,
-                "punch_out": ["is", "set"]
+    }
+
+    # child tables, one query per table field
+    table_fields = frappe.get_meta("Maintenance Visit").get_table_fields()
+    children = {}
+    for df in table_fields:
+        rows = frappe.get_all(
+            df.options,
+            filters={
+                "parent": ["in", visit_tuple],
+                "parenttype": "Maintenance Visit",
+                "parentfield": df.fieldname
             },
-            "punch_out",
-            order_by="punch_out DESC"
+            fields=["*"],
+            order_by="idx asc"
         )
-        visit_data["latest_punch_in"] = latest_punch_in if latest_punch_in else ""
-        visit_data["latest_punch_out"] = latest_punch_out if latest_punch_out else ""
+        # attachments / symptom images and product images: thumbnail for display, original for download
+        for fieldname in ("image", "custom_image"):
+            if rows and fieldname in rows[0]:
+                add_thumbnail_urls(rows, fieldname)
+        for row in rows:
+            row.doctype = df.options
+            children.setdefault((row.parent, df.fieldname), []).append(row)
 
+    #visit-start-time
+    visit_starts = dict(frappe.db.sql(
+        """
+            SELECT parent, MAX(visit_start_at)
+            FROM `tabVisit Start Maintenance`
+            WHERE parent IN %(visits)s AND technician = %(user)s
+            GROUP BY parent
+        """,
+        {"visits": visit_tuple, "user": user}
+    ))
 
-        #geolocation
-        delivery_note_name = frappe.get_value(
-            "Serial No",
-            {"custom_item_current_installation_address": visit_doc.delivery_addres},
-            "custom_item_current_installation_address_name"
+    #start-end time
+    assigned_tasks = {}
+    for task in frappe.get_all(
+        "Assigned Tasks",
+        filters={
+            "technician": user, "status": "Pending", "issue_code": ["in", visit_tuple]
+        },
+        order_by="creation desc",
+        fields=["issue_code", "stime", "etime"]
+    ):
+        assigned_tasks.setdefault(task.issue_code, task)
+
+    #punch-in-punch-out
+    punches = {
+        row.parent: row
+        for row in frappe.db.sql(
+            """
+                SELECT parent, MAX(punch_in) AS latest_punch_in, MAX(punch_out) AS latest_punch_out
+                FROM `tabPunch In Punch Out`
+                WHERE parent IN %(visits)s AND technician = %(user)s
+                GROUP BY parent
+            """,
+            {"visits": visit_tuple, "user": user},
+            as_dict=True
+        )
+    }
+
+    #geolocation
+    delivery_addresses = tuple(
+        {visit.delivery_addres for visit in visits_by_name.values() if visit.delivery_addres}
+    ) or ("",)
+    address_by_delivery_address = {}
+    for row in frappe.get_all(
+        "Serial No",
+        filters={"custom_item_current_installation_address": ["in", delivery_addresses]},
+        fields=["custom_item_current_installation_address", "custom_item_current_installation_address_name"]
+    ):
+        address_by_delivery_address.setdefault(
+            row.custom_item_current_installation_address,
+            row.custom_item_current_installation_address_name
         )
-        if not delivery_note_name:
-            address = frappe.get_doc("Address", "Default-Other")
-            geolocation = address.geolocation
-        else:
-            address = frappe.get_doc("Address", delivery_note_name)
-            geolocation = address.geolocation
 
-        if not geolocation:
-            address = frappe.get_doc("Address", "Default-Other")
-            geolocation = address.geolocation
+    address_names = {name for name in address_by_delivery_address.values() if name}
+    address_names.add(DEFAULT_ADDRESS)
+    geolocation_by_address = dict(frappe.get_all(
+        "Address",
+        filters={"name": ["in", tuple(address_names)]},
+        fields=["name", "geolocation"],
+        as_list=True
+    ))
+
+    visits_with_details = []
+    sub_step_visits = []
+    for name in visit_names:
+        visit = visits_by_name.get(name)
+        if not visit:
+            continue
+
+        visit_data = frappe._dict(visit)
+        visit_data["doctype"] = "Maintenance Visit"
+        for df in table_fields:
+            visit_data[df.fieldname] = children.get((name, df.fieldname), [])
+
+        visit_data["visit_start"] = visit_starts.get(name) or ""
+
+        assigned_task = assigned_tasks.get(name)
+        visit_data["start_time"] = assigned_task.stime if assigned_task else ""
+        visit_data["end_time"] = assigned_task.etime if assigned_task else ""
+
+        punch = punches.get(name) or {}
+        visit_data["latest_punch_in"] = punch.get("latest_punch_in") or ""
+        visit_data["latest_punch_out"] = punch.get("latest_punch_out") or ""
+
+        geolocation = geolocation_by_address.get(
+            address_by_delivery_address.get(visit.delivery_addres)
+        ) or geolocation_by_address.get(DEFAULT_ADDRESS)
+        visit_data["geolocation"] = json.loads(geolocation) if geolocation else None
+
+        # filled in below for all visits at once; grouping keeps the same row objects
+        sub_step_visits.append((
+            visit,
+            visit_data.get('checktree_description') or [],
+            visit_data.get('custom_sub_steps_work_log') or []
+        ))
 
-        # Parse geolocation and assign it to the visit_doc
-        geolocation = json.loads(geolocation)
-        visit_data["geolocation"] = geolocation
-        
-        # Initialize a new dictionary for checktree_description
-        checktree_description = {}
-        for item in visit_doc.checktree_description:
-            item_code = item.item_code
-            if item_code not in checktree_description:
-                checktree_description[item_code] = []
-            checktree_description[item_code].append(item.as_dict())
-        
-        # Initialize a new dictionary for symptoms_table
-        symptoms_table = {}
-        for item in visit_doc.symptoms_table:
-            item_code = item.item_code
-            if item_code not in symptoms_table:
-                symptoms_table[item_code] = []
-            symptoms_table[item_code].append(item.as_dict())
-        
         # Create a dictionary for the current visit, including the reformatted child tables
-        visit_data['checktree_description'] = checktree_description
-        visit_data['symptoms_table'] = symptoms_table
-        
-        # Append the reformatted data to the final output
+        visit_data['checktree_description'] = group_by_item_code(visit_data.get('checktree_description') or [])
+        visit_data['symptoms_table'] = group_by_item_code(visit_data.get('symptoms_table') or [])
+
         visits_with_details.append(visit_data)
-    
+
+    set_mobile_sub_steps(sub_step_visits)
     return visits_with_details
 
+def set_mobile_sub_steps(visits):
+    """
+    Fill `sub_steps_json` and `sub_steps_format_for_mobile_apk` of the checklist rows of
+    visits from their Maintenance Visit Sub Step Work rows, which hold the sub-step state.
+
+    Args:
+        visits: List of (visit, checklist rows, sub-step rows)
+
+    The result is cached per (visit, modified); every sub-step write moves the visit's
+    `modified`, so a cached entry never goes stale. All entries are read with one MGET
+    and the misses written back in one pipeline.
+    """
+    if not visits:
+        return
+
+    cache = frappe.cache()
+    keys = [
+        cache.make_key(f"{MOBILE_SUB_STEPS_CACHE_KEY}{visit.name}:{visit.modified}")
+        for visit, checklist_rows, sub_step_rows in visits
+    ]
+    pipeline = cache.pipeline()
+    for key, cached, (visit, checklist_rows, sub_step_rows) in zip(keys, cache.mget(keys), visits):
+        if cached is None:
+            sub_steps = build_mobile_sub_steps(checklist_rows, sub_step_rows)
+            pipeline.set(key, json.dumps(sub_steps), ex=MOBILE_SUB_STEPS_CACHE_TTL)
+        else:
+            sub_steps = json.loads(cached)
+
+        for row in checklist_rows:
+            if row.name in sub_steps:
+                row.update(sub_steps[row.name])
+    pipeline.execute()
+
+def build_mobile_sub_steps(checklist_rows, sub_step_rows):
+    """
+    Returns {checklist row name: {"sub_steps_json": ..., "sub_steps_format_for_mobile_apk": ...}}.
+
+    `sub_steps_json` keeps the sub-step definitions of the checklist row with the current
+    work_done; the mobile format has one entry per work log row, in idx order.
+    """
+    rows_by_checklist = {}
+    for sub_step in sorted(sub_step_rows, key=lambda row: row.idx or 0):
+        rows_by_checklist.setdefault(sub_step.parent_checklist_row, []).append(sub_step)
+
+    sub_steps = {}
+    for checklist in checklist_rows:
+        try:
+            definitions = json.loads(checklist.sub_steps_json or "[]")
+        except (json.JSONDecodeError, TypeError) as e:
+            frappe.log_error(f"Error parsing sub_steps_json: {str(e)}", "Sub-step JSON Read Error")
+            definitions = []
+        definitions = [d for d in definitions if isinstance(d, dict)]
+        definition_by_name = {d.get('name'): d for d in definitions}
+
+        rows = rows_by_checklist.get(checklist.name, [])
+        work_done_by_name = {row.sub_step_original_name: row.work_done or 'No' for row in rows}
+        for definition in definitions:
+            if definition.get('name') in work_done_by_name:
+                definition['work_done'] = work_done_by_name[definition['name']]
+
+        mobile_format = []
+        for row in rows:
+            mobile_step = dict(definition_by_name.get(row.sub_step_original_name) or {})
+            mobile_step.update({
+                "idx": row.idx,
+                "sub_step_name": row.name,
+                "parent_step_name": checklist.name,
+                "sub_step_original_name": row.sub_step_original_name,
+                "work_done": row.work_done or 'No',
+                "done_by": row.done_by
+            })
+            mobile_format.append(mobile_step)
+
+        if definitions or mobile_format:
+            sub_steps[checklist.name] = {
+                "sub_steps_json": json.dumps(definitions),
+                "sub_steps_format_for_mobile_apk": json.dumps(mobile_format, default=str)
+            }
+
+    return sub_steps
+
+def group_by_item_code(rows):
+    grouped = {}
+    for row in rows:
+        grouped.setdefault(row.item_code, []).append(row)
+    return grouped
+
+def commit_mutation():
+    """Commit the request, unless it runs inside `apply_mutations`, which commits the whole batch once"""
+    if not frappe.flags.in_mutation_batch:
+        frappe.db.commit()
+
+def get_action_time():
+    """When the technician acted: the device time of a mutation replayed by `apply_mutations`, else now"""
+    return frappe.flags.mutation_timestamp or now_datetime()
+
 @frappe.whitelist(allow_guest=True)
-def update_spare_item(status, name):
-    authorization_header = frappe.get_request_header("Authorization")
-    if not authorization_header:
-        return { "status": "error", "message": "Missing Authorization header"}
-    api_key = frappe.get_request_header("Authorization").split(" ")[1].split(":")[0]
-    # Find the user associated with the API key
-    user = frappe.db.get_value("User", {"api_key": api_key}, "name")
-    
-    if not user:
-        return {"status": "failed", "message": "Invalid API key"}
+@api_key_auth
+def update_spare_item(status, name, user):
     spare_item = frappe.get_doc("Spare Items", name)
     if not spare_item:
         return {"status": "error", "message": f"Spare Item with name '{name}' not found"}
@@ -208,22 +478,13 @@ def update_spare_item(status, name):
     spare_item.flags.ignore_permissions = True
     spare_item.save()
     # Commit the changes to the database
-    frappe.db.commit()
+    commit_mutation()
 
     return {"status": "success", "message": f"Spare Item '{name}' updated successfully", "collected": status}
 
 @frappe.whitelist(allow_guest=True)
-def start_maintenance_visit(name):
-    authorization_header = frappe.get_request_header("Authorization")
-    if not authorization_header:
-        return { "status": "error", "message": "Missing Authorization header"}
-    api_key = frappe.get_request_header("Authorization").split(" ")[1].split(":")[0]
-    # Find the user associated with the API key
-    user = frappe.db.get_value("User", {"api_key": api_key}, "name")
-    
-    if not user:
-        return {"status": "failed", "message": "Invalid API key"}
-    
+@api_key_auth
+def start_maintenance_visit(name, user):
     if not name:
         return {"status": "error", "message": "Maintenance Visit name is required"}
 
@@ -248,14 +509,14 @@ def start_maintenance_visit(name):
             "parentfield": "visit_start_records",
             "maintenance_visit": name,
             "technician": technician_user,
-            "visit_start_at": now_datetime(),
+            "visit_start_at": get_action_time(),
         })
         new_record.insert(ignore_permissions=True)
-        frappe.db.commit()
+        commit_mutation()
 
         maintenance.reload()
         if maintenance.visit_start is None:
-            maintenance.visit_start = now()
+            maintenance.visit_start = get_action_time()
         maintenance.flags.ignore_permissions = True
         maintenance.save()
         
@@ -291,17 +552,50 @@ def check_300m_radius(lat1, lon1, lat2, lon2):
     return {"status": "success", "distance": f"Distance between customer location and technician location is '{distance}'.", "message": distance <= radius}
 
 @frappe.whitelist(allow_guest=True)
-def update_punch_in_out(maintenance_visit, punch_in=None, punch_out=None, visit_type="First Visit", is_completed='no'):
-    authorization_header = frappe.get_request_header("Authorization")
-    if not authorization_header:
-        return { "status": "error", "message": "Missing Authorization header"}
-    api_key = frappe.get_request_header("Authorization").split(" ")[1].split(":")[0]
-    # Find the user associated with the API key
-    user = frappe.db.get_value("User", {"api_key": api_key}, "name")
+@api_key_auth
+def check_radius_batch(targets, user, origin=None, origins=None, radius=300):
+    """
+    Distances from one origin to N targets, or from N origins to M targets, in one call
+
+    Args:
+        targets: JSON list of [lat, lon] or {"lat": ..., "lon": ...}
+        origin: (Optional) Single point, the result is then a flat list per target
+        origins: (Optional) List of points, the result is then one row per origin
+        radius: Radius in meters for the `within_radius` flags
 
-    if not user:
-        return {"status": "failed", "message": "Invalid API key"}
+    Note: Either 'origin' or 'origins' must be provided.
+    """
+    try:
+        targets = parse_coordinates(targets)
+        single_origin = origin is not None
+        if single_origin:
+            # one point, either [lat, lon] or {"lat": ..., "lon": ...}
+            origins = [json.loads(origin) if isinstance(origin, str) else origin]
+        origins = parse_coordinates(origins or [])
+        radius = float(radius)
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        return {"status": "error", "message": f"Invalid coordinates: {e}"}
+
+    if not origins or not targets:
+        return {"status": "error", "message": "Either 'origin' or 'origins', and 'targets' must be provided"}
+    if len(origins) * len(targets) > MAX_DISTANCE_PAIRS:
+        return {"status": "error", "message": f"At most {MAX_DISTANCE_PAIRS} origin/target pairs per call"}
+
+    distances = haversine_matrix(origins, targets)
+    within_radius = distances <= radius
+    if single_origin:
+        distances, within_radius = distances[0], within_radius[0]
 
+    return {
+        "status": "success",
+        "radius": radius,
+        "distances": distances.round(2).tolist(),
+        "within_radius": within_radius.tolist()
+    }
+
+@frappe.whitelist(allow_guest=True)
+@api_key_auth
+def update_punch_in_out(maintenance_visit, user, punch_in=None, punch_out=None, visit_type="First Visit", is_completed='no'):
     # Ensure the Maintenance Visit exists
     maintenance = frappe.get_doc("Maintenance Visit", maintenance_visit)
     if not maintenance:
@@ -336,7 +630,8 @@ def update_punch_in_out(maintenance_visit, punch_in=None, punch_out=None, visit_
 
             visit_start_time = visit_start_record[0].get("visit_start_at")
 
-            travel_time = get_time_difference(visit_start_time, now_datetime())
+            punch_in = get_action_time()
+            travel_seconds = get_duration_seconds(visit_start_time, punch_in)
             new_record = frappe.get_doc({
                 "doctype": "Punch In Punch Out",
                 "parent": maintenance_visit,
@@ -344,14 +639,15 @@ def update_punch_in_out(maintenance_visit, punch_in=None, punch_out=None, visit_
                 "parentfield": "punch_in_punch_out",
                 "maintenance_visit": maintenance_visit,
                 "technician": technician_user,
-                "punch_in": now_datetime(),
-                "travel_time": travel_time,
+                "punch_in": punch_in,
+                "travel_time": format_duration(travel_seconds),
+                "custom_travel_seconds": travel_seconds,
                 "type": "First Visit",
                 "is_completed": 'no'
             })
 
             new_record.insert(ignore_permissions=True)
-            frappe.db.commit()
+            commit_mutation()
             return {"status": "success", "message": "Punch-in recorded for First Visit"}
 
         elif visit_type == "Rescheduled Visit":
@@ -363,7 +659,7 @@ def update_punch_in_out(maintenance_visit, punch_in=None, punch_out=None, visit_
                 "parentfield": "punch_in_punch_out",
                 "maintenance_visit": maintenance_visit,
                 "technician": technician_user,
-                "punch_in": now_datetime(),
+                "punch_in": get_action_time(),
                 "type": "Rescheduled Visit",
                 "is_completed": False
             })
@@ -379,11 +675,12 @@ def update_punch_in_out(maintenance_visit, punch_in=None, punch_out=None, visit_
             visit_start_time = visit_start_record[0].get("visit_start_at")
             
             # Calculate the travel_time (difference between visit_start_time and punch_in)
-            travel_time = get_time_difference(visit_start_time, new_record.punch_in)  # Get the time difference
-            new_record.travel_time = travel_time
+            travel_seconds = get_duration_seconds(visit_start_time, new_record.punch_in)  # Get the time difference
+            new_record.travel_time = format_duration(travel_seconds)
+            new_record.custom_travel_seconds = travel_seconds
 
             new_record.insert(ignore_permissions=True)
-            frappe.db.commit()
+            commit_mutation()
             return {"status": "success", "message": "Punch-in recorded for Rescheduled Visit"}
 
     # Case 2: Punching Out (for an ongoing visit)
@@ -392,11 +689,13 @@ def update_punch_in_out(maintenance_visit, punch_in=None, punch_out=None, visit_
             # Update the latest active record with punch_out time and is_completed flag
             record_name = existing_records[0]['name']
             existing_record = frappe.get_doc("Punch In Punch Out", record_name)
-            existing_record.punch_out = now_datetime()
-            existing_record.working_hours = get_time_difference(existing_record.punch_in, now_datetime())
+            existing_record.punch_out = get_action_time()
+            working_seconds = get_duration_seconds(existing_record.punch_in, existing_record.punch_out)
+            existing_record.working_hours = format_duration(working_seconds)
+            existing_record.custom_working_seconds = working_seconds
             existing_record.completed = 'yes'
             existing_record.save(ignore_permissions=True)
-            frappe.db.commit()
+            commit_mutation()
             status_msg = "Punch-out recorded"
             status_msg += " and visit marked as Approval Pending"
             frappe.db.sql(
@@ -414,31 +713,13 @@ def update_punch_in_out(maintenance_visit, punch_in=None, punch_out=None, visit_
 def get_time_difference(start_time, end_time):
     """
     Calculate the time difference between two datetime values.
-    Returns the difference in seconds.
+    Returns the difference as "Xh Ym" text; see `get_duration_seconds` for the seconds.
     """
-    if not start_time or not end_time:
-        return 0
-    
-    time_diff = end_time - start_time
-    total_seconds = time_diff.total_seconds()
-    
-    hours = int(total_seconds // 3600)
-    minutes = int((total_seconds % 3600) // 60)
-    
-    return f"{hours}h {minutes}m"
+    return format_duration(get_duration_seconds(start_time, end_time))
     
 @frappe.whitelist(allow_guest=True)
-def get_maintenance_(name = None):
-
-    authorization_header = frappe.get_request_header("Authorization")
-    if not authorization_header:
-        return { "status": "error", "message": "Missing Authorization header"}
-    api_key = frappe.get_request_header("Authorization").split(" ")[1].split(":")[0]
-    # Find the user associated with the API key
-    user = frappe.db.get_value("User", {"api_key": api_key}, "name")
-    
-    if not user:
-        return {"status": "failed", "message": "Invalid API key"}
+@api_key_auth
+def get_maintenance_(user, name = None):
     
     visit_doc = frappe.get_doc("Maintenance Visit", name)
 
@@ -518,13 +799,16 @@ def get_maintenance_(name = None):
     geolocation = json.loads(geolocation)
     visit_data["geolocation"] = geolocation
     
+    checklist_rows = [item.as_dict() for item in visit_doc.checktree_description]
+    set_mobile_sub_steps([(visit_doc, checklist_rows, visit_doc.custom_sub_steps_work_log)])
+
     # Initialize a new dictionary for checktree_description
     checktree_description = {}
-    for item in visit_doc.checktree_description:
+    for item in checklist_rows:
         item_code = item.item_code
         if item_code not in checktree_description:
             checktree_description[item_code] = []
-        checktree_description[item_code].append(item.as_dict())
+        checktree_description[item_code].append(item)
     
     # Initialize a new dictionary for symptoms_table
     symptoms_table = {}
@@ -571,6 +855,7 @@ def get_maintenance_(name = None):
 
 
 @frappe.whitelist(allow_guest=True)
+@api_key_auth
 # def update_checktree(status, name=None, sub_step_name=None):
 def update_checktree(**kwargs):
     """
@@ -580,26 +865,18 @@ def update_checktree(**kwargs):
         status: 'yes' or 'no'
         name: (Optional) Name of the Maintenance Visit Checklist row (e.g., "a6po3pq7ak")
         sub_step_name: (Optional) Name of the work log record (e.g., "2kn6f2fgld")
+        modified: (Optional) With sub_step_name, `modified` of the sub-step as loaded by the app
     
     Note: Either 'name' or 'sub_step_name' must be provided, but not necessarily both.
     """
-    authorization_header = frappe.get_request_header("Authorization")
-    if not authorization_header:
-        return {"status": "error", "message": "Missing Authorization header"}
-    
-    api_key = frappe.get_request_header("Authorization").split(" ")[1].split(":")[0]
-    user = frappe.db.get_value("User", {"api_key": api_key}, "name")
-    
-    if not user:
-        return {"status": "failed", "message": "Invalid API key"}
-
+    user = kwargs.get('user')
     status = kwargs.get('status')
     name = kwargs.get('name')
     sub_step_name = kwargs.get('sub_step_name')
     
     # Case 1: Update SUB-STEP work done
     if sub_step_name:
-        return update_sub_step_by_name(sub_step_name, status, user)
+        return update_sub_step_by_name(sub_step_name, status, user, kwargs.get('modified'))
     
     # Case 2: Update MAIN CHECKLIST work done
     elif name:
@@ -628,7 +905,7 @@ def update_main_checklist(name, status, user):
     
     checklist.flags.ignore_permissions = True
     checklist.save()
-    frappe.db.commit()
+    commit_mutation()
     
     return {
         "status": "success",
@@ -746,120 +1023,226 @@ def update_main_checklist(name, status, user):
 #         "done_by": user if status == 'yes' else None
 #     }
 
-def update_sub_step_by_name(sub_step_name, status, user):
+def update_sub_step_by_name(sub_step_name, status, user, modified=None):
     """
     Update sub-step work done using the work log record name directly
-    
+
+    Only the sub-step row and its checklist row are written, with direct column
+    updates instead of a save of the whole Maintenance Visit. The checklist row is
+    locked first and the sub-steps are counted with a locking read, so co-technicians
+    ticking sub-steps of the same checklist row in parallel are applied one after the
+    other and the last one always sees every other sub-step's state.
+
     Args:
         sub_step_name: The 'name' field from Maintenance Visit Sub Step Work (e.g., "2kn6f2fgld")
         status: 'yes' or 'no'
         user: Current user
+        modified: (Optional) `modified` of the sub-step as last loaded by the app. If the
+            row has changed since, nothing is written and the current state is returned.
     """
-    import json
-    
-    # Get the work log entry directly
-    work_log = frappe.get_doc("Maintenance Visit Sub Step Work", sub_step_name)
+    checklist_row_name = frappe.db.get_value(
+        "Maintenance Visit Sub Step Work", sub_step_name, "parent_checklist_row"
+    )
+
+    # Step 1: Lock the parent checklist row, which serializes all updates to its sub-steps
+    # (the sub-step JSON of the app is derived on read)
+    parent_checklist = checklist_row_name and frappe.db.get_value(
+        "Maintenance Visit Checklist",
+        checklist_row_name,
+        ["name", "work_done", "done_by"],
+        as_dict=True,
+        for_update=True
+    )
+
+    work_log = frappe.db.get_value(
+        "Maintenance Visit Sub Step Work",
+        sub_step_name,
+        ["name", "parent", "parent_checklist_row", "sub_step_original_name", "idx",
+         "work_done", "done_by", "modified"],
+        as_dict=True,
+        for_update=True
+    )
     
     if not work_log:
         return {
             "status": "error",
             "message": f"Sub-step work log '{sub_step_name}' not found"
         }
-    
-    # Get parent Maintenance Visit
-    visit_doc = frappe.get_doc("Maintenance Visit", work_log.parent)
-    
-    # Step 1: Update custom_sub_steps_work_log
-    for sub_step in visit_doc.custom_sub_steps_work_log:
-        if sub_step.name == sub_step_name:
-            if status == 'yes':
-                sub_step.work_done = 'Yes'
-                sub_step.done_by = user
-            else:
-                sub_step.work_done = 'No'
-                sub_step.done_by = None
-            break
-    
-    # Step 2 & 3: Update JSON fields in checktree_description
-    checklist_row_name = work_log.parent_checklist_row
-    sub_step_original_name = work_log.sub_step_original_name
 
-    parent_checklist = None
-    
-    for checklist in visit_doc.checktree_description:
-        if checklist.name == checklist_row_name:
-            parent_checklist = checklist
-            
-            # Update sub_steps_json
-            if checklist.sub_steps_json:
-                try:
-                    sub_steps_json = json.loads(checklist.sub_steps_json)
-                    
-                    for sub_step_json in sub_steps_json:
-                        if sub_step_json.get('name') == sub_step_original_name:
-                            sub_step_json['work_done'] = 'Yes' if status == 'yes' else 'No'
-                            break
-                    
-                    checklist.sub_steps_json = json.dumps(sub_steps_json)
-                
-                except (json.JSONDecodeError, TypeError) as e:
-                    frappe.log_error(f"Error parsing sub_steps_json: {str(e)}", "Sub-step JSON Update Error")
-            
-            # Update sub_steps_format_for_mobile_apk
-            if checklist.sub_steps_format_for_mobile_apk:
-                try:
-                    mobile_format = json.loads(checklist.sub_steps_format_for_mobile_apk)
-                    
-                    # for mobile_step in mobile_format:
-                    #     if mobile_step.get('sub_step_name') == sub_step_name:
-                    #         mobile_step['work_done'] = 'Yes' if status == 'yes' else 'No'
-                    #         break
-
-                    # Fixed — uses idx as fallback
-                    for mobile_step in mobile_format:
-                        if mobile_step.get('sub_step_name') == sub_step_name:
-                            mobile_step['work_done'] = 'Yes' if status == 'yes' else 'No'
-                            break
-                        elif not mobile_step.get('sub_step_name') and mobile_step.get('idx') == work_log.idx:
-                            mobile_step['work_done'] = 'Yes' if status == 'yes' else 'No'
-                            # Also backfill sub_step_name and parent_step_name while we're here
-                            mobile_step['sub_step_name'] = sub_step_name
-                            mobile_step['parent_step_name'] = checklist_row_name
-                            break
-                    
-                    checklist.sub_steps_format_for_mobile_apk = json.dumps(mobile_format)
-                
-                except (json.JSONDecodeError, TypeError) as e:
-                    frappe.log_error(f"Error parsing sub_steps_format_for_mobile_apk: {str(e)}", "Mobile Format Update Error")
-            
-            break
-    
-    # Step 4: Check if all sub-steps are complete and auto-update parent checklist
+    if modified and get_datetime(modified) != work_log.modified:
+        return {
+            "status": "conflict",
+            "message": "Sub-step was updated by someone else",
+            "work_done": work_log.work_done,
+            "done_by": work_log.done_by,
+            "modified": work_log.modified
+        }
+
+    timestamp = now_datetime()
+
+    # Step 2: Update the sub-step row
+    set_work_done(work_log, status, user)
+    frappe.db.set_value(
+        "Maintenance Visit Sub Step Work",
+        sub_step_name,
+        {"work_done": work_log.work_done, "done_by": work_log.done_by},
+        modified=timestamp,
+        modified_by=user
+    )
+
+    all_sub_steps_complete = False
     if parent_checklist:
-        all_sub_steps_complete = check_all_sub_steps_complete(
-            visit_doc, 
-            checklist_row_name
+        # Step 3: Check if all sub-steps are complete and auto-update parent checklist
+        all_sub_steps_complete = are_sub_steps_complete(work_log.parent, checklist_row_name)
+        set_work_done(parent_checklist, 'yes' if all_sub_steps_complete else 'no', user)
+
+        frappe.db.set_value(
+            "Maintenance Visit Checklist",
+            checklist_row_name,
+            {"work_done": parent_checklist.work_done, "done_by": parent_checklist.done_by},
+            modified=timestamp,
+            modified_by=user
         )
-        
-        if all_sub_steps_complete:
-            parent_checklist.work_done = 'Yes'
-            parent_checklist.done_by = user
-        else:
-            # If any sub-step is not complete, set parent to 'No'
-            parent_checklist.work_done = 'No'
-            parent_checklist.done_by = None
-    
-    # Save the entire document
-    visit_doc.flags.ignore_permissions = True
-    visit_doc.save()
-    frappe.db.commit()
+
+    # Step 4: Move the visit's timestamp, which keys the derived sub-step JSON and keeps
+    # forms open on the old version from saving over this
+    frappe.db.set_value(
+        "Maintenance Visit", work_log.parent, "modified", timestamp, update_modified=False
+    )
+    commit_mutation()
     
     return {
         "status": "success",
         "message": f"Sub-step updated successfully",
         "work_done": status,
         "done_by": user if status == 'yes' else None,
-        "parent_checklist_auto_updated": all_sub_steps_complete if parent_checklist else False
+        "modified": timestamp,
+        "parent_checklist_auto_updated": all_sub_steps_complete
+    }
+
+
+def are_sub_steps_complete(maintenance_visit, parent_checklist_row):
+    """
+    Database version of `check_all_sub_steps_complete`, without loading the visit.
+    A locking read, so it sees rows committed after the transaction's snapshot.
+    """
+    total, done = frappe.db.sql(
+        """
+            SELECT COUNT(*), COALESCE(SUM(work_done = 'Yes'), 0)
+            FROM `tabMaintenance Visit Sub Step Work`
+            WHERE parent = %s AND parenttype = 'Maintenance Visit' AND parent_checklist_row = %s
+            FOR UPDATE
+        """,
+        (maintenance_visit, parent_checklist_row)
+    )[0]
+    return bool(total) and total == done
+
+
+def set_work_done(row, status, user):
+    """Set work_done / done_by of a checklist or sub-step row from a 'yes'/'no' status"""
+    if status == 'yes':
+        row.work_done = 'Yes'
+        row.done_by = user
+    else:
+        row.work_done = 'No'
+        row.done_by = None
+
+
+def apply_sub_step_status(visit_doc, sub_step, status, user):
+    """
+    Update a sub-step row of a loaded visit in memory.
+
+    Returns the parent checklist row, None if it is not part of the visit.
+    """
+    set_work_done(sub_step, status, user)
+
+    for checklist in visit_doc.checktree_description:
+        if checklist.name == sub_step.parent_checklist_row:
+            return checklist
+
+    return None
+
+
+def update_checklist_from_sub_steps(visit_doc, checklist, user):
+    """Set a checklist row to done only when all of its sub-steps are done"""
+    all_sub_steps_complete = check_all_sub_steps_complete(visit_doc, checklist.name)
+    set_work_done(checklist, 'yes' if all_sub_steps_complete else 'no', user)
+    return all_sub_steps_complete
+
+
+@frappe.whitelist(allow_guest=True)
+@api_key_auth
+def update_checktree_bulk(maintenance_visit, changes, user):
+    """
+    Update several checklist rows and sub-steps of one visit with a single save
+
+    Args:
+        maintenance_visit: Name of the Maintenance Visit
+        changes: List (or JSON list) of {"name": checklist row} or {"sub_step_name": work log row},
+            each with "status": 'yes' or 'no'. Applied in order, like successive `update_checktree` calls.
+    """
+    if isinstance(changes, str):
+        try:
+            changes = json.loads(changes)
+        except ValueError:
+            return {"status": "error", "message": "changes must be a JSON list"}
+
+    if not isinstance(changes, list) or not changes:
+        return {"status": "error", "message": "changes must be a non-empty list"}
+
+    if not frappe.db.exists("Maintenance Visit", maintenance_visit):
+        return {"status": "error", "message": f"Maintenance Visit '{maintenance_visit}' not found"}
+
+    visit_doc = frappe.get_doc("Maintenance Visit", maintenance_visit)
+    checklist_rows = {row.name: row for row in visit_doc.checktree_description}
+    sub_steps = {row.name: row for row in visit_doc.custom_sub_steps_work_log}
+
+    # checklist rows whose work_done follows their sub-steps; an explicit update of
+    # the row after its last sub-step change wins, as it would with one call per change
+    derived_checklists = {}
+    for change in changes:
+        status = change.get('status')
+        if change.get('sub_step_name'):
+            sub_step = sub_steps.get(change['sub_step_name'])
+            if not sub_step:
+                return {
+                    "status": "error",
+                    "message": f"Sub-step work log '{change['sub_step_name']}' not found in '{maintenance_visit}'"
+                }
+            parent_checklist = apply_sub_step_status(visit_doc, sub_step, status, user)
+            if parent_checklist:
+                derived_checklists[parent_checklist.name] = parent_checklist
+
+        elif change.get('name'):
+            checklist = checklist_rows.get(change['name'])
+            if not checklist:
+                return {
+                    "status": "error",
+                    "message": f"Checklist with name '{change['name']}' not found in '{maintenance_visit}'"
+                }
+            set_work_done(checklist, status, user)
+            derived_checklists.pop(checklist.name, None)
+
+        else:
+            return {
+                "status": "error",
+                "message": "Either 'name' or 'sub_step_name' must be provided for every change"
+            }
+
+    for checklist in derived_checklists.values():
+        update_checklist_from_sub_steps(visit_doc, checklist, user)
+
+    visit_doc.flags.ignore_permissions = True
+    visit_doc.save()
+    frappe.db.commit()
+
+    return {
+        "status": "success",
+        "message": f"{len(changes)} checklist updates applied",
+        "checklist": [
+            {"name": row.name, "work_done": row.work_done, "done_by": row.done_by}
+            for row in visit_doc.checktree_description
+        ]
     }
 
 
@@ -895,69 +1278,50 @@ def check_all_sub_steps_complete(visit_doc, parent_checklist_row):
 
 
 @frappe.whitelist(allow_guest=True)
-def live_location(lat, lon):
-    authorization_header = frappe.get_request_header("Authorization")
-    if not authorization_header:
-        return { "status": "error", "message": "Missing Authorization header"}
-    api_key = frappe.get_request_header("Authorization").split(" ")[1].split(":")[0]
-    # Find the user associated with the API key
-    user = frappe.db.get_value("User", {"api_key": api_key}, "name")
-
-    if not user:
-        return {"status": "failed", "message": "Invalid API key"}
-
-    employee_data = (
-        frappe.db.get_value(
-            "Employee", {"user_id": user}, ["name", "employee_name"], as_dict=True
-        )
-        or {}
-    )
+@api_key_auth
+def live_location(lat, lon, user):
+    points, rejected = parse_location_points([{"lat": lat, "lon": lon}])
+    if rejected:
+        return {"status": "error", "message": "Invalid latitude or longitude"}
 
-    location = None
-    if lat and lon:
-        location = json.dumps(
-            {
-                "type": "FeatureCollection",
-                "features": [
-                    {
-                        "type": "Feature",
-                        "properties": {},
-                        "geometry": {
-                            "type": "Point",
-                            "coordinates": [lon, lat],  # Note: [lng, lat]
-                        },
-                    }
-                ],
-            }
-        )
+    result = ingest_live_locations(user, points)
+    frappe.db.commit()
+    return {
+        "status": "success",
+        "message": "Updated live Location",
+        "suppressed": result.suppressed,
+        "geofence_events": result.events
+    }
 
-    new_record = frappe.get_doc(
-        {
-            "doctype": "Live Location",
-            "latitude": lat,
-            "longitude": lon,
-            "employee": employee_data.get("name"),
-            "employee_name": employee_data.get("employee_name"),
-            "technician": user,
-            "location": location,
-            "time": now_datetime(),
-        }
-    )
-    new_record.insert(ignore_permissions=True)
+@frappe.whitelist(allow_guest=True)
+@api_key_auth
+def live_location_batch(points, user):
+    """
+    Store a batch of location points (e.g. queued while offline) in one request
+
+    Args:
+        points: JSON list of {"lat": ..., "lon": ..., "time": "YYYY-MM-DD HH:MM:SS"}, time defaults to now
+    """
+    try:
+        points, rejected = parse_location_points(points)
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}
+
+    result = ingest_live_locations(user, points)
     frappe.db.commit()
-    return {"status": "success", "message": "Updated live Location"}
+    return {
+        "status": "success",
+        "message": "Updated live Location",
+        "accepted": result.stored,
+        "suppressed": result.suppressed,
+        "rejected": rejected,
+        "mode": result.mode,
+        "geofence_events": result.events
+    }
 
 @frappe.whitelist(allow_guest=True)
-def attachment(maintenance_visit):
-    authorization_header = frappe.get_request_header("Authorization")
-    if not authorization_header:
-        return { "status": "error", "message": "Missing Authorization header"}
-    api_key = frappe.get_request_header("Authorization").split(" ")[1].split(":")[0]
-    # Find the user associated with the API key
-    user = frappe.db.get_value("User", {"api_key": api_key}, "name")
-    
-    if not user:
-        return {"status": "failed", "message": "Invalid API key"}
+@api_key_auth
+def attachment(maintenance_visit, user):
     if not maintenance_visit:
         return {"status": "Failed", "message": "Maintenance Visit not provided."}
 
@@ -971,59 +1335,21 @@ def attachment(maintenance_visit):
         if 'image' not in frappe.request.files:
             return {"status": "Failed", "message": "Image file not found in the request."}
 
-        # Step 3: Get the uploaded file from the request
-        uploaded_file = frappe.request.files['image']
-        file_content = uploaded_file.stream.read()
+        # Step 3: Stream the uploaded file to disk (content-addressed) and create the File record
         caption = frappe.request.form.get('caption')
+        try:
+            file_url = save_uploaded_image(frappe.request.files['image'], maintenance_visit)
+        except UploadError as e:
+            return {"status": "Failed", "message": str(e)}
 
-        # Step 4: Get the file extension from the content
-        file_extension = imghdr.what(None, file_content)
-        if not file_extension:
-            return {"status": "Failed", "message": "Invalid image format"}
-
-        # Step 5: Generate a unique filename
-        unique_filename = f"{random_string(10)}.{file_extension}"
-
-        # Step 6: Define the path to save the file in the public folder
-        public_files_path = get_site_path("public", "files")
-        file_path = os.path.join(public_files_path, unique_filename)
-
-        # Step 7: Ensure the directory exists, create if not
-        if not os.path.exists(public_files_path):
-            os.makedirs(public_files_path)
-
-        # Step 8: Save the file in the public folder
-        with open(file_path, "wb") as f:
-            f.write(file_content)
-
-        # Step 9: Create a new record in the File Doctype
-        file_doc = frappe.get_doc({
-            "doctype": "File",
-            "file_name": unique_filename,
-            "file_url": f"/files/{unique_filename}",
-            "attached_to_doctype": "Maintenance Visit",
-            "attached_to_name": maintenance_visit,
-            "is_private": 0  # Make the file publicly accessible
-        })
-        file_doc.insert(ignore_permissions=True)
-
-        # Step 10: Insert a record in the Attachments child table
-        new_attachment = frappe.get_doc({
-            "doctype": "Attachments",
-            "parent": maintenance_visit,
-            "parenttype": "Maintenance Visit",
-            "parentfield": "attachments",
-            "maintenance_visit": maintenance_visit,
-            "image": file_doc.file_url,
-            "caption": caption
-        })
-        new_attachment.insert(ignore_permissions=True)
+        # Step 4: Insert a record in the Attachments child table
+        create_visit_attachment(maintenance_visit, file_url, caption)
         frappe.db.commit()
 
         return {
             "status": "success",
             "message": "Image uploaded and records updated successfully",
-            "file_url": file_doc.file_url
+            "file_url": file_url
         }
 
     except Exception as e:
@@ -1031,16 +1357,74 @@ def attachment(maintenance_visit):
         return {"status": "Failed", "message": str(e)}
 
 @frappe.whitelist(allow_guest=True)
-def technician_notes(maintenance_visit, note):
-    authorization_header = frappe.get_request_header("Authorization")
-    if not authorization_header:
-        return { "status": "error", "message": "Missing Authorization header"}
-    api_key = frappe.get_request_header("Authorization").split(" ")[1].split(":")[0]
-    # Find the user associated with the API key
-    user = frappe.db.get_value("User", {"api_key": api_key}, "name")
-    
-    if not user:
-        return {"status": "failed", "message": "Invalid API key"}
+@api_key_auth
+def upload_initiate(maintenance_visit, user, caption=None, size=None):
+    """
+    Open a resumable upload of an image for a Maintenance Visit
+
+    Args:
+        caption: (Optional) Caption of the attachment
+        size: (Optional) Total size in bytes, checked on finalize
+    """
+    if not frappe.db.exists("Maintenance Visit", maintenance_visit):
+        return {"status": "Failed", "message": "Maintenance Visit not found."}
+
+    try:
+        session = create_upload_session(user, maintenance_visit, caption, size)
+    except UploadError as e:
+        return {"status": "Failed", "message": str(e)}
+
+    return {
+        "status": "success",
+        "upload_id": session["upload_id"],
+        "offset": 0,
+        "chunk_size": UPLOAD_SESSION_CHUNK_SIZE
+    }
+
+@frappe.whitelist(allow_guest=True)
+@api_key_auth
+def upload_chunk(upload_id, offset, user):
+    """Append the 'chunk' file of the request to an upload, at `offset` (bytes received so far)"""
+    if 'chunk' not in frappe.request.files:
+        return {"status": "Failed", "message": "Chunk not found in the request."}
+
+    try:
+        offset = append_upload_chunk(upload_id, user, offset, frappe.request.files['chunk'].stream)
+    except UploadError as e:
+        return {"status": "Failed", "message": str(e)}
+
+    return {"status": "success", "offset": offset}
+
+@frappe.whitelist(allow_guest=True)
+@api_key_auth
+def upload_status(upload_id, user):
+    """Offset to resume an interrupted upload from"""
+    try:
+        session = get_upload_session(upload_id, user)
+    except UploadError as e:
+        return {"status": "Failed", "message": str(e)}
+
+    return {"status": "success", "offset": session["offset"], "size": session["size"]}
+
+@frappe.whitelist(allow_guest=True)
+@api_key_auth
+def upload_finalize(upload_id, user, sha256=None):
+    """Complete an upload: creates the File and Attachments records like `attachment`. Safe to retry."""
+    try:
+        file_url = finalize_upload_session(upload_id, user, sha256)
+    except UploadError as e:
+        return {"status": "Failed", "message": str(e)}
+
+    frappe.db.commit()
+    return {
+        "status": "success",
+        "message": "Image uploaded and records updated successfully",
+        "file_url": file_url
+    }
+
+@frappe.whitelist(allow_guest=True)
+@api_key_auth
+def technician_notes(maintenance_visit, note, user):
     maintenance = frappe.get_doc("Maintenance Visit", maintenance_visit)
     if not maintenance:
         return {"status": "Failed", "message": f"Maintenance Visit '{maintenance_visit}' not found."}
@@ -1052,17 +1436,173 @@ def technician_notes(maintenance_visit, note):
     
     return {"status": "Success", "message": f"Service Tech Notes updated for Maintenance Visit '{maintenance_visit}'."}
 
+MUTATION_OPERATIONS = {
+    "start_maintenance_visit": start_maintenance_visit,
+    "update_punch_in_out": update_punch_in_out,
+    "update_checktree": update_checktree,
+    "technician_notes": technician_notes,
+    "update_spare_item": update_spare_item,
+}
+
 @frappe.whitelist(allow_guest=True)
-def add_symptom_requests(maintenance_visit, item_code, symptoms=None):
-    authorization_header = frappe.get_request_header("Authorization")
-    if not authorization_header:
-        return { "status": "error", "message": "Missing Authorization header"}
-    api_key = frappe.get_request_header("Authorization").split(" ")[1].split(":")[0]
-    # Find the user associated with the API key
-    user = frappe.db.get_value("User", {"api_key": api_key}, "name")
-    
-    if not user:
-        return {"status": "failed", "message": "Invalid API key"}
+@api_key_auth
+def apply_mutations(mutations, user):
+    """
+    Replay actions queued by the app while offline, in order and in one transaction
+
+    Args:
+        mutations: List (or JSON list) of {"key": idempotency key, "operation": name, "args": {...},
+            "timestamp": device time of the action}, where operation is one of MUTATION_OPERATIONS
+            and args are that endpoint's arguments. Punches and visit starts are recorded at
+            `timestamp` (see `get_mutation_timestamp`), at the server time when it is not sent.
+
+    Every mutation gets the response its endpoint would have returned. A key that was
+    applied before returns the recorded response without running again. A failed
+    mutation is rolled back on its own and can be sent again with the same key.
+    """
+    if isinstance(mutations, str):
+        try:
+            mutations = json.loads(mutations)
+        except ValueError:
+            return {"status": "error", "message": "mutations must be a JSON list"}
+
+    if not isinstance(mutations, list) or not mutations:
+        return {"status": "error", "message": "mutations must be a non-empty list"}
+    if len(mutations) > MAX_MUTATIONS:
+        return {"status": "error", "message": f"At most {MAX_MUTATIONS} mutations per call"}
+
+    for mutation in mutations:
+        if not isinstance(mutation, dict) or not mutation.get("key") or len(str(mutation["key"])) > 140:
+            return {"status": "error", "message": "Every mutation needs a 'key' of at most 140 characters"}
+        if mutation.get("operation") not in MUTATION_OPERATIONS:
+            return {"status": "error", "message": f"Unknown operation '{mutation.get('operation')}'"}
+        if not isinstance(mutation.get("args") or {}, dict):
+            return {"status": "error", "message": "Mutation 'args' must be an object"}
+
+    applied = get_applied_mutations(user, [str(mutation["key"]) for mutation in mutations])
+    ledger = []
+    results = []
+    # after-commit callbacks (enqueue_after_commit jobs, after_commit realtime events) of the
+    # applied mutations; each mutation collects its own so a failed one's can be dropped
+    mutation_callbacks = []
+
+    frappe.flags.in_mutation_batch = True
+    try:
+        for index, mutation in enumerate(mutations):
+            key = str(mutation["key"])
+            if key in applied:
+                results.append({"key": key, "status": "duplicate", "response": applied[key]})
+                continue
+
+            try:
+                frappe.flags.mutation_timestamp = get_mutation_timestamp(mutation)
+            except ValueError as e:
+                results.append({"key": key, "status": "failed", "response": {"status": "error", "message": str(e)}})
+                continue
+
+            # the endpoint itself, without authenticating the request again
+            operation = inspect.unwrap(MUTATION_OPERATIONS[mutation["operation"]])
+            args = dict(mutation.get("args") or {}, user=user)
+
+            savepoint = f"mutation_{index}"
+            frappe.db.savepoint(savepoint)
+            message_count = len(frappe.local.message_log)
+            shared_callbacks, frappe.db.after_commit = frappe.db.after_commit, CallbackManager()
+            try:
+                response = operation(**args)
+            except Exception as e:
+                frappe.log_error(frappe.get_traceback(), "Apply Mutation Error")
+                response = {"status": "error", "message": str(e)}
+            finally:
+                frappe.flags.mutation_timestamp = None
+                callbacks, frappe.db.after_commit = frappe.db.after_commit, shared_callbacks
+
+            if str((response or {}).get("status")).lower() != "success":
+                frappe.db.rollback(save_point=savepoint)
+                # e.g. the message of a frappe.throw, already part of the response
+                del frappe.local.message_log[message_count:]
+                results.append({"key": key, "status": "failed", "response": response})
+                continue
+
+            applied[key] = response
+            mutation_callbacks.append(callbacks)
+            maintenance_visit = args.get("name") if mutation["operation"] == "start_maintenance_visit" else args.get("maintenance_visit")
+            ledger.append((key, mutation["operation"], maintenance_visit, response))
+            results.append({"key": key, "status": "applied", "response": response})
+
+        record_mutations(user, ledger)
+    finally:
+        frappe.flags.in_mutation_batch = False
+        frappe.flags.mutation_timestamp = None
+
+    frappe.db.commit()
+    for callbacks in mutation_callbacks:
+        callbacks.run()
+    return {"status": "success", "results": results}
+
+def get_mutation_timestamp(mutation):
+    """
+    Device time of a mutation as a naive datetime in the system timezone, None when not sent.
+
+    Raises ValueError when it cannot be parsed, is older than the idempotency ledger keeps
+    keys, or is ahead of the server clock by more than MUTATION_CLOCK_SKEW_SECONDS.
+    """
+    if not mutation.get("timestamp"):
+        return None
+
+    try:
+        timestamp = get_datetime(mutation["timestamp"])
+    except Exception:
+        raise ValueError(f"Invalid timestamp '{mutation['timestamp']}'")
+    if timestamp.tzinfo:
+        timestamp = timestamp.astimezone(ZoneInfo(get_system_timezone())).replace(tzinfo=None)
+
+    current_time = now_datetime()
+    if timestamp > current_time + timedelta(seconds=MUTATION_CLOCK_SKEW_SECONDS):
+        raise ValueError("Timestamp is in the future, check the device clock")
+    if timestamp < add_days(current_time, -MUTATION_LEDGER_RETENTION_DAYS):
+        raise ValueError(f"Timestamp is older than {MUTATION_LEDGER_RETENTION_DAYS} days")
+    return timestamp
+
+def get_applied_mutations(user, keys):
+    """Recorded responses of the keys `user` already applied"""
+    return {
+        row.idempotency_key: json.loads(row.response) if row.response else None
+        for row in frappe.get_all(
+            "Mobile Mutation",
+            filters={"technician": user, "idempotency_key": ["in", keys]},
+            fields=["idempotency_key", "response"]
+        )
+    }
+
+def record_mutations(user, ledger):
+    """Add applied mutations to the ledger, in the same transaction as their changes"""
+    if not ledger:
+        return
+
+    timestamp = now_datetime()
+    frappe.db.bulk_insert(
+        "Mobile Mutation",
+        ["name", "creation", "modified", "owner", "modified_by", "technician",
+         "idempotency_key", "operation", "maintenance_visit", "response"],
+        [
+            (frappe.generate_hash(length=10), timestamp, timestamp, user, user, user,
+             key, operation, maintenance_visit, frappe.as_json(response))
+            for key, operation, maintenance_visit, response in ledger
+        ]
+    )
+
+def delete_old_mutations():
+    """Scheduled job: forget idempotency keys older than MUTATION_LEDGER_RETENTION_DAYS"""
+    frappe.db.delete(
+        "Mobile Mutation",
+        {"creation": ["<", add_days(now_datetime(), -MUTATION_LEDGER_RETENTION_DAYS)]}
+    )
+    frappe.db.commit()
+
+@frappe.whitelist(allow_guest=True)
+@api_key_auth
+def add_symptom_requests(maintenance_visit, item_code, user, symptoms=None):
     # Get Maintenance Visit document
     maintenance = frappe.get_doc("Maintenance Visit", maintenance_visit)
     if not maintenance:
@@ -1085,42 +1625,10 @@ def add_symptom_requests(maintenance_visit, item_code, symptoms=None):
             image_field = f'symptoms[{idx}][image]'
             image_url = None
             if image_field in frappe.request.files:
-                uploaded_file = frappe.request.files[image_field]
-                file_content = uploaded_file.stream.read()
-
-                # Step 4: Get the file extension from the content
-                file_extension = imghdr.what(None, file_content)
-                if not file_extension:
-                    return {"status": "Failed", "message": "Invalid image format"}
-
-                # Step 5: Generate a unique filename using the random_string function from frappe.utils
-                unique_filename = random_string(10) + "." + file_extension
-
-                # Step 6: Define the path to save the file in the public folder
-                public_files_path = get_site_path("public", "files")
-                file_path = os.path.join(public_files_path, unique_filename)
-
-                # Step 7: Ensure the directory exists, create if not
-                if not os.path.exists(public_files_path):
-                    os.makedirs(public_files_path)
-
-                # Step 8: Save the file in the public folder
-                with open(file_path, "wb") as f:
-                    f.write(file_content)
-
-                # Step 9: Create a new record in the File Doctype
-                file_doc = frappe.get_doc({
-                    "doctype": "File",
-                    "file_name": unique_filename,
-                    "file_url": f"/files/{unique_filename}",
-                    "attached_to_doctype": "Maintenance Visit",
-                    "attached_to_name": maintenance_visit,
-                    "is_private": 0  # Make the file publicly accessible
-                })
-                file_doc.insert(ignore_permissions=True)
-
-                # Set the file URL
-                image_url = file_doc.file_url
+                try:
+                    image_url = save_uploaded_image(frappe.request.files[image_field], maintenance_visit)
+                except UploadError as e:
+                    return {"status": "Failed", "message": str(e)}
 
             # Create the symptom data to insert into the child table
             symptom_data = {
@@ -1162,16 +1670,8 @@ def add_symptom_requests(maintenance_visit, item_code, symptoms=None):
     return {"status": "success", "message": "Symptom requests added successfully."}
 
 @frappe.whitelist(allow_guest=True)
-def add_reschedule_requests(maintenance_visit, type, reason, date, hours):
-    authorization_header = frappe.get_request_header("Authorization")
-    if not authorization_header:
-        return { "status": "error", "message": "Missing Authorization header"}
-    api_key = frappe.get_request_header("Authorization").split(" ")[1].split(":")[0]
-    # Find the user associated with the API key
-    user = frappe.db.get_value("User", {"api_key": api_key}, "name")
-    
-    if not user:
-        return {"status": "failed", "message": "Invalid API key"}
+@api_key_auth
+def add_reschedule_requests(maintenance_visit, type, reason, date, hours, user):
     # Get Maintenance Visit document
     maintenance = frappe.get_doc("Maintenance Visit", maintenance_visit)
     if not maintenance:
@@ -1193,69 +1693,106 @@ def add_reschedule_requests(maintenance_visit, type, reason, date, hours):
     frappe.db.commit()
     return {"status": "success", "message": "Reschedule Request submitted successfully!"}
 
-@frappe.whitelist(allow_guest=True)
+@frappe.whitelist()
 def update_shipping_address():
-    # Get all rows with a valid delivery_document_no
-    records = frappe.get_all(
-        'Serial No',
-        filters={'delivery_document_no': ['is', 'set']},
-        fields=['name', 'delivery_document_no']
+    """
+    Queue `update_shipping_address_job`, which copies the shipping address of each Serial No's
+    Delivery Note onto the Serial No. Progress is published to the caller on the
+    `fsm_shipping_address_progress` realtime event.
+    """
+    frappe.only_for("System Manager")
+    frappe.enqueue(
+        "field_service_management.api.update_shipping_address_job",
+        queue="long",
+        timeout=60 * 60,
+        job_id="fsm_update_shipping_address",
+        deduplicate=True,
+        user=frappe.session.user,
     )
-    updated_count = 0
-    
-    for record in records:
-        # Fetch the shipping_address from Delivery Note
-        
-        shipping_address_name = frappe.db.get_value(
-            'Delivery Note',
-            record.delivery_document_no,
-            'shipping_address_name'
-        )
-        address = frappe.db.get_value(
-            "Address",
-            shipping_address_name,
-            ["address_line1", "address_line2", "ward_name", "district", "town", "province", "country", "phone", "fax"],
+    return {"message": "Shipping address update queued."}
+
+def update_shipping_address_job(user=None, chunk_size=None):
+    """
+    Background job of `update_shipping_address`. Serial Nos are read in chunks together with
+    their Delivery Note and Address, only rows whose address changed are written, and every
+    chunk is committed on its own (site config `fsm_shipping_address_chunk_size`, default 500).
+    Progress goes to `user`, who started the job.
+    """
+    chunk_size = int(chunk_size or frappe.conf.get("fsm_shipping_address_chunk_size") or SHIPPING_ADDRESS_CHUNK_SIZE)
+    # counted over the same joins as the chunks, so progress ends at `total`
+    total = frappe.db.sql(
+        f"SELECT COUNT(*) {SHIPPING_ADDRESS_SOURCE}",
+        {"last_name": ""}
+    )[0][0]
+    progress = {"total": total, "processed": 0, "updated": 0, "unchanged": 0}
+
+    last_name = ""
+    while True:
+        rows = frappe.db.sql(
+            f"""
+            SELECT
+                sn.name, sn.custom_item_current_installation_address AS current_address,
+                sn.custom_item_current_installation_address_name AS current_address_name,
+                dn.shipping_address_name, addr.address_line1, addr.address_line2, addr.ward_name,
+                addr.district, addr.town, addr.province, addr.country, addr.phone, addr.fax
+            {SHIPPING_ADDRESS_SOURCE}
+            ORDER BY sn.name
+            LIMIT %(limit)s
+            """,
+            {"last_name": last_name, "limit": chunk_size},
             as_dict=True
         )
+        if not rows:
+            break
+        last_name = rows[-1].name
 
-        if not address:
-            shipping_address = None
-        else:
-        # Construct the address in the desired format
-            address_string = f"{address['address_line1']}<br>"
-            
-            if address['address_line2']:
-                address_string += f"{address['address_line2']}<br>"
-            
-            if address['ward_name']:
-                address_string += f"{address['ward_name']}<br>"
-            
-            if address['district']:
-                address_string += f"{address['district']}<br>"
-            
-            address_string += f"{address['town']}<br>"
-            
-            if address['province']:
-                address_string += f"{address['province']}<br>"
-            
-            address_string += f"{address['country']}<br>"
-            
-            if address['phone']:
-                address_string += f"Phone: {address['phone']}<br>"
-            
-            if address['fax']:
-                address_string += f"Fax: {address['fax']}<br>"
-            
-            shipping_address = address_string
+        for row in rows:
+            shipping_address = format_shipping_address(row)
+            if (row.current_address, row.current_address_name) == (shipping_address, row.shipping_address_name):
+                progress["unchanged"] += 1
+                continue
+
+            frappe.db.set_value('Serial No', row.name, {
+                'custom_item_current_installation_address': shipping_address,
+                'custom_item_current_installation_address_name': row.shipping_address_name
+            })
+            progress["updated"] += 1
+
+        frappe.db.commit()
+        progress["processed"] += len(rows)
+        frappe.publish_realtime("fsm_shipping_address_progress", progress, user=user)
+
+    progress["done"] = True
+    frappe.publish_realtime("fsm_shipping_address_progress", progress, user=user)
+    return progress
+
+def format_shipping_address(address):
+    """Address as the HTML block stored on Serial No"""
+    address_string = f"{address['address_line1']}<br>"
     
-        if shipping_address:
-            # Update the shipping_address field in your Doctype
-            frappe.db.set_value('Serial No', record.name, 'custom_item_current_installation_address', shipping_address)
-            frappe.db.set_value('Serial No', record.name, 'custom_item_current_installation_address_name', shipping_address_name)
-            frappe.db.commit()
-            updated_count += 1
+    if address['address_line2']:
+        address_string += f"{address['address_line2']}<br>"
+    
+    if address['ward_name']:
+        address_string += f"{address['ward_name']}<br>"
+    
+    if address['district']:
+        address_string += f"{address['district']}<br>"
+    
+    address_string += f"{address['town']}<br>"
+    
+    if address['province']:
+        address_string += f"{address['province']}<br>"
+    
+    address_string += f"{address['country']}<br>"
+    
+    if address['phone']:
+        address_string += f"Phone: {address['phone']}<br>"
+    
+    if address['fax']:
+        address_string += f"Fax: {address['fax']}<br>"
     
-    return {"message": f"{updated_count} rows updated successfully."}
+    return address_string
 
 @frappe.whitelist(allow_guest=True)
 def populate_initial_serial_card_history():
@@ -0,0 +1,199 @@
+import time
+from collections import OrderedDict
+from functools import wraps
+
+import frappe
+import jwt
+from frappe.utils.password import get_encryption_key
+
+
+API_KEY_USER_CACHE_KEY = "fsm:api_key_user"
+LOCAL_CACHE_TTL = 30
+LOCAL_CACHE_SIZE = 1024
+
+ACCESS_TOKEN_TTL = 15 * 60
+REFRESH_TOKEN_TTL = 30 * 24 * 60 * 60
+TOKEN_ALGORITHM = "HS256"
+REVOKED_TOKEN_CACHE_KEY = "fsm:revoked_token:"
+REVOKED_USER_CACHE_KEY = "fsm:tokens_revoked_before:"
+
+# In-process LRU in front of Redis: (site, api_key) -> (user, expires_at).
+# Other workers drop their copy after LOCAL_CACHE_TTL seconds, Redis and the
+# current process are invalidated immediately by `clear_api_key_cache`.
+_local_api_key_users = OrderedDict()
+
+
+def api_key_auth(fn):
+    """
+    Authenticate a mobile endpoint from the Authorization header and pass the
+    resolved user as `user`. Accepts either a signed access token issued by
+    `login` ("Bearer <token>", verified without a database query, see
+    `validate_bearer_token`) or an API key ("token <api_key>:<api_secret>").
+
+    Goes below `frappe.whitelist`:
+
+        @frappe.whitelist(allow_guest=True)
+        @api_key_auth
+        def endpoint(arg, user):
+    """
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        authorization_header = frappe.get_request_header("Authorization")
+        if not authorization_header:
+            return {"status": "error", "message": "Missing Authorization header"}
+
+        if authorization_header.startswith("Bearer "):
+            claims = get_request_token_claims(authorization_header[len("Bearer "):])
+            if not claims:
+                return {"status": "failed", "message": "Invalid or expired token"}
+            user = claims["sub"]
+        else:
+            user = get_user_for_api_key(get_api_key(authorization_header))
+            if not user:
+                return {"status": "failed", "message": "Invalid API key"}
+
+        kwargs["user"] = user
+        return frappe.call(fn, *args, **kwargs)
+
+    return wrapper
+
+
+def validate_bearer_token():
+    """
+    auth_hooks entry: log the request in as the subject of a valid access token from `login`.
+
+    Frappe reads "Bearer" headers as OAuth tokens and rejects the request when no auth hook
+    sets a user, so the token must be accepted here for `api_key_auth` to see it.
+    """
+    authorization_header = frappe.get_request_header("Authorization") or ""
+    if not authorization_header.startswith("Bearer ") or frappe.session.user not in ("", "Guest"):
+        return
+
+    claims = get_request_token_claims(authorization_header[len("Bearer "):])
+    if claims:
+        frappe.set_user(claims["sub"])
+
+
+def get_request_token_claims(token):
+    """`decode_token` memoized for the current request, shared by the auth hook and `api_key_auth`"""
+    cached = getattr(frappe.local, "fsm_token_claims", None)
+    if cached and cached[0] == token:
+        return cached[1]
+
+    claims = decode_token(token)
+    frappe.local.fsm_token_claims = (token, claims)
+    return claims
+
+
+def get_api_key(authorization_header):
+    try:
+        return authorization_header.split(" ")[1].split(":")[0]
+    except IndexError:
+        return None
+
+
+def get_user_for_api_key(api_key):
+    """Resolve an API key to an enabled user, through the local LRU, then Redis, then the database"""
+    if not api_key:
+        return None
+
+    local_key = (frappe.local.site, api_key)
+    cached = _local_api_key_users.get(local_key)
+    if cached and cached[1] > time.monotonic():
+        _local_api_key_users.move_to_end(local_key)
+        return cached[0]
+
+    user = frappe.cache().hget(API_KEY_USER_CACHE_KEY, api_key)
+    if not user:
+        user = frappe.db.get_value("User", {"api_key": api_key, "enabled": 1}, "name")
+        # unknown keys are not cached, so random keys cannot grow the cache
+        if not user:
+            return None
+        frappe.cache().hset(API_KEY_USER_CACHE_KEY, api_key, user)
+
+    _local_api_key_users[local_key] = (user, time.monotonic() + LOCAL_CACHE_TTL)
+    _local_api_key_users.move_to_end(local_key)
+    while len(_local_api_key_users) > LOCAL_CACHE_SIZE:
+        _local_api_key_users.popitem(last=False)
+
+    return user
+
+
+def clear_api_key_cache(doc, method=None):
+    """User doc event: drop cached keys when the API key changes or the user is disabled or deleted"""
+    api_keys = {doc.api_key}
+    previous = doc.get_doc_before_save()
+    if previous:
+        if previous.api_key == doc.api_key and previous.enabled == doc.enabled and method != "on_trash":
+            return
+        api_keys.add(previous.api_key)
+
+    if method == "on_trash" or not doc.enabled:
+        revoke_user_tokens(doc.name)
+
+    for api_key in filter(None, api_keys):
+        frappe.cache().hdel(API_KEY_USER_CACHE_KEY, api_key)
+        _local_api_key_users.pop((frappe.local.site, api_key), None)
+
+
+def get_token_secret():
+    return frappe.conf.get("fsm_token_secret") or get_encryption_key()
+
+
+def issue_tokens(user):
+    """Signed access and refresh tokens for `user`; the access token carries the user's roles"""
+    return {
+        "access_token": encode_token(user, "access", ACCESS_TOKEN_TTL, roles=frappe.get_roles(user)),
+        "refresh_token": encode_token(user, "refresh", REFRESH_TOKEN_TTL),
+        "token_type": "Bearer",
+        "expires_in": ACCESS_TOKEN_TTL,
+    }
+
+
+def encode_token(user, token_type, ttl, **claims):
+    issued_at = int(time.time())
+    payload = {
+        "sub": user,
+        "type": token_type,
+        "jti": frappe.generate_hash(length=20),
+        "iat": issued_at,
+        "exp": issued_at + ttl,
+        **claims,
+    }
+    return jwt.encode(payload, get_token_secret(), algorithm=TOKEN_ALGORITHM)
+
+
+def decode_token(token, token_type="access"):
+    """Claims of a valid, unrevoked token of the given type, otherwise None"""
+    try:
+        claims = jwt.decode(token, get_token_secret(), algorithms=[TOKEN_ALGORITHM])
+    except jwt.InvalidTokenError:
+        return None
+
+    if claims.get("type") != token_type or is_token_revoked(claims):
+        return None
+    return claims
+
+
+def is_token_revoked(claims):
+    if frappe.cache().get_value(REVOKED_TOKEN_CACHE_KEY + claims["jti"]):
+        return True
+    revoked_before = frappe.cache().get_value(REVOKED_USER_CACHE_KEY + claims["sub"])
+    return bool(revoked_before) and claims["iat"] <= revoked_before
+
+
+def revoke_token(claims):
+    """Deny-list a single token until it would have expired anyway"""
+    frappe.cache().set_value(
+        REVOKED_TOKEN_CACHE_KEY + claims["jti"],
+        1,
+        expires_in_sec=max(int(claims["exp"] - time.time()), 1),
+    )
+
+
+def revoke_user_tokens(user):
+    """Reject every token issued to `user` up to now"""
+    frappe.cache().set_value(
+        REVOKED_USER_CACHE_KEY + user, int(time.time()), expires_in_sec=REFRESH_TOKEN_TTL
+    )
@@ -1,6 +1,8 @@
 
 import frappe
-import re
+import json
+
+from field_service_management.time_ledger import get_invoice_hours_by_employee
 
 
 @frappe.whitelist(allow_guest=True)
@@ -240,48 +242,27 @@ def get_customer_addresses(customer):
 
 @frappe.whitelist(allow_guest=True)
 def get_punch_data(employee_email, start_date, end_date):
-    query = """
-        SELECT travel_time, working_hours
+    # summed in the database over the integer second columns, (technician, punch_in) is indexed
+    total_travel_seconds, total_working_seconds = frappe.db.sql("""
+        SELECT COALESCE(SUM(custom_travel_seconds), 0), COALESCE(SUM(custom_working_seconds), 0)
         FROM `tabPunch In Punch Out`
         WHERE technician = %s
         AND punch_in >= %s
         AND punch_in <= %s
-    """
-    records = frappe.db.sql(query, (employee_email, start_date, end_date), as_dict=True)
-
-
-    total_travel_minutes = 0
-    total_working_minutes = 0
-
-    for record in records:
-        # Convert travel time to total minutes
-        total_travel_minutes += time_to_minutes(record.get("travel_time", "0h 0m"))
-
-        # Convert working hours to total minutes
-        total_working_minutes += time_to_minutes(record.get("working_hours", "0h 0m"))
+    """, (employee_email, start_date, end_date))[0]
 
     # Convert back to "Xh Ym" format
-    total_travel_time = minutes_to_time(total_travel_minutes)
-    total_working_hours = minutes_to_time(total_working_minutes)
+    total_travel_time = minutes_to_time(int(total_travel_seconds) // 60)
+    total_working_hours = minutes_to_time(int(total_working_seconds) // 60)
 
     return {
         "total_travel_time": total_travel_time,
-        "total_working_hours": total_working_hours
+        "total_working_hours": total_working_hours,
+        "total_travel_seconds": int(total_travel_seconds),
+        "total_working_seconds": int(total_working_seconds)
     }
 
 
-def time_to_minutes(time_str):
-    """ Convert 'Xh Ym' format to total minutes """
-    if not time_str:
-        return 0
-    match = re.match(r"(?:(\d+)h)?\s*(?:(\d+)m)?", time_str)
-    if not match:
-        return 0
-    hours = int(match.group(1) or 0)
-    minutes = int(match.group(2) or 0)
-    return hours * 60 + minutes
-
-
 def minutes_to_time(total_minutes):
     """ Convert total minutes back to 'Xh Ym' format """
     hours = total_minutes // 60
@@ -290,34 +271,21 @@ def minutes_to_time(total_minutes):
 
 @frappe.whitelist(allow_guest=True)
 def get_invoice_hours(employee, start_date, end_date):
-    total_hours = 0
-    delivery_notes = frappe.db.sql("""
-        SELECT name, total_qty, posting_date
-        FROM `tabDelivery Note`
-        WHERE posting_date >= %s AND  posting_date <= %s
-    """, (start_date, end_date), as_dict=True)
-    
-    valid_delivery_notes = []
-
-    for dn in delivery_notes:
-        # Get employee contributions for the current delivery note
-        employee_contributions = frappe.db.sql("""
-            SELECT employee 
-            FROM `tabEmployee Contribution`
-            WHERE parent = %s
-        """, (dn.name,), as_dict=True)
-
-
-        employee_list = [e["employee"] for e in employee_contributions]
+    # each Delivery Note counts for total_qty / number of contributors, summed in one query
+    hours = get_invoice_hours_by_employee(start_date, end_date, [employee])
+    return {
+        "total_invoice_hours": hours.get(employee, 0)
+    }
 
-        if employee in employee_list:
-            total_hours += dn.total_qty/len(employee_list)
-            valid_delivery_notes.append({
-                "delivery_note": dn.name,
-                "total_employees": len(employee_list)
-            })
+@frappe.whitelist()
+def get_team_invoice_hours(employees, start_date, end_date):
+    """Invoice hours of several employees (JSON list, all contributors if empty) in one pass, for payroll"""
+    frappe.only_for(("HR Manager", "System Manager"))
+    if isinstance(employees, str):
+        employees = json.loads(employees or "[]")
+    hours = get_invoice_hours_by_employee(start_date, end_date, employees)
     return {
-        "total_invoice_hours": total_hours
+        "invoice_hours": {employee: hours.get(employee, 0) for employee in employees} if employees else hours
     }
 
 @frappe.whitelist(allow_guest=True)
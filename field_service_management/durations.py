@@ -0,0 +1,49 @@
+import re
+
+
+PUNCH_DURATION_FIELDS = (
+    ("travel_time", "custom_travel_seconds"),
+    ("working_hours", "custom_working_seconds"),
+)
+
+DURATION_PATTERN = re.compile(r"^\s*(?:(\d+)\s*h)?\s*(?:(\d+)\s*m)?\s*$")
+
+
+def get_duration_seconds(start_time, end_time):
+    """Whole seconds between two datetimes, 0 if either is missing"""
+    if not start_time or not end_time:
+        return 0
+    return max(int((end_time - start_time).total_seconds()), 0)
+
+
+def format_duration(seconds):
+    """Seconds as the "Xh Ym" text shown by the app and the desk"""
+    seconds = int(seconds or 0)
+    return f"{seconds // 3600}h {seconds % 3600 // 60}m"
+
+
+def parse_duration(text):
+    """Seconds of an "Xh Ym" / "Ym" text, 0 for empty or unreadable values"""
+    match = DURATION_PATTERN.match(text or "")
+    if not match:
+        return 0
+    hours, minutes = match.groups()
+    return int(hours or 0) * 3600 + int(minutes or 0) * 60
+
+
+def set_punch_duration_seconds(doc, method=None):
+    """
+    Keep the integer second columns of Punch In Punch Out rows in line with their
+    "Xh Ym" text, for rows written from the desk. Exact values set by the API are
+    kept as long as they round to the same text.
+    """
+    if doc.doctype == "Maintenance Visit":
+        rows = doc.get("punch_in_punch_out") or []
+    else:
+        rows = [doc]
+
+    for row in rows:
+        for text_field, seconds_field in PUNCH_DURATION_FIELDS:
+            seconds = parse_duration(row.get(text_field))
+            if seconds != int(row.get(seconds_field) or 0) // 60 * 60:
+                setattr(row, seconds_field, seconds)
@@ -0,0 +1,8 @@
+// Copyright (c) 2024, Aayush Patidar and contributors
+// For license information, please see license.txt
+
+frappe.ui.form.on('Live Location Archive', {
+	// refresh: function(frm) {
+
+	// }
+});
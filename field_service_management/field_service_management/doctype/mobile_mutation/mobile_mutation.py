@@ -0,0 +1,12 @@
+# Copyright (c) 2024, Aayush Patidar and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+class MobileMutation(Document):
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_unique("Mobile Mutation", ["technician", "idempotency_key"], constraint_name="unique_technician_key")
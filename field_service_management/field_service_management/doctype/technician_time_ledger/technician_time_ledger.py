@@ -0,0 +1,12 @@
+# Copyright (c) 2024, Aayush Patidar and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.model.document import Document
+
+class TechnicianTimeLedger(Document):
+	pass
+
+
+def on_doctype_update():
+	frappe.db.add_index("Technician Time Ledger", ["date", "technician"])
@@ -0,0 +1,19 @@
+# Copyright (c) 2024, Aayush Patidar and Contributors
+# See license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from field_service_management.time_ledger import get_ledger_name, get_time_summary, upsert_ledger_rows
+
+
+class TestTechnicianTimeLedger(FrappeTestCase):
+	def test_upsert_overwrites_the_day(self):
+		key = ("Administrator", "2001-01-01")
+		row = {"scheduled_seconds": 3600, "travel_seconds": 600, "working_seconds": 1800, "invoiced_hours": 1.5}
+		upsert_ledger_rows({key: row})
+		upsert_ledger_rows({key: dict(row, working_seconds=2700)})
+
+		self.assertEqual(frappe.db.count("Technician Time Ledger", {"name": get_ledger_name(*key)}), 1)
+		summary = get_time_summary("2001-01-01", "2001-01-31", ["Administrator"])
+		self.assertEqual(int(summary[0].working_seconds), 2700)
@@ -1,199 +1,55 @@
 import frappe
 import json
-from frappe.contacts.doctype.address.address import get_address_display
-
-
-MAINTENANCE_VISITS_CACHE_KEY = "fsm:map_maintenance_visits:v1"
-MAINTENANCE_VISITS_CACHE_TTL = 60
+from field_service_management.location import (
+    MAINTENANCE_VISITS_CACHE_KEY,
+    MAINTENANCE_VISITS_VERSION_KEY,
+    compact_live_location_history,
+    get_live_location_queue_stats,
+    get_maintenance_visit_grid,
+    get_maintenance_visits,
+    get_technician_track as _get_technician_track,
+    get_technician_positions,
+)
+from field_service_management.time_ledger import get_time_summary
 
 
 @frappe.whitelist()
 def get_technicians():
-    query = """
-    SELECT ll.technician, ll.latitude, ll.longitude, ll.time, ll.employee_name AS technician_name
-    FROM `tabLive Location` ll
-    JOIN (
-        SELECT technician, MAX(time) AS latest_time
-        FROM `tabLive Location`
-        GROUP BY technician
-    ) latest
-        ON latest.technician = ll.technician
-        AND latest.latest_time = ll.time
-    JOIN `tabUser` u
-        ON u.name = ll.technician
-    WHERE u.enabled = 1
-    """
-    technicians = frappe.db.sql(query, as_dict=True)
-
-    return technicians
-
-
-@frappe.whitelist()
-def get_cords():
-    return get_technicians()
-
-
-def _parse_geolocation(address_name, geolocation):
-    if not geolocation:
-        return None
-
-    if isinstance(geolocation, dict):
-        return geolocation
+    positions = get_technician_positions()
+    if not positions:
+        return []
 
-    if not isinstance(geolocation, str):
-        frappe.log_error(
-            f"Unexpected geolocation format for address: {address_name}",
-            "Field Service Management",
-        )
-        return None
-
-    try:
-        return json.loads(geolocation)
-    except json.JSONDecodeError:
-        frappe.log_error(
-            f"Invalid geolocation data for address: {address_name}",
-            "Field Service Management",
+    enabled_users = set(
+        frappe.get_all(
+            "User",
+            filters={
+                "name": ["in", [position["technician"] for position in positions]],
+                "enabled": 1,
+            },
+            pluck="name",
         )
-        return None
-
-
-def _get_cached_maintenance_visits():
-    cached = frappe.cache().get_value(MAINTENANCE_VISITS_CACHE_KEY)
-    if not cached:
-        return None
-
-    if isinstance(cached, str):
-        try:
-            return json.loads(cached)
-        except json.JSONDecodeError:
-            frappe.cache().delete_value(MAINTENANCE_VISITS_CACHE_KEY)
-            return None
-
-    return cached
-
-
-def _set_cached_maintenance_visits(maintenance_visits):
-    frappe.cache().set_value(
-        MAINTENANCE_VISITS_CACHE_KEY,
-        json.dumps(maintenance_visits),
-        expires_in_sec=MAINTENANCE_VISITS_CACHE_TTL,
     )
+    return [position for position in positions if position["technician"] in enabled_users]
 
 
-def get_maintenance_visits(use_cache=True):
-    if use_cache:
-        cached = _get_cached_maintenance_visits()
-        if cached is not None:
-            return cached
-
-    maintenance_records = frappe.db.sql(
-        """
-        SELECT name, delivery_addres, customer, maintenance_type, completion_status
-        FROM `tabMaintenance Visit`
-        WHERE completion_status != 'Fully Completed'
-            AND docstatus != 2
-    """,
-        as_dict=True,
-    )
-
-    if not maintenance_records:
-        return []
+@frappe.whitelist()
+def get_cords():
+    return get_technicians()
 
-    delivery_addresses = {
-        visit.delivery_addres for visit in maintenance_records if visit.delivery_addres
-    }
-    customers = {visit.customer for visit in maintenance_records if visit.customer}
 
-    serial_address_by_delivery_address = {}
-    if delivery_addresses:
-        serial_rows = frappe.get_all(
-            "Serial No",
-            filters={
-                "custom_item_current_installation_address": [
-                    "in",
-                    list(delivery_addresses),
-                ]
-            },
-            fields=[
-                "custom_item_current_installation_address",
-                "custom_item_current_installation_address_name",
-            ],
-        )
-        serial_address_by_delivery_address = {
-            row.custom_item_current_installation_address: row.custom_item_current_installation_address_name
-            for row in serial_rows
-            if row.custom_item_current_installation_address
-            and row.custom_item_current_installation_address_name
-        }
-
-    customer_address_names = {}
-    if customers:
-        dynamic_links = frappe.get_all(
-            "Dynamic Link",
-            filters={
-                "link_doctype": "Customer",
-                "link_name": ["in", list(customers)],
-                "parenttype": "Address",
-            },
-            fields=["parent", "link_name"],
-        )
-        for link in dynamic_links:
-            customer_address_names.setdefault(link.link_name, []).append(link.parent)
-
-    address_names = set(serial_address_by_delivery_address.values())
-    for names in customer_address_names.values():
-        address_names.update(names)
-
-    addresses_by_name = {}
-    if address_names:
-        address_rows = frappe.get_all(
-            "Address",
-            filters={"name": ["in", list(address_names)]},
-            fields=["name", "geolocation"],
-        )
-        addresses_by_name = {row.name: row for row in address_rows}
-
-    display_by_address_name = {}
-    unresolved_visits = [
-        visit
-        for visit in maintenance_records
-        if not serial_address_by_delivery_address.get(visit.delivery_addres)
-        and visit.delivery_addres
-        and visit.customer
-    ]
-    for visit in unresolved_visits:
-        for address_name in customer_address_names.get(visit.customer, []):
-            if address_name not in display_by_address_name:
-                display_by_address_name[address_name] = get_address_display(
-                    address_name
-                )
-            if display_by_address_name[address_name] == visit.delivery_addres:
-                serial_address_by_delivery_address[visit.delivery_addres] = address_name
-                break
-
-    maintenance_visits = []
-    for visit in maintenance_records:
-        address_name = serial_address_by_delivery_address.get(visit.delivery_addres)
-        geolocation = None
-        if address_name and address_name in addresses_by_name:
-            address = addresses_by_name[address_name]
-            geolocation = _parse_geolocation(address.name, address.geolocation)
-
-        maintenance_visits.append(
-            {
-                "visit_id": visit.name,
-                "geolocation": geolocation,
-                "address": visit.delivery_addres,
-                "customer": visit.customer,
-                "type": visit.maintenance_type,
-                "status": visit.completion_status,
-            }
-        )
+@frappe.whitelist()
+def get_technician_track(technician, from_time, to_time, tolerance=10):
+    """Simplified route of a technician for map playback, see `location.get_technician_track`"""
+    return _get_technician_track(technician, from_time, to_time, tolerance)
 
-    if use_cache:
-        _set_cached_maintenance_visits(maintenance_visits)
 
-    return maintenance_visits
+@frappe.whitelist()
+def get_technician_time_summary(from_date, to_date, technicians=None):
+    """Scheduled, travel, working (seconds) and invoiced hours per technician, from Technician Time Ledger"""
+    frappe.only_for("System Manager")
+    if isinstance(technicians, str):
+        technicians = json.loads(technicians)
+    return get_time_summary(from_date, to_date, technicians)
 
 
 @frappe.whitelist()
@@ -216,4 +72,34 @@ def get_map_maintenance_visits():
 @frappe.whitelist()
 def clear_map_maintenance_visits_cache():
     frappe.cache().delete_value(MAINTENANCE_VISITS_CACHE_KEY)
+    frappe.cache().delete_value(MAINTENANCE_VISITS_VERSION_KEY)
     return {"success": True}
+
+
+@frappe.whitelist()
+def nearest_open_visits(lat, lon, k=10, radius=5000):
+    """Open maintenance visits closest to a point, `radius` in meters"""
+    nearest = get_maintenance_visit_grid().nearest(
+        float(lat), float(lon), k=int(k), radius=float(radius) if radius else None
+    )
+    return [{**visit, "distance": round(distance, 2)} for visit, distance in nearest]
+
+
+@frappe.whitelist()
+def open_visits_in_bbox(min_lat, min_lon, max_lat, max_lon):
+    return get_maintenance_visit_grid().bbox(
+        float(min_lat), float(min_lon), float(max_lat), float(max_lon)
+    )
+
+
+@frappe.whitelist()
+def get_live_location_queue_status():
+    frappe.only_for("System Manager")
+    return get_live_location_queue_stats()
+
+
+@frappe.whitelist()
+def get_live_location_compaction_report():
+    """Dry run of the nightly Live Location retention job"""
+    frappe.only_for("System Manager")
+    return compact_live_location_history(dry_run=True)
@@ -5,6 +5,9 @@ from datetime import datetime
 from datetime import timedelta
 from frappe.contacts.doctype.address.address import get_address_display
 
+from field_service_management.time_ledger import get_utilization
+from field_service_management.uploads import add_thumbnail_urls
+
 
 @frappe.whitelist()
 def get_context(context=None):
@@ -130,6 +133,7 @@ def get_context(context=None):
             filters = {"parent": issue.name},
             fields = ['item_code', 'item_name', 'custom_image']
         )
+        add_thumbnail_urls(products, "custom_image")
         issue.products = products
 
         # Spare Items -------------------------------------------------------------
@@ -146,6 +150,7 @@ def get_context(context=None):
             filters = {"parent": issue.name},
             fields = ['item_code', 'symptom_code', 'resolution', 'image']
         )
+        add_thumbnail_urls(symptoms)
         symptoms_res = {}
         html_content = ""
         for symptom in symptoms:
@@ -158,7 +163,7 @@ def get_context(context=None):
             if resolutions:
                 html_content += f"<p><strong>{item_code}:</strong></p>"
                 for resolution in resolutions:
-                    html_content += f"<p>&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;<img src='{resolution.image}' style='max-width: 100px;'> --> <strong>{resolution.symptom_code}</strong> --> {resolution.resolution}<br>"
+                    html_content += f"<p>&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;<a href='{resolution.image}' target='_blank'><img src='{resolution.image_thumbnail}' style='max-width: 100px;'></a> --> <strong>{resolution.symptom_code}</strong> --> {resolution.resolution}<br>"
                 html_content += "</p>"
         issue.symptoms_res = html_content
 
@@ -185,6 +190,9 @@ def get_context(context=None):
         {"label": "07", "time": timedelta(hours=19)},
         {"label": "08", "time": timedelta(hours=20)},
     ]
+
+    # scheduled hours against the 77 working hours of the board, from Technician Time Ledger
+    utilization = get_utilization([tech.email for tech in technicians], min(dates), max(dates), 77)
     for tech in technicians:
         html_content = ""
         tasks = frappe.get_all(
@@ -199,7 +207,6 @@ def get_context(context=None):
             task.duration_in_hours = time_diff.total_seconds() / 3600
             task.flag = 0
             tasks_by_date[task.date].append(task)
-        total_hours = 0
         for date in dates:
             tss = tasks_by_date[date]
             
@@ -278,7 +285,6 @@ def get_context(context=None):
                                 task.flag = 1  # Mark as displayed
                                 break
                     if task_in_slot:
-                        total_hours += task_in_slot['duration_in_hours']
                         html_content += f"""
                         <div style="width: {task_in_slot['duration_in_hours'] * 25}px; background-color: red; border-right: 1px solid #000;" class="px-1 py-2 text-white text-center drag" data-type="type2" draggable="true" id="task-{task_in_slot['issue_code']}" data-duration="{task_in_slot['duration_in_hours']}">
                             <a href="javascript:void(0)"
@@ -339,8 +345,7 @@ def get_context(context=None):
                         else:
                             count -= 1
             tech.html_content = html_content
-            percent_occupied = round((total_hours) / 77 * 100, 2)
-            tech.total_hours = percent_occupied
+            tech.total_hours = utilization.get(tech.email, 0)
 
     context["dates"] = dates
     context["technicians"] = technicians    
@@ -5,6 +5,9 @@ from datetime import datetime
 from datetime import timedelta
 from frappe.contacts.doctype.address.address import get_address_display
 
+from field_service_management.time_ledger import get_utilization
+from field_service_management.uploads import add_thumbnail_urls
+
 
 
 
@@ -105,6 +108,7 @@ def get_context(context=None):
            "Maintenance Visit Purpose", filters={"parent": issue.name},
            fields=['item_code', 'item_name', 'custom_image']
        )
+       add_thumbnail_urls(issue.products, "custom_image")
        issue.spare_items = frappe.get_all(
            "Spare Part", filters={"parent": issue.name},
            fields=['item_code', 'description', 'periodicity', 'uom']
@@ -115,6 +119,7 @@ def get_context(context=None):
            "Maintenance Visit Symptoms", filters={"parent": issue.name},
            fields=['item_code', 'symptom_code', 'resolution', 'image']
        )
+       add_thumbnail_urls(symptoms)
        symptoms_res = {}
        for symptom in symptoms:
            symptoms_res.setdefault(symptom.item_code, []).append(symptom)
@@ -124,7 +129,7 @@ def get_context(context=None):
                html_content += f"<p><strong>{item_code}:</strong></p>"
                for resolution in resolutions:
                    html_content += (f"<p>&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;"
-                                     f"<img src='{resolution.image}' style='max-width: 100px;'> --> "
+                                     f"<a href='{resolution.image}' target='_blank'><img src='{resolution.image_thumbnail}' style='max-width: 100px;'></a> --> "
                                      f"<strong>{resolution.symptom_code}</strong> --> {resolution.resolution}<br>")
                html_content += "</p>"
        issue.symptoms_res = html_content
@@ -178,6 +183,8 @@ def get_context(context=None):
    LUNCH_END = timedelta(hours=13)
 
 
+   # scheduled hours against the 77 working hours of the board, from Technician Time Ledger
+   utilization = get_utilization([tech.email for tech in technicians], dates[0], dates[-1], 77)
    for tech in technicians:
        html_content = ""
        tasks = frappe.get_all(
@@ -194,7 +201,6 @@ def get_context(context=None):
            tasks_by_date[task.date].append(task)
 
 
-       total_hours = 0
 
 
        for date in dates:
@@ -301,7 +307,6 @@ def get_context(context=None):
 
                if task_in_slot:
                    maintenance = get_maintenance_doc(task_in_slot['issue_code'])
-                   total_hours += task_in_slot['duration_in_hours']
                    html_content += f"""
                    <div style="width: {task_in_slot['duration_in_hours'] * 25}px; background-color: #ef4444; border-right: 1px solid #000; border-radius: 4px; box-shadow: 0 1px 2px rgba(0,0,0,0.25); overflow: hidden;" class="px-1 py-2 text-white text-center drag" data-type="type2" draggable="true" id="task-{task_in_slot['issue_code']}" data-duration="{task_in_slot['duration_in_hours']}" title="{task_in_slot['issue_code']}">
                        <a href="javascript:void(0)"
@@ -362,7 +367,7 @@ def get_context(context=None):
 
 
        tech.html_content = html_content
-       tech.total_hours = round(total_hours / 77 * 100, 2)
+       tech.total_hours = utilization.get(tech.email, 0)
 
 
    context["dates"] = dates
@@ -5,6 +5,9 @@ from datetime import datetime
 from datetime import timedelta
 from frappe.contacts.doctype.address.address import get_address_display
 
+from field_service_management.time_ledger import get_utilization
+from field_service_management.uploads import add_thumbnail_urls
+
 
 @frappe.whitelist()
 def get_context(context=None):
@@ -118,6 +121,7 @@ def get_context(context=None):
           "Maintenance Visit Purpose", filters={"parent": issue.name},
           fields=['item_code', 'item_name', 'custom_image']
       )
+      add_thumbnail_urls(issue.products, "custom_image")
       issue.spare_items = frappe.get_all(
           "Spare Part", filters={"parent": issue.name},
           fields=['item_code', 'description', 'periodicity', 'uom']
@@ -128,6 +132,7 @@ def get_context(context=None):
           "Maintenance Visit Symptoms", filters={"parent": issue.name},
           fields=['item_code', 'symptom_code', 'resolution', 'image']
       )
+      add_thumbnail_urls(symptoms)
       symptoms_res = {}
       for symptom in symptoms:
           symptoms_res.setdefault(symptom.item_code, []).append(symptom)
@@ -137,7 +142,7 @@ def get_context(context=None):
               html_content += f"<p><strong>{item_code}:</strong></p>"
               for resolution in resolutions:
                   html_content += (f"<p>&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;"
-                                    f"<img src='{resolution.image}' style='max-width: 100px;'> --> "
+                                    f"<a href='{resolution.image}' target='_blank'><img src='{resolution.image_thumbnail}' style='max-width: 100px;'></a> --> "
                                     f"<strong>{resolution.symptom_code}</strong> --> {resolution.resolution}<br>")
               html_content += "</p>"
       issue.symptoms_res = html_content
@@ -189,6 +194,8 @@ def get_context(context=None):
   LUNCH_END = timedelta(hours=13)
 
 
+  # scheduled hours against the 11 working hours of the board, from Technician Time Ledger
+  utilization = get_utilization([tech.email for tech in technicians], date, date, 11)
   for tech in technicians:
       html_content = ""
       tasks = frappe.get_all(
@@ -204,7 +211,6 @@ def get_context(context=None):
       tech.tasks = tasks
 
 
-      total_hours = 0
 
 
       employee = frappe.db.get_value("Employee", {"prefered_email": tech.email}, "employee")
@@ -303,7 +309,6 @@ def get_context(context=None):
 
           if task_in_slot:
               maintenance = get_maintenance_doc(task_in_slot['issue_code'])
-              total_hours += task_in_slot['duration_in_hours']
               html_content += f"""
               <div style="width: {task_in_slot['duration_in_hours'] * 2 * slot_width_percent}%; background-color: #ef4444; border-right: 1px solid #fff; border-radius: 4px; overflow: hidden;" class="px-1 py-2 text-white text-center drag" data-type="type2" draggable="true" id="task-{task_in_slot['issue_code']}" data-duration="{task_in_slot['duration_in_hours']}" title="{task_in_slot['issue_code']}">
                   <a href="javascript:void(0)"
@@ -364,7 +369,7 @@ def get_context(context=None):
 
 
       tech.html_content = html_content
-      tech.total_hours = round(total_hours / 11 * 100, 2)
+      tech.total_hours = utilization.get(tech.email, 0)
 
 
   context["technicians"] = technicians
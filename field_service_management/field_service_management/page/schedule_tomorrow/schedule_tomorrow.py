@@ -4,6 +4,9 @@ import json
 from datetime import datetime
 from datetime import timedelta
 
+from field_service_management.time_ledger import get_utilization
+from field_service_management.uploads import add_thumbnail_urls
+
 
 
 
@@ -133,6 +136,7 @@ def get_context(context=None):
            filters = {"parent": issue.name},
            fields = ['item_code', 'item_name', 'custom_image']
        )
+       add_thumbnail_urls(products, "custom_image")
        issue.products = products
 
 
@@ -151,6 +155,7 @@ def get_context(context=None):
            filters = {"parent": issue.name},
            fields = ['item_code', 'symptom_code', 'resolution', 'image']
        )
+       add_thumbnail_urls(symptoms)
        symptoms_res = {}
        html_content = ""
        for symptom in symptoms:
@@ -164,7 +169,7 @@ def get_context(context=None):
            if resolutions:
                html_content += f"<p><strong>{item_code}:</strong></p>"
                for resolution in resolutions:
-                   html_content += f"<p>&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;<img src='{resolution.image}' style='max-width: 100px;'> --> <strong>{resolution.symptom_code}</strong> --> {resolution.resolution}<br>"
+                   html_content += f"<p>&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;<a href='{resolution.image}' target='_blank'><img src='{resolution.image_thumbnail}' style='max-width: 100px;'></a> --> <strong>{resolution.symptom_code}</strong> --> {resolution.resolution}<br>"
                html_content += "</p>"
        issue.symptoms_res = html_content
 
@@ -212,6 +217,8 @@ def get_context(context=None):
    LUNCH_END = timedelta(hours=13)
 
 
+   # scheduled hours against the 11 working hours of the board, from Technician Time Ledger
+   utilization = get_utilization([tech.email for tech in technicians], date, date, 11)
    for tech in technicians:
        html_content = ""
        tasks = frappe.get_all(
@@ -227,7 +234,6 @@ def get_context(context=None):
        tech.tasks = tasks
 
 
-       total_hours = 0
 
 
        employee = frappe.db.get_value("Employee", {"prefered_email": tech.email}, "employee")
@@ -326,7 +332,6 @@ def get_context(context=None):
 
            if task_in_slot:
                maintenance = get_maintenance_doc(task_in_slot['issue_code'])
-               total_hours += task_in_slot['duration_in_hours']
                html_content += f"""
                <div style="width: {task_in_slot['duration_in_hours'] * 2 * slot_width_percent}%; background-color: #ef4444; border-right: 1px solid #fff; border-radius: 4px; overflow: hidden; cursor: grab; user-select: none;" class="px-1 py-2 text-white text-center drag" data-type="type2" draggable="true" id="task-{task_in_slot['issue_code']}" data-duration="{task_in_slot['duration_in_hours']}" title="{task_in_slot['issue_code']}">
                    <a href="javascript:void(0)"
@@ -387,7 +392,7 @@ def get_context(context=None):
 
 
        tech.html_content = html_content
-       tech.total_hours = round(total_hours / 11 * 100, 2)
+       tech.total_hours = utilization.get(tech.email, 0)
 
 
    context["technicians"] = technicians
@@ -17,15 +17,26 @@ app_include_css = [
 
 override_whitelisted_methods = {
     'api.login': 'field_service_management.api.login',
+    'api.refresh_token': 'field_service_management.api.refresh_token',
+    'api.logout': 'field_service_management.api.logout',
     'api.get_maintenance': 'field_service_management.api.get_maintenance',
     'api.get_maintenance_': 'field_service_management.api.get_maintenance_',
+    'api.get_maintenance_changes': 'field_service_management.api.get_maintenance_changes',
     'api.update_spare_item': 'field_service_management.api.update_spare_item',
     'api.start_maintenance_visit': 'field_service_management.api.start_maintenance_visit',
     'api.check_300m_radius': 'field_service_management.api.check_300m_radius',
+    'api.check_radius_batch': 'field_service_management.api.check_radius_batch',
     'api.update_punch_in_out': 'field_service_management.api.update_punch_in_out',
     'api.update_checktree': 'field_service_management.api.update_checktree',
+    'api.update_checktree_bulk': 'field_service_management.api.update_checktree_bulk',
+    'api.apply_mutations': 'field_service_management.api.apply_mutations',
     'api.live_location': 'field_service_management.api.live_location',
+    'api.live_location_batch': 'field_service_management.api.live_location_batch',
     'api.attachment': 'field_service_management.api.attachment',
+    'api.upload_initiate': 'field_service_management.api.upload_initiate',
+    'api.upload_chunk': 'field_service_management.api.upload_chunk',
+    'api.upload_status': 'field_service_management.api.upload_status',
+    'api.upload_finalize': 'field_service_management.api.upload_finalize',
     'api.technician_notes': 'field_service_management.api.technician_notes',
     'api.add_symptom_requests': 'field_service_management.api.add_symptom_requests',
     'api.add_reschedule_requests': 'field_service_management.api.add_reschedule_requests',
@@ -147,6 +158,42 @@ override_whitelisted_methods = {
 # 	}
 # }
 
+doc_events = {
+    "User": {
+        "on_update": "field_service_management.auth.clear_api_key_cache",
+        "on_trash": "field_service_management.auth.clear_api_key_cache",
+    },
+    "Employee": {
+        "on_update": "field_service_management.location.clear_employee_cache",
+        "on_trash": "field_service_management.location.clear_employee_cache",
+    },
+    "Assigned Tasks": {
+        "on_update": [
+            "field_service_management.location.clear_geofence_cache",
+            "field_service_management.time_ledger.update_scheduled_hours",
+        ],
+        "on_trash": [
+            "field_service_management.location.clear_geofence_cache",
+            "field_service_management.time_ledger.update_scheduled_hours",
+        ],
+    },
+    "Punch In Punch Out": {
+        "validate": "field_service_management.durations.set_punch_duration_seconds",
+        "on_update": "field_service_management.time_ledger.update_punch_hours",
+        "on_trash": "field_service_management.time_ledger.update_punch_hours",
+    },
+    "Maintenance Visit": {
+        "validate": "field_service_management.durations.set_punch_duration_seconds",
+        "on_update": "field_service_management.time_ledger.update_punch_hours",
+    },
+    "Delivery Note": {
+        "on_update": "field_service_management.time_ledger.update_invoiced_hours",
+        "on_submit": "field_service_management.time_ledger.update_invoiced_hours",
+        "on_cancel": "field_service_management.time_ledger.update_invoiced_hours",
+        "on_trash": "field_service_management.time_ledger.update_invoiced_hours",
+    },
+}
+
 # Scheduled Tasks
 # ---------------
 
@@ -168,6 +215,24 @@ override_whitelisted_methods = {
 # 	],
 # }
 
+scheduler_events = {
+    "hourly": [
+        "field_service_management.uploads.remove_abandoned_upload_sessions",
+    ],
+    "daily": [
+        "field_service_management.api.delete_old_mutations",
+    ],
+    "daily_long": [
+        "field_service_management.location.compact_live_location_history",
+        "field_service_management.time_ledger.reconcile_time_ledger",
+    ],
+    "cron": {
+        "* * * * *": [
+            "field_service_management.location.flush_live_location_queue",
+        ],
+    },
+}
+
 # Testing
 # -------
 
@@ -233,6 +298,6 @@ override_whitelisted_methods = {
 # Authentication and authorization
 # --------------------------------
 
-# auth_hooks = [
-# 	"field_service_management.auth.validate"
-# ]
+auth_hooks = [
+	"field_service_management.auth.validate_bearer_token"
+]
@@ -0,0 +1,1041 @@
+import json
+import math
+import time
+
+import frappe
+import numpy as np
+import redis
+from frappe.contacts.doctype.address.address import get_address_display
+from frappe.utils import add_days, flt, get_datetime, now_datetime, nowdate
+
+
+EMPLOYEE_BY_USER_CACHE_KEY = "fsm:employee_by_user"
+TECHNICIAN_POSITIONS_CACHE_KEY = "fsm:technician_positions"
+TECHNICIAN_GEOFENCES_CACHE_KEY = "fsm:technician_geofences"
+TECHNICIAN_GEOFENCE_STATE_CACHE_KEY = "fsm:technician_geofence_state"
+GEOFENCE_RADIUS = 300
+MAX_BATCH_POINTS = 1000
+
+LIVE_LOCATION_QUEUE_KEY = "fsm:live_location_queue"
+LIVE_LOCATION_PROCESSING_KEY = "fsm:live_location_queue:processing"
+LIVE_LOCATION_QUEUE_LOCK_KEY = "fsm:live_location_queue:lock"
+LIVE_LOCATION_QUEUE_STATS_KEY = "fsm:live_location_queue:stats"
+LIVE_LOCATION_QUEUE_MAX = 50000
+LIVE_LOCATION_FLUSH_THRESHOLD = 2000
+LIVE_LOCATION_FLUSH_CHUNK = 1000
+LIVE_LOCATION_FLUSH_ROUNDS = 10
+
+LIVE_LOCATION_JITTER_METERS = 25
+LIVE_LOCATION_JITTER_SECONDS = 10 * 60
+
+MAX_DISTANCE_PAIRS = 20_000
+GRID_CELL_DEGREES = 0.05
+METERS_PER_DEGREE = 111_320
+
+MAINTENANCE_VISITS_CACHE_KEY = "fsm:map_maintenance_visits:v1"
+MAINTENANCE_VISITS_CACHE_TTL = 60
+MAINTENANCE_VISITS_VERSION_KEY = MAINTENANCE_VISITS_CACHE_KEY + ":version"
+
+# Per process spatial index of the cached visit list: site -> (version, PointGrid)
+_maintenance_visit_grids = {}
+
+TRACK_CHUNK = 5000
+TRACK_MAX_POINTS = 2000
+TRACK_SEGMENT_GAP_SECONDS = 30 * 60
+EARTH_RADIUS = 6371e3
+
+LIVE_LOCATION_RETENTION_DAYS = 14
+LIVE_LOCATION_DOWNSAMPLE_SECONDS = 5 * 60
+LIVE_LOCATION_DOWNSAMPLE_METERS = 200
+LIVE_LOCATION_COMPACTION_CHUNK = 5000
+LIVE_LOCATION_COMPACTED_UNTIL_KEY = "fsm_live_location_compacted_until"
+
+LIVE_LOCATION_FIELDS = (
+    "name",
+    "creation",
+    "modified",
+    "owner",
+    "modified_by",
+    "docstatus",
+    "idx",
+    "technician",
+    "employee",
+    "employee_name",
+    "latitude",
+    "longitude",
+    "location",
+    "time",
+)
+
+
+def get_employee_for_user(user):
+    """Employee `name` and `employee_name` linked to `user`, cached in Redis"""
+
+    def generator():
+        return frappe.db.get_value(
+            "Employee", {"user_id": user}, ["name", "employee_name"], as_dict=True
+        ) or {}
+
+    return frappe.cache().hget(EMPLOYEE_BY_USER_CACHE_KEY, user, generator=generator) or {}
+
+
+def clear_employee_cache(doc, method=None):
+    """Employee doc event: the user link or the name of the employee may have changed"""
+    users = {doc.user_id}
+    previous = doc.get_doc_before_save()
+    if previous:
+        users.add(previous.user_id)
+
+    for user in filter(None, users):
+        frappe.cache().hdel(EMPLOYEE_BY_USER_CACHE_KEY, user)
+
+
+def make_geojson(lat, lon):
+    return json.dumps(
+        {
+            "type": "FeatureCollection",
+            "features": [
+                {
+                    "type": "Feature",
+                    "properties": {},
+                    "geometry": {
+                        "type": "Point",
+                        "coordinates": [lon, lat],  # Note: [lng, lat]
+                    },
+                }
+            ],
+        }
+    )
+
+
+def parse_location_points(points):
+    """
+    Validate a batch of points sent by the app
+
+    Args:
+        points: List (or its JSON) of {"lat", "lon", "time"}, `time` defaults to now
+
+    Returns a tuple of (valid points, number of rejected points)
+    """
+    if isinstance(points, str):
+        points = json.loads(points)
+    if not isinstance(points, list):
+        raise ValueError("points must be a list")
+    if len(points) > MAX_BATCH_POINTS:
+        raise ValueError(f"A batch can hold at most {MAX_BATCH_POINTS} points")
+
+    valid = []
+    for point in points:
+        try:
+            lat = float(point["lat"])
+            lon = float(point["lon"])
+            time = get_datetime(point.get("time")) if point.get("time") else now_datetime()
+        except (KeyError, TypeError, ValueError, AttributeError):
+            continue
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            continue
+        valid.append({"lat": lat, "lon": lon, "time": time})
+
+    return valid, len(points) - len(valid)
+
+
+def build_live_location_rows(user, points):
+    """Live Location rows for parsed points of `user`, names are assigned here so a row can be written more than once"""
+    employee = get_employee_for_user(user)
+    # the map reads the numeric columns, the GeoJSON copy is only kept for sites that want it
+    store_geojson = frappe.conf.get("fsm_live_location_store_geojson")
+    return [
+        {
+            "name": frappe.generate_hash(length=10),
+            "technician": user,
+            "employee": employee.get("name"),
+            "employee_name": employee.get("employee_name"),
+            "latitude": point["lat"],
+            "longitude": point["lon"],
+            "location": make_geojson(point["lat"], point["lon"]) if store_geojson else None,
+            "time": str(point["time"]),
+        }
+        for point in points
+    ]
+
+
+def bulk_insert_live_locations(rows, ignore_duplicates=False):
+    """Write Live Location rows with a single multi-row insert"""
+    if not rows:
+        return 0
+
+    timestamp = now_datetime()
+    values = [
+        (
+            row["name"],
+            timestamp,
+            timestamp,
+            row["technician"],
+            row["technician"],
+            0,
+            0,
+            row["technician"],
+            row["employee"],
+            row["employee_name"],
+            row["latitude"],
+            row["longitude"],
+            row["location"],
+            row["time"],
+        )
+        for row in rows
+    ]
+    frappe.db.bulk_insert(
+        "Live Location", LIVE_LOCATION_FIELDS, values, ignore_duplicates=ignore_duplicates
+    )
+    return len(values)
+
+
+def ingest_live_locations(user, points):
+    """
+    Store parsed points of `user`, either through the write-behind queue (site config
+    `fsm_live_location_write_behind`) or directly. The caller commits.
+
+    Points that are within `fsm_live_location_jitter_meters` of the technician's last
+    stored point and `fsm_live_location_jitter_seconds` after it are not stored, they
+    only move the technician's "last seen" time forward. Every point, stored or not,
+    is checked against the geofences of the technician's visits of the day.
+
+    Returns a dict of `stored`, `suppressed`, `mode` ("queued" or "stored") and the geofence `events`
+    """
+    rows = build_live_location_rows(user, sorted(points, key=lambda point: point["time"]))
+    result = frappe._dict(stored=0, suppressed=0, mode="stored", events=[])
+    if not rows:
+        return result
+
+    result.events = detect_geofence_events(user, rows)
+
+    position = frappe.cache().hget(TECHNICIAN_POSITIONS_CACHE_KEY, user)
+    rows, position = filter_jitter(rows, position)
+    frappe.cache().hset(TECHNICIAN_POSITIONS_CACHE_KEY, user, position)
+    result.suppressed = len(points) - len(rows)
+
+    if not rows:
+        return result
+
+    if frappe.conf.get("fsm_live_location_write_behind") and enqueue_live_locations(rows):
+        result.stored, result.mode = len(rows), "queued"
+    else:
+        result.stored = bulk_insert_live_locations(rows)
+    return result
+
+
+def get_technician_geofences(user):
+    """
+    Geofences of the visits assigned to `user` today, as [{"visit", "latitude", "longitude"}].
+    Cached in Redis for the day, cleared by the Assigned Tasks doc events.
+    """
+    today = str(nowdate())
+    cached = frappe.cache().hget(TECHNICIAN_GEOFENCES_CACHE_KEY, user)
+    if cached and cached["date"] == today:
+        return cached["geofences"]
+
+    visit_names = set(
+        frappe.get_all(
+            "Assigned Tasks", filters={"technician": user, "date": today}, pluck="issue_code"
+        )
+    )
+    geofences = []
+    if visit_names:
+        for visit in get_maintenance_visits():
+            if visit["visit_id"] not in visit_names:
+                continue
+            point = get_visit_point(visit)
+            if point:
+                geofences.append({"visit": visit["visit_id"], "latitude": point[0], "longitude": point[1]})
+
+    frappe.cache().hset(TECHNICIAN_GEOFENCES_CACHE_KEY, user, {"date": today, "geofences": geofences})
+    return geofences
+
+
+def clear_geofence_cache(doc, method=None):
+    """Assigned Tasks doc event: the technician's visits of the day may have changed"""
+    technicians = {doc.technician}
+    previous = doc.get_doc_before_save()
+    if previous:
+        technicians.add(previous.technician)
+
+    for technician in filter(None, technicians):
+        frappe.cache().hdel(TECHNICIAN_GEOFENCES_CACHE_KEY, technician)
+
+
+def detect_geofence_events(user, rows):
+    """
+    Compare rows (sorted by time) of `user` with the technician's geofences and publish an
+    "arrival" or "departure" realtime event (`fsm_geofence`) each time one is crossed.
+    Returns the events.
+    """
+    geofences = get_technician_geofences(user)
+    if not geofences:
+        return []
+
+    radius = frappe.conf.get("fsm_geofence_radius") or GEOFENCE_RADIUS
+    was_inside = set(frappe.cache().hget(TECHNICIAN_GEOFENCE_STATE_CACHE_KEY, user) or ())
+    # visits no longer assigned for today are forgotten without a departure
+    inside = was_inside.intersection(geofence["visit"] for geofence in geofences)
+    events = []
+    for row in rows:
+        for geofence in geofences:
+            visit = geofence["visit"]
+            within = distance_between(geofence, row) <= radius
+            if within == (visit in inside):
+                continue
+
+            if within:
+                inside.add(visit)
+            else:
+                inside.discard(visit)
+            events.append(
+                {
+                    "event": "arrival" if within else "departure",
+                    "technician": user,
+                    "maintenance_visit": visit,
+                    "time": row["time"],
+                    "latitude": row["latitude"],
+                    "longitude": row["longitude"],
+                }
+            )
+
+    if inside != was_inside:
+        frappe.cache().hset(TECHNICIAN_GEOFENCE_STATE_CACHE_KEY, user, sorted(inside))
+    for event in events:
+        frappe.publish_realtime("fsm_geofence", event, after_commit=True)
+    return events
+
+
+def filter_jitter(rows, position):
+    """
+    Drop rows (sorted by time) that repeat the last stored point of the technician.
+
+    Args:
+        rows: Live Location rows of one technician
+        position: Cached position of the technician, None when unknown
+
+    Returns the rows to store and the updated position
+    """
+    max_meters = frappe.conf.get("fsm_live_location_jitter_meters", LIVE_LOCATION_JITTER_METERS)
+    max_seconds = frappe.conf.get("fsm_live_location_jitter_seconds", LIVE_LOCATION_JITTER_SECONDS)
+
+    kept = []
+    for row in rows:
+        if (
+            position
+            and abs((get_datetime(row["time"]) - get_datetime(position["stored_time"])).total_seconds()) <= max_seconds
+            and distance_between(position, row) <= max_meters
+        ):
+            position["time"] = max(position["time"], row["time"])
+            continue
+
+        kept.append(row)
+        # offline queued points older than the cached position do not replace it
+        if not position or row["time"] >= position["time"]:
+            position = make_technician_position(row)
+
+    return kept, position
+
+
+def make_technician_position(row):
+    """Entry of the position hash: coordinates and time of the last stored point, `time` is the last seen time"""
+    return {
+        "technician": row["technician"],
+        "latitude": row["latitude"],
+        "longitude": row["longitude"],
+        "time": row["time"],
+        "stored_time": row["time"],
+        "technician_name": row["employee_name"],
+    }
+
+
+def get_technician_positions():
+    """Latest point of every technician, one entry per technician"""
+    positions = list(frappe.cache().hgetall(TECHNICIAN_POSITIONS_CACHE_KEY).values())
+    if not positions:
+        positions = rebuild_technician_positions()
+    return positions
+
+
+def rebuild_technician_positions():
+    """Seed the position hash from Live Location history, only needed when Redis lost it"""
+    positions = frappe.db.sql(
+        """
+        SELECT ll.technician, ll.latitude, ll.longitude, ll.time, ll.employee_name AS technician_name
+        FROM `tabLive Location` ll
+        JOIN (
+            SELECT technician, MAX(time) AS latest_time
+            FROM `tabLive Location`
+            GROUP BY technician
+        ) latest
+            ON latest.technician = ll.technician
+            AND latest.latest_time = ll.time
+        """,
+        as_dict=True,
+    )
+    for position in positions:
+        position["time"] = str(position["time"])
+        position["latitude"] = flt(position["latitude"])
+        position["longitude"] = flt(position["longitude"])
+        position["stored_time"] = position["time"]
+        frappe.cache().hset(TECHNICIAN_POSITIONS_CACHE_KEY, position["technician"], dict(position))
+    return positions
+
+
+def enqueue_live_locations(rows):
+    """
+    Append rows to the Redis queue drained by `flush_live_location_queue`.
+    Returns False when the queue is full, the caller then writes synchronously.
+    """
+    cache = frappe.cache()
+    max_length = frappe.conf.get("fsm_live_location_queue_max") or LIVE_LOCATION_QUEUE_MAX
+    length = cache.llen(LIVE_LOCATION_QUEUE_KEY)
+    if length + len(rows) > max_length:
+        return False
+
+    enqueued_at = time.time()
+    payloads = [json.dumps({**row, "enqueued_at": enqueued_at}) for row in rows]
+    length = cache.execute_command("RPUSH", cache.make_key(LIVE_LOCATION_QUEUE_KEY), *payloads)
+
+    # do not wait for the scheduler when the phones are sending faster than it drains
+    if length >= LIVE_LOCATION_FLUSH_THRESHOLD:
+        frappe.enqueue(
+            "field_service_management.location.flush_live_location_queue",
+            queue="short",
+            job_id="fsm_flush_live_location_queue",
+            deduplicate=True,
+        )
+    return True
+
+
+def flush_live_location_queue():
+    """
+    Scheduled job: drain the write-behind queue into Live Location.
+
+    The queue is renamed to a processing list, written in chunks and only dropped
+    once committed, so a crashed run is retried on the next call (at-least-once).
+    Rows keep the name assigned at ingest and are inserted with INSERT IGNORE,
+    which makes a retry idempotent.
+    """
+    cache = frappe.cache()
+    lock = cache.lock(cache.make_key(LIVE_LOCATION_QUEUE_LOCK_KEY), timeout=300)
+    if not lock.acquire(blocking=False):
+        return
+
+    try:
+        flushed = 0
+        max_lag = 0
+        # bounded so a continuous stream of pings cannot keep one run going forever
+        for _round in range(LIVE_LOCATION_FLUSH_ROUNDS):
+            if not cache.exists(LIVE_LOCATION_PROCESSING_KEY):
+                try:
+                    cache.renamenx(
+                        cache.make_key(LIVE_LOCATION_QUEUE_KEY),
+                        cache.make_key(LIVE_LOCATION_PROCESSING_KEY),
+                    )
+                except redis.exceptions.ResponseError:
+                    # nothing queued
+                    break
+
+            rows = [json.loads(value) for value in cache.lrange(LIVE_LOCATION_PROCESSING_KEY, 0, -1)]
+            now = time.time()
+            for start in range(0, len(rows), LIVE_LOCATION_FLUSH_CHUNK):
+                chunk = rows[start : start + LIVE_LOCATION_FLUSH_CHUNK]
+                bulk_insert_live_locations(chunk, ignore_duplicates=True)
+                frappe.db.commit()
+                max_lag = max(max_lag, now - min(row["enqueued_at"] for row in chunk))
+            cache.delete_value(LIVE_LOCATION_PROCESSING_KEY)
+            flushed += len(rows)
+
+        if flushed:
+            cache.set_value(
+                LIVE_LOCATION_QUEUE_STATS_KEY,
+                {"flushed_at": str(now_datetime()), "flushed": flushed, "max_lag_seconds": round(max_lag, 3)},
+            )
+    finally:
+        lock.release()
+
+
+def get_live_location_queue_stats():
+    """Current queue length and age of the oldest queued point, plus figures of the last flush"""
+    cache = frappe.cache()
+    oldest_age = 0
+    for key in (LIVE_LOCATION_PROCESSING_KEY, LIVE_LOCATION_QUEUE_KEY):
+        oldest = cache.lindex(cache.make_key(key), 0)
+        if oldest:
+            oldest_age = time.time() - json.loads(oldest)["enqueued_at"]
+            break
+
+    return {
+        "queued": cache.llen(LIVE_LOCATION_QUEUE_KEY) + cache.llen(LIVE_LOCATION_PROCESSING_KEY),
+        "oldest_age_seconds": round(oldest_age, 3),
+        "last_flush": cache.get_value(LIVE_LOCATION_QUEUE_STATS_KEY),
+    }
+
+
+def compact_live_location_history(dry_run=False):
+    """
+    Scheduled job: downsample Live Location points older than the retention window
+    (site config `fsm_live_location_retention_days`, default 14).
+
+    Per technician, a point is kept when it is at least
+    `fsm_live_location_downsample_seconds` after, or `fsm_live_location_downsample_meters`
+    away from, the previous kept point. Every other point is moved to Live Location Archive,
+    one chunk per transaction. Points already compacted by an earlier run are not scanned again.
+
+    Args:
+        dry_run: Only report what would be moved
+
+    Returns a report of the rows scanned, kept and archived and an estimate of the bytes reclaimed
+    """
+    conf = frappe.conf
+    min_seconds = conf.get("fsm_live_location_downsample_seconds") or LIVE_LOCATION_DOWNSAMPLE_SECONDS
+    min_meters = conf.get("fsm_live_location_downsample_meters") or LIVE_LOCATION_DOWNSAMPLE_METERS
+    compacted_until = frappe.db.get_global(LIVE_LOCATION_COMPACTED_UNTIL_KEY) or "1900-01-01"
+    cutoff = str(add_days(now_datetime(), -(conf.get("fsm_live_location_retention_days") or LIVE_LOCATION_RETENTION_DAYS)))
+
+    report = {"from": compacted_until, "until": cutoff, "dry_run": bool(dry_run), "scanned": 0, "kept": 0, "archived": 0}
+
+    technicians = frappe.db.sql_list(
+        """
+        SELECT DISTINCT technician FROM `tabLive Location`
+        WHERE time >= %s AND time < %s
+        """,
+        (compacted_until, cutoff),
+    )
+    for technician in technicians:
+        last_kept = None
+        # keyset pagination, archived rows disappear from the table while we page
+        after = (compacted_until, "")
+        while True:
+            rows = frappe.db.sql(
+                """
+                SELECT name, time, latitude, longitude FROM `tabLive Location`
+                WHERE technician = %(technician)s AND time < %(cutoff)s
+                    AND (time > %(time)s OR (time = %(time)s AND name > %(name)s))
+                ORDER BY time, name
+                LIMIT %(limit)s
+                """,
+                {
+                    "technician": technician,
+                    "cutoff": cutoff,
+                    "time": after[0],
+                    "name": after[1],
+                    "limit": LIVE_LOCATION_COMPACTION_CHUNK,
+                },
+                as_dict=True,
+            )
+            if not rows:
+                break
+            after = (rows[-1].time, rows[-1].name)
+
+            to_archive = []
+            for row in rows:
+                if last_kept is None or (
+                    (row.time - last_kept.time).total_seconds() >= min_seconds
+                    or distance_between(last_kept, row) >= min_meters
+                ):
+                    last_kept = row
+                else:
+                    to_archive.append(row.name)
+
+            report["scanned"] += len(rows)
+            report["archived"] += len(to_archive)
+            if to_archive and not dry_run:
+                archive_live_locations(to_archive)
+                frappe.db.commit()
+
+    report["kept"] = report["scanned"] - report["archived"]
+    report["bytes_reclaimed"] = report["archived"] * get_live_location_avg_row_length()
+
+    if not dry_run:
+        frappe.db.set_global(LIVE_LOCATION_COMPACTED_UNTIL_KEY, cutoff)
+        frappe.db.commit()
+
+    return report
+
+
+def distance_between(a, b):
+    """Meters between two points holding `latitude`/`longitude`, infinite when either has no usable coordinates"""
+    from field_service_management.api import is_within_radius
+
+    try:
+        return is_within_radius(a["latitude"], a["longitude"], b["latitude"], b["longitude"])
+    except (TypeError, ValueError):
+        return float("inf")
+
+
+def archive_live_locations(names):
+    frappe.db.sql(
+        """
+        INSERT IGNORE INTO `tabLive Location Archive`
+            (name, creation, modified, modified_by, owner, docstatus, idx,
+            technician, employee, employee_name, latitude, longitude, location, time)
+        SELECT name, creation, modified, modified_by, owner, docstatus, idx,
+            technician, employee, employee_name, latitude, longitude, location, time
+        FROM `tabLive Location`
+        WHERE name IN %(names)s
+        """,
+        {"names": tuple(names)},
+    )
+    frappe.db.sql("DELETE FROM `tabLive Location` WHERE name IN %(names)s", {"names": tuple(names)})
+
+
+def get_live_location_avg_row_length():
+    """Average on-disk row size of Live Location (data + indexes), from the table statistics"""
+    stats = frappe.db.sql(
+        """
+        SELECT TABLE_ROWS, DATA_LENGTH + INDEX_LENGTH
+        FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'tabLive Location'
+        """
+    )
+    if not stats or not stats[0][0]:
+        return 0
+    return int(stats[0][1] / stats[0][0])
+
+
+def get_technician_track(technician, from_time, to_time, tolerance=10, max_points=TRACK_MAX_POINTS):
+    """
+    Route of a technician between two datetimes, simplified with Douglas-Peucker.
+
+    Points are read in time order, chunk by chunk. The route is split into segments
+    wherever the technician sent nothing for 30 minutes. If the simplified route still has
+    more than `max_points` points the tolerance is doubled until it fits.
+
+    Args:
+        tolerance: Maximum deviation from the raw route, in meters
+
+    Returns encoded polylines (precision 5), one per segment, and the distance travelled over the raw points
+    """
+    tolerance = max(flt(tolerance), 0.1)
+    segments = [[]]
+    distance = 0
+    count = 0
+    previous = None
+    for row in iter_track_points(technician, from_time, to_time):
+        count += 1
+        if previous:
+            step = distance_between(previous, row)
+            if step != float("inf"):
+                distance += step
+            if (row.time - previous.time).total_seconds() > TRACK_SEGMENT_GAP_SECONDS:
+                segments.append([])
+        segments[-1].append((flt(row.latitude), flt(row.longitude)))
+        previous = row
+
+    segments = [segment for segment in segments if segment]
+    while True:
+        simplified = [simplify_track(segment, tolerance) for segment in segments]
+        if sum(len(segment) for segment in simplified) <= max_points or tolerance > EARTH_RADIUS:
+            break
+        tolerance *= 2
+
+    return {
+        "technician": technician,
+        "from": from_time,
+        "to": to_time,
+        "points": count,
+        "simplified_points": sum(len(segment) for segment in simplified),
+        "tolerance": tolerance,
+        "distance": round(distance),
+        "polylines": [encode_polyline(segment) for segment in simplified],
+    }
+
+
+def iter_track_points(technician, from_time, to_time):
+    """Live Location rows of a technician in time order, read in chunks so long ranges are not loaded at once"""
+    after = (from_time, "")
+    while True:
+        rows = frappe.db.sql(
+            """
+            SELECT name, time, latitude, longitude FROM `tabLive Location`
+            WHERE technician = %(technician)s AND time <= %(to_time)s
+                AND (time > %(time)s OR (time = %(time)s AND name > %(name)s))
+            ORDER BY time, name
+            LIMIT %(limit)s
+            """,
+            {
+                "technician": technician,
+                "to_time": to_time,
+                "time": after[0],
+                "name": after[1],
+                "limit": TRACK_CHUNK,
+            },
+            as_dict=True,
+        )
+        if not rows:
+            return
+        yield from rows
+        after = (rows[-1].time, rows[-1].name)
+
+
+def simplify_track(points, tolerance):
+    """
+    Douglas-Peucker simplification of (lat, lon) points, iterative so long tracks cannot hit the recursion limit.
+    Distances are measured on a local equirectangular projection, in meters.
+    """
+    if len(points) < 3:
+        return list(points)
+
+    cos_lat = math.cos(math.radians(points[0][0]))
+    xy = [
+        (math.radians(lon) * cos_lat * EARTH_RADIUS, math.radians(lat) * EARTH_RADIUS)
+        for lat, lon in points
+    ]
+
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        start, end = stack.pop()
+        max_distance, index = 0, None
+        for i in range(start + 1, end):
+            distance = distance_to_segment(xy[i], xy[start], xy[end])
+            if distance > max_distance:
+                max_distance, index = distance, i
+        if index is not None and max_distance > tolerance:
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def distance_to_segment(point, start, end):
+    dx, dy = end[0] - start[0], end[1] - start[1]
+    if not dx and not dy:
+        return math.hypot(point[0] - start[0], point[1] - start[1])
+
+    t = ((point[0] - start[0]) * dx + (point[1] - start[1]) * dy) / (dx * dx + dy * dy)
+    t = max(0, min(1, t))
+    return math.hypot(point[0] - (start[0] + t * dx), point[1] - (start[1] + t * dy))
+
+
+def encode_polyline(points, precision=5):
+    """Encoded polyline (Google format) of (lat, lon) points"""
+    factor = 10**precision
+    encoded = []
+    previous_lat = previous_lon = 0
+    for lat, lon in points:
+        lat, lon = round(lat * factor), round(lon * factor)
+        for delta in (lat - previous_lat, lon - previous_lon):
+            delta = ~(delta << 1) if delta < 0 else delta << 1
+            while delta >= 0x20:
+                encoded.append(chr((0x20 | (delta & 0x1F)) + 63))
+                delta >>= 5
+            encoded.append(chr(delta + 63))
+        previous_lat, previous_lon = lat, lon
+    return "".join(encoded)
+
+
+def parse_coordinates(points):
+    """
+    (lat, lon) pairs from a list (or its JSON) of `[lat, lon]` or `{"lat": ..., "lon": ...}`
+    """
+    if isinstance(points, str):
+        points = json.loads(points)
+    if isinstance(points, dict):
+        points = [points]
+
+    coordinates = []
+    for point in points:
+        if isinstance(point, dict):
+            point = (point["lat"], point["lon"])
+        lat, lon = float(point[0]), float(point[1])
+        if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+            raise ValueError(f"Invalid coordinates: {lat}, {lon}")
+        coordinates.append((lat, lon))
+    return coordinates
+
+
+def haversine_matrix(origins, targets):
+    """
+    Meters between every origin and every target as an (origins x targets) array,
+    the vectorized form of `api.is_within_radius`
+    """
+    origins = np.radians(np.asarray(origins, dtype=float).reshape(-1, 2))
+    targets = np.radians(np.asarray(targets, dtype=float).reshape(-1, 2))
+    lat1, lon1 = origins[:, 0:1], origins[:, 1:2]
+    lat2, lon2 = targets[:, 0], targets[:, 1]
+
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    # rounding can push antipodal pairs just past 1, where sqrt(1 - a) is NaN
+    a = np.clip(a, 0, 1)
+    return 2 * EARTH_RADIUS * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def parse_geolocation(address_name, geolocation):
+    if not geolocation:
+        return None
+
+    if isinstance(geolocation, dict):
+        return geolocation
+
+    if not isinstance(geolocation, str):
+        frappe.log_error(
+            f"Unexpected geolocation format for address: {address_name}",
+            "Field Service Management",
+        )
+        return None
+
+    try:
+        return json.loads(geolocation)
+    except json.JSONDecodeError:
+        frappe.log_error(
+            f"Invalid geolocation data for address: {address_name}",
+            "Field Service Management",
+        )
+        return None
+
+
+def get_cached_maintenance_visits():
+    cached = frappe.cache().get_value(MAINTENANCE_VISITS_CACHE_KEY)
+    if not cached:
+        return None
+
+    if isinstance(cached, str):
+        try:
+            return json.loads(cached)
+        except json.JSONDecodeError:
+            frappe.cache().delete_value(MAINTENANCE_VISITS_CACHE_KEY)
+            return None
+
+    return cached
+
+
+def set_cached_maintenance_visits(maintenance_visits):
+    frappe.cache().set_value(
+        MAINTENANCE_VISITS_CACHE_KEY,
+        json.dumps(maintenance_visits),
+        expires_in_sec=MAINTENANCE_VISITS_CACHE_TTL,
+    )
+    # lets every worker notice the refresh and rebuild its spatial index
+    frappe.cache().set_value(
+        MAINTENANCE_VISITS_VERSION_KEY,
+        frappe.generate_hash(length=10),
+        expires_in_sec=MAINTENANCE_VISITS_CACHE_TTL,
+    )
+
+
+def get_maintenance_visits(use_cache=True):
+    if use_cache:
+        cached = get_cached_maintenance_visits()
+        if cached is not None:
+            return cached
+
+    maintenance_records = frappe.db.sql(
+        """
+        SELECT name, delivery_addres, customer, maintenance_type, completion_status
+        FROM `tabMaintenance Visit`
+        WHERE completion_status != 'Fully Completed'
+            AND docstatus != 2
+    """,
+        as_dict=True,
+    )
+
+    if not maintenance_records:
+        return []
+
+    delivery_addresses = {
+        visit.delivery_addres for visit in maintenance_records if visit.delivery_addres
+    }
+    customers = {visit.customer for visit in maintenance_records if visit.customer}
+
+    serial_address_by_delivery_address = {}
+    if delivery_addresses:
+        serial_rows = frappe.get_all(
+            "Serial No",
+            filters={
+                "custom_item_current_installation_address": [
+                    "in",
+                    list(delivery_addresses),
+                ]
+            },
+            fields=[
+                "custom_item_current_installation_address",
+                "custom_item_current_installation_address_name",
+            ],
+        )
+        serial_address_by_delivery_address = {
+            row.custom_item_current_installation_address: row.custom_item_current_installation_address_name
+            for row in serial_rows
+            if row.custom_item_current_installation_address
+            and row.custom_item_current_installation_address_name
+        }
+
+    customer_address_names = {}
+    if customers:
+        dynamic_links = frappe.get_all(
+            "Dynamic Link",
+            filters={
+                "link_doctype": "Customer",
+                "link_name": ["in", list(customers)],
+                "parenttype": "Address",
+            },
+            fields=["parent", "link_name"],
+        )
+        for link in dynamic_links:
+            customer_address_names.setdefault(link.link_name, []).append(link.parent)
+
+    address_names = set(serial_address_by_delivery_address.values())
+    for names in customer_address_names.values():
+        address_names.update(names)
+
+    addresses_by_name = {}
+    if address_names:
+        address_rows = frappe.get_all(
+            "Address",
+            filters={"name": ["in", list(address_names)]},
+            fields=["name", "geolocation"],
+        )
+        addresses_by_name = {row.name: row for row in address_rows}
+
+    display_by_address_name = {}
+    unresolved_visits = [
+        visit
+        for visit in maintenance_records
+        if not serial_address_by_delivery_address.get(visit.delivery_addres)
+        and visit.delivery_addres
+        and visit.customer
+    ]
+    for visit in unresolved_visits:
+        for address_name in customer_address_names.get(visit.customer, []):
+            if address_name not in display_by_address_name:
+                display_by_address_name[address_name] = get_address_display(
+                    address_name
+                )
+            if display_by_address_name[address_name] == visit.delivery_addres:
+                serial_address_by_delivery_address[visit.delivery_addres] = address_name
+                break
+
+    maintenance_visits = []
+    for visit in maintenance_records:
+        address_name = serial_address_by_delivery_address.get(visit.delivery_addres)
+        geolocation = None
+        if address_name and address_name in addresses_by_name:
+            address = addresses_by_name[address_name]
+            geolocation = parse_geolocation(address.name, address.geolocation)
+
+        maintenance_visits.append(
+            {
+                "visit_id": visit.name,
+                "geolocation": geolocation,
+                "address": visit.delivery_addres,
+                "customer": visit.customer,
+                "type": visit.maintenance_type,
+                "status": visit.completion_status,
+            }
+        )
+
+    if use_cache:
+        set_cached_maintenance_visits(maintenance_visits)
+
+    return maintenance_visits
+
+
+def get_visit_point(visit):
+    """(lat, lon) of the first Point in a visit's GeoJSON geolocation"""
+    for feature in (visit.get("geolocation") or {}).get("features") or []:
+        geometry = feature.get("geometry") or {}
+        if geometry.get("type") == "Point":
+            lon, lat = geometry["coordinates"][:2]
+            return float(lat), float(lon)
+    return None
+
+
+def get_maintenance_visit_grid():
+    """Spatial index of the open visits, rebuilt whenever the cached visit list is refreshed"""
+    cached = _maintenance_visit_grids.get(frappe.local.site)
+    version = frappe.cache().get_value(MAINTENANCE_VISITS_VERSION_KEY)
+    if cached and version and cached[0] == version:
+        return cached[1]
+
+    # refreshes the cached list (and its version) when it has expired
+    maintenance_visits = get_maintenance_visits()
+    version = frappe.cache().get_value(MAINTENANCE_VISITS_VERSION_KEY)
+
+    points = []
+    for visit in maintenance_visits:
+        point = get_visit_point(visit)
+        if point:
+            points.append((visit, point))
+    grid = PointGrid(points)
+    _maintenance_visit_grids[frappe.local.site] = (version, grid)
+    return grid
+
+
+class PointGrid:
+    """
+    Uniform lat/lon grid over a fixed set of items for nearest-neighbour and
+    bounding-box queries. Built once from a list of (item, (lat, lon)) and read only.
+    """
+
+    def __init__(self, items, cell_size=GRID_CELL_DEGREES):
+        self.cell_size = cell_size
+        self.items = []
+        self.cells = {}
+        coordinates = []
+        for item, (lat, lon) in items:
+            self.cells.setdefault(self.cell(lat, lon), []).append(len(self.items))
+            self.items.append(item)
+            coordinates.append((lat, lon))
+        self.coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 2)
+
+    def __len__(self):
+        return len(self.items)
+
+    def cell(self, lat, lon):
+        return (math.floor(lat / self.cell_size), math.floor(lon / self.cell_size))
+
+    def indexes_in_bbox(self, min_lat, min_lon, max_lat, max_lon):
+        (min_row, min_col), (max_row, max_col) = self.cell(min_lat, min_lon), self.cell(max_lat, max_lon)
+        if (max_row - min_row + 1) * (max_col - min_col + 1) > len(self.cells):
+            # a box larger than the populated area, walk the populated cells instead
+            cells = [
+                key for key in self.cells if min_row <= key[0] <= max_row and min_col <= key[1] <= max_col
+            ]
+        else:
+            cells = [(row, col) for row in range(min_row, max_row + 1) for col in range(min_col, max_col + 1)]
+
+        indexes = []
+        for key in cells:
+            for index in self.cells.get(key, ()):
+                lat, lon = self.coordinates[index]
+                if min_lat <= lat <= max_lat and min_lon <= lon <= max_lon:
+                    indexes.append(index)
+        return indexes
+
+    def bbox(self, min_lat, min_lon, max_lat, max_lon):
+        return [self.items[index] for index in self.indexes_in_bbox(min_lat, min_lon, max_lat, max_lon)]
+
+    def nearest(self, lat, lon, k=10, radius=None):
+        """
+        Up to `k` items closest to (lat, lon), as (item, meters) sorted by distance
+
+        Args:
+            radius: (Optional) Only consider items within this many meters
+        """
+        if not self.items:
+            return []
+
+        if radius:
+            delta_lat = radius / METERS_PER_DEGREE
+            delta_lon = radius / (METERS_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+            indexes = np.asarray(
+                self.indexes_in_bbox(lat - delta_lat, lon - delta_lon, lat + delta_lat, lon + delta_lon),
+                dtype=int,
+            )
+        else:
+            indexes = np.arange(len(self.items))
+        if not len(indexes):
+            return []
+
+        distances = haversine_matrix([(lat, lon)], self.coordinates[indexes])[0]
+        if radius:
+            inside = distances <= radius
+            indexes, distances = indexes[inside], distances[inside]
+
+        order = np.argsort(distances)[: int(k)]
+        return [(self.items[indexes[i]], float(distances[i])) for i in order]
@@ -0,0 +1,7 @@
+import frappe
+
+
+def execute():
+    frappe.db.add_index(
+        "Live Location", ["latitude", "longitude"], "live_location_lat_lon_idx"
+    )
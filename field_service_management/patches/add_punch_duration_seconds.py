@@ -0,0 +1,69 @@
+import frappe
+from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
+
+
+CHUNK_SIZE = 10000
+
+
+def seconds_from_text(column):
+    # "2h 15m" -> 8100, "45m" -> 2700
+    return f"""(
+        COALESCE(CAST(REGEXP_SUBSTR(REGEXP_SUBSTR({column}, '[0-9]+ *h'), '[0-9]+') AS UNSIGNED), 0) * 3600
+        + COALESCE(CAST(REGEXP_SUBSTR(REGEXP_SUBSTR({column}, '[0-9]+ *m'), '[0-9]+') AS UNSIGNED), 0) * 60
+    )"""
+
+
+def execute():
+    """
+    Punch In Punch Out durations were only kept as "Xh Ym" text. Add integer second
+    columns next to them, fill them from the text chunk by chunk, and index
+    (technician, punch_in) for the per-technician SUM() reports.
+    """
+    create_custom_fields(
+        {
+            "Punch In Punch Out": [
+                {
+                    "fieldname": "custom_travel_seconds",
+                    "label": "Travel Time (Seconds)",
+                    "fieldtype": "Int",
+                    "insert_after": "travel_time",
+                    "read_only": 1,
+                    "no_copy": 1,
+                },
+                {
+                    "fieldname": "custom_working_seconds",
+                    "label": "Working Hours (Seconds)",
+                    "fieldtype": "Int",
+                    "insert_after": "working_hours",
+                    "read_only": 1,
+                    "no_copy": 1,
+                },
+            ]
+        },
+        update=True,
+    )
+
+    last_name = ""
+    while True:
+        names = frappe.db.sql_list(
+            "SELECT name FROM `tabPunch In Punch Out` WHERE name > %s ORDER BY name LIMIT %s",
+            (last_name, CHUNK_SIZE),
+        )
+        if not names:
+            break
+        last_name = names[-1]
+
+        frappe.db.sql(
+            f"""
+            UPDATE `tabPunch In Punch Out`
+            SET custom_travel_seconds = {seconds_from_text("travel_time")},
+                custom_working_seconds = {seconds_from_text("working_hours")}
+            WHERE name IN %(names)s
+            """,
+            {"names": tuple(names)},
+        )
+        frappe.db.commit()
+
+    frappe.db.add_index(
+        "Punch In Punch Out", ["technician", "punch_in"], "punch_in_punch_out_technician_punch_in_idx"
+    )
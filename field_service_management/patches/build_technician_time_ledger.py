@@ -0,0 +1,34 @@
+import frappe
+from frappe.utils import add_days, getdate, nowdate
+
+from field_service_management.time_ledger import rebuild_time_ledger
+
+
+CHUNK_DAYS = 31
+
+
+def execute():
+    """Fill Technician Time Ledger from the existing tasks, punches and invoices, one month per transaction"""
+    first_date = frappe.db.sql(
+        """
+        SELECT MIN(day) FROM (
+            SELECT MIN(date) AS day FROM `tabAssigned Tasks`
+            UNION ALL
+            SELECT MIN(DATE(punch_in)) FROM `tabPunch In Punch Out`
+            UNION ALL
+            SELECT MIN(dn.posting_date)
+            FROM `tabDelivery Note` dn
+            JOIN `tabEmployee Contribution` contribution ON contribution.parent = dn.name
+        ) days
+        """
+    )[0][0]
+    last_date = frappe.db.sql("SELECT MAX(date) FROM `tabAssigned Tasks`")[0][0]
+    if not first_date:
+        return
+
+    from_date = getdate(first_date)
+    to_date = max(getdate(last_date or nowdate()), getdate(nowdate()))
+    while from_date <= to_date:
+        rebuild_time_ledger(from_date, min(add_days(from_date, CHUNK_DAYS - 1), to_date))
+        frappe.db.commit()
+        from_date = add_days(from_date, CHUNK_DAYS)
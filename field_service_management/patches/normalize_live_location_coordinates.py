@@ -0,0 +1,45 @@
+import frappe
+
+
+CHUNK_SIZE = 10000
+NUMERIC = "'^ *-?[0-9]+([.][0-9]+)? *$'"
+
+
+def execute():
+    """
+    Live Location latitude/longitude become Float columns on model sync. Clean the
+    varchar values first, chunk by chunk, so the column conversion cannot fail on
+    rows that hold no number. Such rows carry no position, so they are deleted rather
+    than given a made-up coordinate.
+    """
+    for doctype in ("Live Location", "Live Location Archive"):
+        if not frappe.db.table_exists(doctype):
+            continue
+
+        last_name = ""
+        while True:
+            names = frappe.db.sql_list(
+                f"SELECT name FROM `tab{doctype}` WHERE name > %s ORDER BY name LIMIT %s",
+                (last_name, CHUNK_SIZE),
+            )
+            if not names:
+                break
+            last_name = names[-1]
+
+            frappe.db.sql(
+                f"""
+                DELETE FROM `tab{doctype}`
+                WHERE name IN %(names)s
+                    AND NOT (IFNULL(latitude, '') REGEXP {NUMERIC} AND IFNULL(longitude, '') REGEXP {NUMERIC})
+                """,
+                {"names": tuple(names)},
+            )
+            frappe.db.sql(
+                f"""
+                UPDATE `tab{doctype}`
+                SET latitude = TRIM(latitude), longitude = TRIM(longitude)
+                WHERE name IN %(names)s
+                """,
+                {"names": tuple(names)},
+            )
+            frappe.db.commit()
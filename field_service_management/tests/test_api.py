@@ -0,0 +1,324 @@
+# Copyright (c) 2024, Aayush Patidar and Contributors
+# See license.txt
+
+import inspect
+import json
+from unittest.mock import patch
+
+import frappe
+from frappe.utils import add_days, add_to_date, now_datetime
+from frappe.tests.utils import FrappeTestCase
+
+from field_service_management.api import (
+	apply_mutations,
+	build_mobile_sub_steps,
+	decode_sync_cursor,
+	encode_sync_cursor,
+	format_shipping_address,
+	get_action_time,
+	get_maintenance_payloads,
+	get_mutation_timestamp,
+	update_checklist_from_sub_steps,
+	update_shipping_address,
+	update_shipping_address_job,
+	update_sub_step_by_name,
+)
+
+
+def count_queries(fn, *args, **kwargs):
+	with patch.object(frappe.db, "sql", wraps=frappe.db.sql) as sql:
+		fn(*args, **kwargs)
+	return sql.call_count
+
+
+def make_maintenance_visit(item_codes=("_Test Item", "_Test Item 2")):
+	"""Maintenance Visit with a checklist row, a sub-step and a symptom per item"""
+	visit = frappe.new_doc("Maintenance Visit")
+	visit.update({
+		"customer": "_Test Customer",
+		"mntc_date": frappe.utils.today(),
+		"maintenance_type": "Breakdown",
+		"completion_status": "Partially Completed",
+	})
+	for item_code in item_codes:
+		visit.append("checktree_description", {
+			"item_code": item_code,
+			"work_done": "No",
+			"sub_steps_json": json.dumps([{"name": f"{item_code}-step", "title": "Inspect", "work_done": "No"}]),
+		})
+		visit.append("symptoms_table", {"item_code": item_code})
+	visit.flags.ignore_validate = True
+	visit.insert(ignore_permissions=True, ignore_links=True, ignore_mandatory=True)
+
+	for row in visit.checktree_description:
+		visit.append("custom_sub_steps_work_log", {
+			"parent_checklist_row": row.name,
+			"sub_step_original_name": f"{row.item_code}-step",
+			"work_done": "No",
+		})
+	visit.flags.ignore_validate = True
+	visit.save(ignore_permissions=True)
+	return visit
+
+
+class TestGetMaintenancePayloads(FrappeTestCase):
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		cls.visits = [make_maintenance_visit() for _ in range(3)]
+
+	def test_query_count_is_constant(self):
+		user = "Administrator"
+		names = [visit.name for visit in self.visits]
+		# warm up doctype meta so it is not counted below
+		get_maintenance_payloads(names[:1], user)
+
+		single = count_queries(get_maintenance_payloads, names[:1], user)
+		many = count_queries(get_maintenance_payloads, names, user)
+		self.assertEqual(single, many)
+
+	def test_payload_matches_visit_documents(self):
+		names = [visit.name for visit in self.visits]
+		payloads = get_maintenance_payloads(names, "Administrator")
+		self.assertEqual([payload.name for payload in payloads], names)
+
+		for visit, payload in zip(self.visits, payloads):
+			# batching several visits must not change what each visit gets
+			self.assertEqual(payload, get_maintenance_payloads([visit.name], "Administrator")[0])
+
+			checklist = payload["checktree_description"]
+			self.assertEqual(set(checklist), {"_Test Item", "_Test Item 2"})
+			for row in visit.checktree_description:
+				self.assertEqual([r.name for r in checklist[row.item_code]], [row.name])
+				mobile_steps = json.loads(checklist[row.item_code][0]["sub_steps_format_for_mobile_apk"])
+				self.assertEqual([step["parent_step_name"] for step in mobile_steps], [row.name])
+
+			symptoms = payload["symptoms_table"]
+			self.assertEqual(
+				{item_code: [r.name for r in rows] for item_code, rows in symptoms.items()},
+				{row.item_code: [row.name] for row in visit.symptoms_table},
+			)
+			self.assertEqual(
+				[r.name for r in payload["custom_sub_steps_work_log"]],
+				[r.name for r in visit.custom_sub_steps_work_log],
+			)
+
+	def test_sub_steps_cache_is_read_once(self):
+		names = [visit.name for visit in self.visits]
+		cache = frappe.cache()
+		with patch.object(cache, "mget", wraps=cache.mget) as mget:
+			get_maintenance_payloads(names, "Administrator")
+			get_maintenance_payloads(names, "Administrator")
+		self.assertEqual(mget.call_count, 2)
+		self.assertEqual([len(call.args[0]) for call in mget.call_args_list], [len(names), len(names)])
+
+	def test_missing_visits_are_skipped(self):
+		self.assertEqual(get_maintenance_payloads(["_Test Missing Visit"], "Administrator"), [])
+
+
+class TestSyncCursor(FrappeTestCase):
+	def test_round_trip(self):
+		cursor = encode_sync_cursor("2024-11-15 19:21:17.335163", ["MV-2", "MV-1"])
+		self.assertEqual(
+			decode_sync_cursor(cursor),
+			{"synced_at": "2024-11-15 19:21:17.335163", "visits": ["MV-1", "MV-2"]},
+		)
+
+	def test_malformed_cursor_forces_full_sync(self):
+		self.assertIsNone(decode_sync_cursor("not-a-cursor"))
+
+
+class TestChecklistFromSubSteps(FrappeTestCase):
+	def make_visit(self, *work_done):
+		return frappe._dict(
+			custom_sub_steps_work_log=[
+				frappe._dict(parent_checklist_row="row-1", work_done=status) for status in work_done
+			]
+		)
+
+	def test_checklist_done_when_all_sub_steps_done(self):
+		checklist = frappe._dict(name="row-1")
+		self.assertTrue(update_checklist_from_sub_steps(self.make_visit("Yes", "Yes"), checklist, "tech@example.com"))
+		self.assertEqual((checklist.work_done, checklist.done_by), ("Yes", "tech@example.com"))
+
+	def test_checklist_reopened_by_pending_sub_step(self):
+		checklist = frappe._dict(name="row-1", work_done="Yes", done_by="tech@example.com")
+		self.assertFalse(update_checklist_from_sub_steps(self.make_visit("Yes", "No"), checklist, "tech@example.com"))
+		self.assertEqual((checklist.work_done, checklist.done_by), ("No", None))
+
+
+class TestUpdateSubStepByName(FrappeTestCase):
+	def setUp(self):
+		# keep the writes inside the test transaction
+		frappe.flags.in_mutation_batch = True
+		self.addCleanup(setattr, frappe.flags, "in_mutation_batch", False)
+
+	def test_last_two_sub_steps_complete_checklist(self):
+		visit = make_maintenance_visit(item_codes=("_Test Item",))
+		checklist = visit.checktree_description[0]
+		visit.append("custom_sub_steps_work_log", {
+			"parent_checklist_row": checklist.name,
+			"sub_step_original_name": "_Test Item-step-2",
+			"work_done": "No",
+		})
+		visit.flags.ignore_validate = True
+		visit.save(ignore_permissions=True)
+		first, second = visit.custom_sub_steps_work_log
+
+		update_sub_step_by_name(first.name, "yes", "Administrator")
+		self.assertEqual(frappe.db.get_value("Maintenance Visit Checklist", checklist.name, "work_done"), "No")
+
+		response = update_sub_step_by_name(second.name, "yes", "Administrator")
+		self.assertTrue(response["parent_checklist_auto_updated"])
+		self.assertEqual(
+			frappe.db.get_value("Maintenance Visit Checklist", checklist.name, ["work_done", "done_by"]),
+			("Yes", "Administrator"),
+		)
+
+
+class TestMobileSubSteps(FrappeTestCase):
+	def test_mobile_format_follows_work_log_rows(self):
+		checklist = frappe._dict(
+			name="row-1",
+			sub_steps_json=json.dumps([
+				{"name": "step-a", "title": "Open panel", "work_done": "No"},
+				{"name": "step-b", "title": "Clean filter", "work_done": "No"},
+			]),
+		)
+		work_log = [
+			frappe._dict(name="log-2", idx=2, parent_checklist_row="row-1", sub_step_original_name="step-b", work_done="No"),
+			frappe._dict(
+				name="log-1", idx=1, parent_checklist_row="row-1", sub_step_original_name="step-a",
+				work_done="Yes", done_by="tech@example.com",
+			),
+		]
+
+		sub_steps = build_mobile_sub_steps([checklist], work_log)["row-1"]
+		mobile_format = json.loads(sub_steps["sub_steps_format_for_mobile_apk"])
+
+		self.assertEqual([step["sub_step_name"] for step in mobile_format], ["log-1", "log-2"])
+		self.assertEqual(mobile_format[0]["title"], "Open panel")
+		self.assertEqual(mobile_format[0]["work_done"], "Yes")
+		self.assertEqual(mobile_format[0]["parent_step_name"], "row-1")
+		self.assertEqual(
+			[step["work_done"] for step in json.loads(sub_steps["sub_steps_json"])], ["Yes", "No"]
+		)
+
+
+class TestApplyMutations(FrappeTestCase):
+	def apply(self, mutations):
+		return inspect.unwrap(apply_mutations)(mutations, user="Administrator")
+
+	def test_rejects_batch_with_unknown_operation(self):
+		response = self.apply([{"key": "k1", "operation": "delete_everything", "args": {}}])
+		self.assertEqual(response["status"], "error")
+
+	def test_rejects_mutation_without_key(self):
+		response = self.apply(json.dumps([{"operation": "technician_notes", "args": {}}]))
+		self.assertEqual(response["status"], "error")
+
+	def test_failed_mutation_is_not_recorded(self):
+		response = self.apply([{"key": "k-missing", "operation": "update_checktree", "args": {"status": "yes"}}])
+		self.assertEqual(response["results"][0]["status"], "failed")
+		self.assertFalse(frappe.db.exists("Mobile Mutation", {"idempotency_key": "k-missing"}))
+
+	def test_operation_runs_at_device_time(self):
+		device_time = add_to_date(now_datetime(), hours=-3).replace(microsecond=0)
+		seen = []
+
+		def record_time(user):
+			seen.append(get_action_time())
+			return {"status": "success"}
+
+		with patch.dict("field_service_management.api.MUTATION_OPERATIONS", {"technician_notes": record_time}):
+			self.apply([{"key": "k-time", "operation": "technician_notes", "args": {}, "timestamp": str(device_time)}])
+		self.assertEqual(seen, [device_time])
+
+	def test_device_time_is_bounded(self):
+		self.assertIsNone(get_mutation_timestamp({}))
+		self.assertRaises(ValueError, get_mutation_timestamp, {"timestamp": "yesterday-ish"})
+		self.assertRaises(ValueError, get_mutation_timestamp, {"timestamp": str(add_days(now_datetime(), 1))})
+		self.assertRaises(ValueError, get_mutation_timestamp, {"timestamp": str(add_days(now_datetime(), -60))})
+
+	def test_only_applied_mutations_run_after_commit_jobs(self):
+		ran = []
+
+		def enqueue(status):
+			def operation(user):
+				frappe.db.after_commit.add(lambda: ran.append(status))
+				return {"status": status}
+			return operation
+
+		operations = {"technician_notes": enqueue("error"), "update_spare_item": enqueue("success")}
+		with patch.dict("field_service_management.api.MUTATION_OPERATIONS", operations):
+			self.apply([
+				{"key": "k-enqueue-failed", "operation": "technician_notes", "args": {}},
+				{"key": "k-enqueue-applied", "operation": "update_spare_item", "args": {}},
+			])
+		self.assertEqual(ran, ["success"])
+
+	def test_failed_mutation_leaves_no_messages(self):
+		def throw(user):
+			frappe.throw("No active punch-in record found to update.")
+
+		message_count = len(frappe.local.message_log)
+		with patch.dict("field_service_management.api.MUTATION_OPERATIONS", {"update_punch_in_out": throw}):
+			response = self.apply([{"key": "k-throw", "operation": "update_punch_in_out", "args": {}}])
+		self.assertEqual(response["results"][0]["status"], "failed")
+		self.assertEqual(len(frappe.local.message_log), message_count)
+
+
+class TestShippingAddress(FrappeTestCase):
+	def test_optional_lines_are_skipped(self):
+		address = frappe._dict(
+			address_line1="12 Main St", address_line2=None, ward_name=None, district="Central",
+			town="Hanoi", province=None, country="Vietnam", phone="123", fax=None,
+		)
+		self.assertEqual(
+			format_shipping_address(address),
+			"12 Main St<br>Central<br>Hanoi<br>Vietnam<br>Phone: 123<br>",
+		)
+
+	def test_second_run_updates_nothing(self):
+		suffix = frappe.generate_hash(length=8)
+		frappe.get_doc({
+			"doctype": "Address", "name": f"_Test FSM Address {suffix}", "address_line1": "12 Main St",
+			"town": "Hanoi", "country": "Vietnam",
+		}).db_insert()
+		frappe.get_doc({
+			"doctype": "Delivery Note", "name": f"_Test FSM DN {suffix}",
+			"shipping_address_name": f"_Test FSM Address {suffix}",
+		}).db_insert()
+		for i in range(3):
+			frappe.get_doc({
+				"doctype": "Serial No", "name": f"_Test FSM SN {suffix} {i}",
+				"delivery_document_no": f"_Test FSM DN {suffix}",
+			}).db_insert()
+
+		# keep the chunk commits inside the test transaction, but count them
+		with patch.object(frappe.db, "commit") as commit:
+			first = update_shipping_address_job(chunk_size=1)
+			self.assertEqual(commit.call_count, first["total"])
+			second = update_shipping_address_job(chunk_size=1)
+
+		self.assertGreaterEqual(first["updated"], 3)
+		self.assertEqual(first["processed"], first["total"])
+		self.assertEqual(second["updated"], 0)
+		self.assertEqual(second["unchanged"], second["total"])
+		self.assertEqual(
+			frappe.db.get_value("Serial No", f"_Test FSM SN {suffix} 0", "custom_item_current_installation_address_name"),
+			f"_Test FSM Address {suffix}",
+		)
+
+	def test_only_system_manager_can_queue(self):
+		frappe.set_user("Guest")
+		self.addCleanup(frappe.set_user, "Administrator")
+		with patch("frappe.enqueue") as enqueue:
+			self.assertRaises(frappe.PermissionError, update_shipping_address)
+		enqueue.assert_not_called()
+
+	def test_progress_goes_to_caller(self):
+		frappe.set_user("Administrator")
+		with patch("frappe.enqueue") as enqueue:
+			update_shipping_address()
+		self.assertEqual(enqueue.call_args.kwargs["user"], "Administrator")
@@ -0,0 +1,45 @@
+# Copyright (c) 2024, Aayush Patidar and Contributors
+# See license.txt
+
+from frappe.tests.test_api import FrappeAPITestCase
+from frappe.tests.utils import FrappeTestCase
+
+from field_service_management.auth import decode_token, issue_tokens, revoke_token
+
+
+class TestTokens(FrappeTestCase):
+	def test_access_token_round_trip(self):
+		tokens = issue_tokens("Administrator")
+		claims = decode_token(tokens["access_token"])
+		self.assertEqual(claims["sub"], "Administrator")
+		self.assertIn("Administrator", claims["roles"])
+
+	def test_token_type_is_enforced(self):
+		tokens = issue_tokens("Administrator")
+		self.assertIsNone(decode_token(tokens["refresh_token"]))
+		self.assertIsNone(decode_token(tokens["access_token"], token_type="refresh"))
+
+	def test_revoked_token_is_rejected(self):
+		tokens = issue_tokens("Administrator")
+		revoke_token(decode_token(tokens["access_token"]))
+		self.assertIsNone(decode_token(tokens["access_token"]))
+
+
+class TestBearerRequests(FrappeAPITestCase):
+	path = "/api/method/field_service_management.api.get_maintenance"
+
+	def get_with_token(self, token):
+		return self.get(self.path, headers={"Authorization": f"Bearer {token}"})
+
+	def test_access_token_reaches_endpoint(self):
+		response = self.get_with_token(issue_tokens("Administrator")["access_token"])
+		self.assertEqual(response.status_code, 200)
+		self.assertIsInstance(response.json["message"], list)
+
+	def test_invalid_token_is_rejected(self):
+		self.assertEqual(self.get_with_token("not-a-token").status_code, 401)
+
+	def test_revoked_token_is_rejected(self):
+		token = issue_tokens("Administrator")["access_token"]
+		revoke_token(decode_token(token))
+		self.assertEqual(self.get_with_token(token).status_code, 401)
@@ -0,0 +1,40 @@
+# Copyright (c) 2024, Aayush Patidar and Contributors
+# See license.txt
+
+from datetime import datetime
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from field_service_management.durations import (
+	format_duration,
+	get_duration_seconds,
+	parse_duration,
+	set_punch_duration_seconds,
+)
+
+
+class TestDurations(FrappeTestCase):
+	def test_round_trip(self):
+		self.assertEqual(parse_duration("2h 15m"), 8100)
+		self.assertEqual(parse_duration("45m"), 2700)
+		self.assertEqual(format_duration(8159), "2h 15m")
+		self.assertEqual(parse_duration(format_duration(8159)), 8100)
+
+	def test_unreadable_text_is_zero(self):
+		self.assertEqual(parse_duration(None), 0)
+		self.assertEqual(parse_duration("soon"), 0)
+
+	def test_seconds_between(self):
+		start = datetime(2024, 5, 1, 9, 0, 0)
+		self.assertEqual(get_duration_seconds(start, datetime(2024, 5, 1, 10, 30, 5)), 5405)
+		self.assertEqual(get_duration_seconds(start, None), 0)
+
+	def test_exact_seconds_kept_when_text_matches(self):
+		row = frappe._dict(doctype="Punch In Punch Out", travel_time="1h 30m", custom_travel_seconds=5405)
+		set_punch_duration_seconds(row)
+		self.assertEqual(row.custom_travel_seconds, 5405)
+
+		row.travel_time = "2h 0m"
+		set_punch_duration_seconds(row)
+		self.assertEqual(row.custom_travel_seconds, 7200)
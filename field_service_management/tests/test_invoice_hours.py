@@ -0,0 +1,76 @@
+# Copyright (c) 2024, Aayush Patidar and Contributors
+# See license.txt
+
+import importlib
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from field_service_management.time_ledger import get_invoice_hours_by_employee
+
+FROM_DATE, TO_DATE = "2099-01-01", "2099-01-31"
+
+
+def make_delivery_note(posting_date, total_qty, employees):
+	note = frappe.get_doc({
+		"doctype": "Delivery Note",
+		"name": f"_Test FSM DN {frappe.generate_hash(length=8)}",
+		"customer": "_Test Customer",
+		"posting_date": posting_date,
+		"total_qty": total_qty,
+	})
+	note.db_insert()
+	for idx, employee in enumerate(employees, start=1):
+		frappe.get_doc({
+			"doctype": "Employee Contribution",
+			"parent": note.name,
+			"parenttype": "Delivery Note",
+			"parentfield": "employee_contribution",
+			"idx": idx,
+			"employee": employee,
+		}).db_insert()
+	return note
+
+
+def get_invoice_hours_per_note(employee, start_date, end_date):
+	"""The per-note loop `get_invoice_hours` used before it became one query"""
+	total_hours = 0
+	for dn in frappe.db.sql(
+		"SELECT name, total_qty FROM `tabDelivery Note` WHERE posting_date BETWEEN %s AND %s",
+		(start_date, end_date),
+		as_dict=True,
+	):
+		employee_list = frappe.db.sql_list("SELECT employee FROM `tabEmployee Contribution` WHERE parent = %s", dn.name)
+		if employee in employee_list:
+			total_hours += dn.total_qty / len(employee_list)
+	return total_hours
+
+
+class TestInvoiceHours(FrappeTestCase):
+	@classmethod
+	def setUpClass(cls):
+		super().setUpClass()
+		cls.a, cls.b = "_T-FSM-EMP-A", "_T-FSM-EMP-B"
+		# duplicate row: counts toward the divisor, but A gets one share
+		make_delivery_note("2099-01-05", 6, [cls.a, cls.a, cls.b])
+		# A did not contribute
+		make_delivery_note("2099-01-06", 4, [cls.b])
+		# nobody contributed
+		make_delivery_note("2099-01-07", 10, [])
+
+	def test_shares_follow_contributors(self):
+		self.assertEqual(get_invoice_hours_by_employee(FROM_DATE, TO_DATE), {self.a: 2, self.b: 6})
+		self.assertEqual(get_invoice_hours_by_employee(FROM_DATE, TO_DATE, [self.a]), {self.a: 2})
+
+	def test_matches_per_note_computation(self):
+		hours = get_invoice_hours_by_employee(FROM_DATE, TO_DATE)
+		for employee in (self.a, self.b):
+			self.assertAlmostEqual(hours[employee], get_invoice_hours_per_note(employee, FROM_DATE, TO_DATE))
+
+	def test_team_hours_need_hr_or_system_manager(self):
+		delivery_address = importlib.import_module("field_service_management.delivery-address")
+		frappe.set_user("Guest")
+		self.addCleanup(frappe.set_user, "Administrator")
+		self.assertRaises(
+			frappe.PermissionError, delivery_address.get_team_invoice_hours, "[]", FROM_DATE, TO_DATE
+		)
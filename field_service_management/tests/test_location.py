@@ -0,0 +1,135 @@
+# Copyright (c) 2024, Aayush Patidar and Contributors
+# See license.txt
+
+import inspect
+import json
+
+import numpy as np
+from frappe.tests.utils import FrappeTestCase
+
+from field_service_management.api import check_radius_batch, is_within_radius
+from field_service_management.location import (
+	encode_polyline,
+	filter_jitter,
+	haversine_matrix,
+	make_technician_position,
+	PointGrid,
+	simplify_track,
+)
+
+
+def make_row(lat, lon, time):
+	return {
+		"technician": "tech@example.com",
+		"employee_name": "Tech",
+		"latitude": lat,
+		"longitude": lon,
+		"time": time,
+	}
+
+
+class TestFilterJitter(FrappeTestCase):
+	def test_stationary_points_are_suppressed(self):
+		position = make_technician_position(make_row(21.0285, 105.8542, "2024-11-15 10:00:00"))
+		rows = [
+			make_row(21.02851, 105.85421, "2024-11-15 10:01:00"),
+			make_row(21.02852, 105.85419, "2024-11-15 10:02:00"),
+		]
+
+		kept, position = filter_jitter(rows, position)
+
+		self.assertEqual(kept, [])
+		self.assertEqual(position["time"], "2024-11-15 10:02:00")
+		self.assertEqual(position["stored_time"], "2024-11-15 10:00:00")
+
+	def test_movement_and_stale_anchor_are_stored(self):
+		position = make_technician_position(make_row(21.0285, 105.8542, "2024-11-15 10:00:00"))
+		rows = [
+			make_row(21.0385, 105.8542, "2024-11-15 10:01:00"),
+			make_row(21.0385, 105.8542, "2024-11-15 10:30:00"),
+		]
+
+		kept, position = filter_jitter(rows, position)
+
+		self.assertEqual(kept, rows)
+		self.assertEqual(position["stored_time"], "2024-11-15 10:30:00")
+
+
+class TestTrack(FrappeTestCase):
+	def test_encode_polyline(self):
+		# reference example of the polyline algorithm documentation
+		points = [(38.5, -120.2), (40.7, -120.95), (43.252, -126.453)]
+		self.assertEqual(encode_polyline(points), "_p~iF~ps|U_ulLnnqC_mqNvxq`@")
+
+	def test_simplify_track_drops_collinear_points(self):
+		points = [(21.0 + i * 0.001, 105.0) for i in range(50)]
+		self.assertEqual(simplify_track(points, 1), [points[0], points[-1]])
+
+	def test_simplify_track_keeps_corners(self):
+		points = [(21.0, 105.0), (21.0, 105.01), (21.01, 105.01)]
+		self.assertEqual(simplify_track(points, 10), points)
+
+
+class TestHaversineMatrix(FrappeTestCase):
+	def test_matches_is_within_radius(self):
+		origins = [(21.0285, 105.8542), (10.7769, 106.7009)]
+		targets = [(21.0245, 105.8412), (16.0544, 108.2022), (10.7769, 106.7009)]
+
+		distances = haversine_matrix(origins, targets)
+
+		self.assertEqual(distances.shape, (2, 3))
+		for i, origin in enumerate(origins):
+			for j, target in enumerate(targets):
+				self.assertAlmostEqual(distances[i][j], is_within_radius(*origin, *target), places=3)
+
+	def test_antipodal_points_are_finite(self):
+		distances = haversine_matrix([(0.0, 0.0), (45.0, 10.0)], [(0.0, 180.0), (-45.0, -170.0)])
+		self.assertFalse(np.isnan(distances).any())
+
+
+class TestCheckRadiusBatch(FrappeTestCase):
+	origin = (21.0285, 105.8542)
+	targets = [(21.0288, 105.8525), (16.0544, 108.2022)]
+
+	def check(self, **kwargs):
+		return inspect.unwrap(check_radius_batch)(targets=json.dumps(self.targets), user="Administrator", **kwargs)
+
+	def test_list_origin(self):
+		response = self.check(origin=json.dumps(list(self.origin)))
+		self.assertEqual(response["status"], "success")
+		self.assertEqual(response["within_radius"], [True, False])
+		self.assertAlmostEqual(
+			response["distances"][1], is_within_radius(*self.origin, *self.targets[1]), places=1
+		)
+
+	def test_dict_origin(self):
+		response = self.check(origin=json.dumps({"lat": self.origin[0], "lon": self.origin[1]}))
+		self.assertEqual(response["within_radius"], [True, False])
+
+	def test_origins(self):
+		response = self.check(origins=json.dumps([list(self.origin), {"lat": 16.0544, "lon": 108.2022}]))
+		self.assertEqual(response["status"], "success")
+		self.assertEqual(response["within_radius"], [[True, False], [False, True]])
+
+
+class TestPointGrid(FrappeTestCase):
+	def setUp(self):
+		self.grid = PointGrid(
+			[
+				("hanoi", (21.0285, 105.8542)),
+				("hoan-kiem", (21.0288, 105.8525)),
+				("da-nang", (16.0544, 108.2022)),
+			]
+		)
+
+	def test_nearest_within_radius(self):
+		nearest = self.grid.nearest(21.0285, 105.8542, k=5, radius=5000)
+		self.assertEqual([item for item, distance in nearest], ["hanoi", "hoan-kiem"])
+
+	def test_nearest_without_radius_respects_k(self):
+		nearest = self.grid.nearest(16.0, 108.0, k=1)
+		self.assertEqual(nearest[0][0], "da-nang")
+
+	def test_bbox(self):
+		self.assertEqual(sorted(self.grid.bbox(20, 105, 22, 106)), ["hanoi", "hoan-kiem"])
+		self.assertEqual(self.grid.bbox(-90, -180, 90, 180), ["hanoi", "hoan-kiem", "da-nang"])
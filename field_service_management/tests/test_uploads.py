@@ -0,0 +1,122 @@
+# Copyright (c) 2024, Aayush Patidar and Contributors
+# See license.txt
+
+import io
+import os
+import stat
+import tempfile
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import get_site_path
+
+from field_service_management.tests.test_api import make_maintenance_visit
+from field_service_management.uploads import (
+	UploadError,
+	append_upload_chunk,
+	create_upload_session,
+	create_visit_attachment,
+	THUMBNAIL_SUFFIX,
+	discard_upload_session,
+	finalize_upload_session,
+	get_derived_image_url,
+	get_image_extension,
+	get_public_file_mode,
+	get_thumbnail_url,
+	get_upload_session,
+	make_image_derivatives,
+	store_content_addressed,
+)
+
+
+class TestImageExtension(FrappeTestCase):
+	def test_known_signatures(self):
+		self.assertEqual(get_image_extension(b"\xff\xd8\xff\xe0\x00\x10JFIF"), "jpeg")
+		self.assertEqual(get_image_extension(b"\x89PNG\r\n\x1a\n\x00\x00"), "png")
+		self.assertEqual(get_image_extension(b"RIFF\x24\x00\x00\x00WEBPVP8 "), "webp")
+
+	def test_unknown_content(self):
+		self.assertIsNone(get_image_extension(b"%PDF-1.7"))
+		self.assertIsNone(get_image_extension(b""))
+
+
+class TestStoreContentAddressed(FrappeTestCase):
+	def test_stored_file_is_readable_by_web_server(self):
+		os.makedirs(get_site_path("public", "files"), exist_ok=True)
+		fd, path = tempfile.mkstemp(dir=get_site_path("public", "files"), prefix=".upload-")
+		os.close(fd)
+
+		file_name = store_content_addressed(path, "0" * 64 + "-mode-test", "png")
+		target = get_site_path("public", "files", file_name)
+		self.addCleanup(os.remove, target)
+
+		self.assertEqual(stat.S_IMODE(os.stat(target).st_mode), get_public_file_mode())
+
+
+class TestVisitAttachment(FrappeTestCase):
+	def test_same_image_is_attached_once(self):
+		visit = make_maintenance_visit()
+		first = create_visit_attachment(visit.name, "/files/abc.png", "Before")
+		second = create_visit_attachment(visit.name, "/files/abc.png", "After")
+
+		self.assertEqual(first.name, second.name)
+		self.assertEqual(frappe.db.count("Attachments", {"parent": visit.name, "image": "/files/abc.png"}), 1)
+		self.assertEqual(frappe.db.get_value("Attachments", first.name, "caption"), "After")
+
+
+class TestDerivedImages(FrappeTestCase):
+	def test_derived_url_sits_next_to_public_file(self):
+		self.assertEqual(get_derived_image_url("/files/abc.png", THUMBNAIL_SUFFIX), "/files/abc_thumb.jpg")
+
+	def test_no_derived_url_for_external_or_private_images(self):
+		self.assertIsNone(get_derived_image_url("https://example.com/a.png", THUMBNAIL_SUFFIX))
+		self.assertIsNone(get_derived_image_url("/private/files/a.png", THUMBNAIL_SUFFIX))
+		self.assertIsNone(get_derived_image_url(None, THUMBNAIL_SUFFIX))
+
+	def test_unreadable_image_is_not_requeued(self):
+		os.makedirs(get_site_path("public", "files"), exist_ok=True)
+		file_url = f"/files/{frappe.generate_hash(length=20)}.png"
+		path = get_site_path("public", "files", file_url[len("/files/"):])
+		with open(path, "wb") as f:
+			f.write(b"\x89PNG\r\n\x1a\nnot really a png")
+		self.addCleanup(os.remove, path)
+
+		make_image_derivatives(file_url)
+
+		with patch("frappe.enqueue") as enqueue:
+			self.assertEqual(get_thumbnail_url(file_url), file_url)
+		enqueue.assert_not_called()
+
+
+class TestUploadSession(FrappeTestCase):
+	def setUp(self):
+		self.session = create_upload_session("Administrator", "_Test Visit", size=8)
+		self.upload_id = self.session["upload_id"]
+
+	def tearDown(self):
+		discard_upload_session(self.upload_id)
+
+	def test_chunks_resume_from_offset(self):
+		self.assertEqual(append_upload_chunk(self.upload_id, "Administrator", 0, io.BytesIO(b"\x89PNG")), 4)
+		self.assertRaises(UploadError, append_upload_chunk, self.upload_id, "Administrator", 0, io.BytesIO(b"\x89PNG"))
+		self.assertEqual(append_upload_chunk(self.upload_id, "Administrator", 4, io.BytesIO(b"\r\n\x1a\n")), 8)
+		self.assertEqual(get_upload_session(self.upload_id, "Administrator")["offset"], 8)
+
+	def test_session_is_private_to_its_user(self):
+		self.assertRaises(UploadError, get_upload_session, self.upload_id, "Guest")
+
+	def test_finalize_twice_attaches_once(self):
+		visit = make_maintenance_visit()
+		session = create_upload_session("Administrator", visit.name, size=8)
+		self.addCleanup(discard_upload_session, session["upload_id"])
+		append_upload_chunk(session["upload_id"], "Administrator", 0, io.BytesIO(b"\x89PNG\r\n\x1a\n"))
+
+		file_url = finalize_upload_session(session["upload_id"], "Administrator")
+		self.assertEqual(finalize_upload_session(session["upload_id"], "Administrator"), file_url)
+		self.assertEqual(
+			frappe.db.count("Attachments", {"parent": visit.name, "image": file_url}), 1
+		)
+		self.assertRaises(
+			UploadError, append_upload_chunk, session["upload_id"], "Administrator", 8, io.BytesIO(b"x")
+		)
@@ -0,0 +1,309 @@
+from collections import defaultdict
+
+import frappe
+from frappe.utils import add_days, flt, getdate, now_datetime, nowdate
+
+
+LEDGER_DOCTYPE = "Technician Time Ledger"
+LEDGER_RECONCILE_DAYS = 7
+LEDGER_FIELDS = ("scheduled_seconds", "travel_seconds", "working_seconds", "invoiced_hours")
+
+# Share of every Delivery Note of a posting date range for each of its contributors:
+# total_qty divided by the number of Employee Contribution rows, once per employee
+INVOICE_SHARES = """
+        SELECT DISTINCT ec.employee, team.name, team.posting_date, team.total_qty / team.contributors AS share
+        FROM (
+            SELECT dn.name, dn.posting_date, dn.total_qty, COUNT(*) AS contributors
+            FROM `tabDelivery Note` dn
+            JOIN `tabEmployee Contribution` contribution ON contribution.parent = dn.name
+            WHERE dn.posting_date BETWEEN %(from_date)s AND %(to_date)s
+            GROUP BY dn.name, dn.posting_date, dn.total_qty
+        ) team
+        JOIN `tabEmployee Contribution` ec ON ec.parent = team.name
+        {employee_filter}
+"""
+
+
+# Sources
+# -------
+# Each query returns {(technician, date): value} for a date range, optionally
+# limited to some technicians, so one function serves both the incremental
+# refresh of a few days and the nightly rebuild.
+
+
+def get_scheduled_seconds(from_date, to_date, technicians=None):
+    return _grouped(
+        """
+        SELECT technician, date, SUM(GREATEST(TIME_TO_SEC(TIMEDIFF(etime, stime)), 0))
+        FROM `tabAssigned Tasks`
+        WHERE date BETWEEN %(from_date)s AND %(to_date)s {technician_filter}
+        GROUP BY technician, date
+        """,
+        "technician",
+        from_date,
+        to_date,
+        technicians,
+    )
+
+
+def get_punch_seconds(from_date, to_date, technicians=None):
+    """({(technician, date): travel seconds}, {(technician, date): working seconds}), by punch-in day"""
+    travel, working = {}, {}
+    for technician, date, travel_seconds, working_seconds in frappe.db.sql(
+        """
+        SELECT technician, DATE(punch_in), SUM(custom_travel_seconds), SUM(custom_working_seconds)
+        FROM `tabPunch In Punch Out`
+        WHERE punch_in >= %(from_date)s AND punch_in < %(until)s {technician_filter}
+        GROUP BY technician, DATE(punch_in)
+        """.format(technician_filter="AND technician IN %(technicians)s" if technicians else ""),
+        {"from_date": from_date, "until": add_days(to_date, 1), "technicians": tuple(technicians or ())},
+    ):
+        travel[(technician, date)] = int(travel_seconds or 0)
+        working[(technician, date)] = int(working_seconds or 0)
+    return travel, working
+
+
+def get_invoiced_hours(from_date, to_date, employees=None):
+    """
+    {(employee, posting date): hours}: every Delivery Note the employee contributed to
+    counts for total_qty divided by its number of contributors.
+    """
+    return _sum_invoice_shares(["employee", "posting_date"], from_date, to_date, employees)
+
+
+def get_invoice_hours_by_employee(from_date, to_date, employees=None):
+    """{employee: hours} over a posting date range, same rule as `get_invoiced_hours`, in one query"""
+    return {
+        employee: flt(hours)
+        for (employee,), hours in _sum_invoice_shares(["employee"], from_date, to_date, employees).items()
+    }
+
+
+def _sum_invoice_shares(group_by, from_date, to_date, employees):
+    columns = ", ".join(group_by)
+    employee_filter = "WHERE ec.employee IN %(employees)s" if employees else ""
+    return {
+        tuple(row[:-1]): row[-1] or 0
+        for row in frappe.db.sql(
+            f"""
+            SELECT {columns}, SUM(share)
+            FROM ({INVOICE_SHARES.format(employee_filter=employee_filter)}) shares
+            GROUP BY {columns}
+            """,
+            {"from_date": from_date, "to_date": to_date, "employees": tuple(employees or ())},
+        )
+    }
+
+
+def _grouped(query, technician_column, from_date, to_date, technicians):
+    technician_filter = f"AND {technician_column} IN %(technicians)s" if technicians else ""
+    return {
+        (technician, date): value or 0
+        for technician, date, value in frappe.db.sql(
+            query.format(technician_filter=technician_filter),
+            {"from_date": from_date, "to_date": to_date, "technicians": tuple(technicians or ())},
+        )
+    }
+
+
+def get_users_by_employee(employees=None, technicians=None):
+    """{employee: user} of employees linked to a user, optionally limited to some employees or users"""
+    filters = {"user_id": ["is", "set"]}
+    if employees is not None:
+        filters["name"] = ["in", list(employees) or [""]]
+    if technicians:
+        filters["user_id"] = ["in", list(technicians)]
+    return dict(frappe.get_all("Employee", filters=filters, fields=["name", "user_id"], as_list=True))
+
+
+# Ledger
+# ------
+
+
+def rebuild_time_ledger(from_date, to_date, technicians=None):
+    """
+    Recompute the ledger rows of a date range (of some technicians only, if given)
+    from Assigned Tasks, Punch In Punch Out and Delivery Notes, and replace them.
+    """
+    from_date, to_date = getdate(from_date), getdate(to_date)
+    technicians = list(filter(None, technicians or [])) or None
+
+    users_by_employee = get_users_by_employee(technicians=technicians)
+
+    rows = defaultdict(lambda: dict.fromkeys(LEDGER_FIELDS, 0))
+    for key, seconds in get_scheduled_seconds(from_date, to_date, technicians).items():
+        rows[key]["scheduled_seconds"] = int(seconds)
+
+    travel, working = get_punch_seconds(from_date, to_date, technicians)
+    for key, seconds in travel.items():
+        rows[key]["travel_seconds"] = seconds
+    for key, seconds in working.items():
+        rows[key]["working_seconds"] = seconds
+
+    if users_by_employee:
+        invoiced = get_invoiced_hours(from_date, to_date, list(users_by_employee) if technicians else None)
+        for (employee, date), hours in invoiced.items():
+            if users_by_employee.get(employee):
+                rows[(users_by_employee[employee], date)]["invoiced_hours"] = flt(hours, 3)
+
+    rows = {key: values for key, values in rows.items() if key[0] and any(values.values())}
+
+    # rows of the range that no longer have any source
+    filters = {"date": ["between", [from_date, to_date]]}
+    if technicians:
+        filters["technician"] = ["in", technicians]
+    current = {get_ledger_name(*key) for key in rows}
+    stale = [name for name in frappe.get_all(LEDGER_DOCTYPE, filters=filters, pluck="name") if name not in current]
+    if stale:
+        frappe.db.delete(LEDGER_DOCTYPE, {"name": ["in", stale]})
+
+    upsert_ledger_rows(rows)
+
+
+def upsert_ledger_rows(rows):
+    """Insert or overwrite ledger rows {(technician, date): values} in one statement"""
+    if not rows:
+        return
+
+    timestamp = now_datetime()
+    columns = ["name", "creation", "modified", "owner", "modified_by", "technician", "date", *LEDGER_FIELDS]
+    values = [
+        (
+            get_ledger_name(technician, date),
+            timestamp,
+            timestamp,
+            "Administrator",
+            "Administrator",
+            technician,
+            date,
+            *(row[field] for field in LEDGER_FIELDS),
+        )
+        for (technician, date), row in rows.items()
+    ]
+    placeholders = ", ".join(["(" + ", ".join(["%s"] * len(columns)) + ")"] * len(values))
+    frappe.db.sql(
+        f"""
+        INSERT INTO `tab{LEDGER_DOCTYPE}` ({", ".join(f"`{column}`" for column in columns)})
+        VALUES {placeholders}
+        ON DUPLICATE KEY UPDATE
+            {", ".join(f"`{field}` = VALUES(`{field}`)" for field in (*LEDGER_FIELDS, "modified"))}
+        """,
+        [value for row in values for value in row],
+    )
+
+
+def get_ledger_name(technician, date):
+    return f"{technician}::{date}"
+
+
+def refresh_time_ledger(keys):
+    """Rebuild the rows of a few (technician, date) pairs, e.g. the old and new values of a changed document"""
+    technicians_by_date = defaultdict(set)
+    for technician, date in keys:
+        if technician and date:
+            technicians_by_date[getdate(date)].add(technician)
+
+    for date, technicians in technicians_by_date.items():
+        rebuild_time_ledger(date, date, technicians)
+    frappe.db.commit()
+
+
+def reconcile_time_ledger():
+    """
+    Scheduled job: rebuild `fsm_time_ledger_reconcile_days` days (default 7) on either
+    side of today, catching changes made without doc events (SQL updates, imports).
+    """
+    days = frappe.conf.get("fsm_time_ledger_reconcile_days") or LEDGER_RECONCILE_DAYS
+    rebuild_time_ledger(add_days(nowdate(), -days), add_days(nowdate(), days))
+    frappe.db.commit()
+
+
+# Doc events
+# ----------
+
+
+def enqueue_ledger_refresh(doc, get_keys):
+    """
+    Refresh the ledger rows a document affects, before and after the change, in a
+    background job once the change is committed: a ledger problem never fails the save.
+    """
+    keys = set(get_keys(doc))
+    previous = doc.get_doc_before_save()
+    if previous:
+        keys.update(get_keys(previous))
+
+    keys = sorted((technician, str(getdate(date))) for technician, date in keys if technician and date)
+    if keys:
+        frappe.enqueue(
+            "field_service_management.time_ledger.refresh_time_ledger",
+            queue="short",
+            enqueue_after_commit=True,
+            keys=keys,
+        )
+
+
+def update_scheduled_hours(doc, method=None):
+    """Assigned Tasks doc event"""
+    enqueue_ledger_refresh(doc, lambda task: [(task.technician, task.date)])
+
+
+def update_punch_hours(doc, method=None):
+    """Punch In Punch Out doc event; for Maintenance Visit, covers the punch rows edited with the visit"""
+
+    def get_keys(doc):
+        if doc.doctype == "Maintenance Visit":
+            rows = doc.get("punch_in_punch_out") or []
+        else:
+            rows = [doc]
+        return [(row.technician, row.punch_in) for row in rows if row.punch_in]
+
+    enqueue_ledger_refresh(doc, get_keys)
+
+
+def update_invoiced_hours(doc, method=None):
+    """Delivery Note doc event"""
+
+    def get_keys(doc):
+        employees = {
+            row.employee
+            for df in doc.meta.get_table_fields()
+            if df.options == "Employee Contribution"
+            for row in doc.get(df.fieldname) or []
+            if row.employee
+        }
+        users_by_employee = get_users_by_employee(employees) if employees else {}
+        return [(users_by_employee.get(employee), doc.posting_date) for employee in employees]
+
+    enqueue_ledger_refresh(doc, get_keys)
+
+
+# Reads
+# -----
+
+
+def get_time_summary(from_date, to_date, technicians=None):
+    """Per-technician totals of a date range, read from the ledger"""
+    filters = {"date": ["between", [getdate(from_date), getdate(to_date)]]}
+    if technicians:
+        filters["technician"] = ["in", list(technicians)]
+
+    return frappe.get_all(
+        LEDGER_DOCTYPE,
+        filters=filters,
+        fields=[
+            "technician",
+            "sum(scheduled_seconds) as scheduled_seconds",
+            "sum(travel_seconds) as travel_seconds",
+            "sum(working_seconds) as working_seconds",
+            "sum(invoiced_hours) as invoiced_hours",
+        ],
+        group_by="technician",
+    )
+
+
+def get_utilization(technicians, from_date, to_date, available_hours):
+    """{technician: scheduled hours as a percentage of `available_hours`}, for the board utilization bars"""
+    return {
+        row.technician: round(flt(row.scheduled_seconds) / 3600 / available_hours * 100, 2)
+        for row in get_time_summary(from_date, to_date, technicians)
+    }
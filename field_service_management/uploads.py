@@ -0,0 +1,427 @@
+import hashlib
+import os
+import tempfile
+import time
+
+import frappe
+from frappe.utils import get_site_path
+
+
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+UPLOAD_SESSION_CACHE_KEY = "fsm:upload_session:"
+UPLOAD_SESSION_TTL = 24 * 60 * 60
+UPLOAD_SESSION_CHUNK_SIZE = 256 * 1024
+
+THUMBNAIL_SIZE = (200, 200)
+WEB_IMAGE_MAX_SIZE = (1600, 1600)
+WEB_IMAGE_QUALITY = 80
+THUMBNAIL_SUFFIX = "_thumb.jpg"
+WEB_IMAGE_SUFFIX = "_web.jpg"
+IMAGE_DERIVATIVES_FAILED_CACHE_KEY = "fsm:image_derivatives_failed:"
+IMAGE_DERIVATIVES_RETRY_AFTER = 7 * 24 * 60 * 60
+
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"BM", "bmp"),
+    (b"II*\x00", "tiff"),
+    (b"MM\x00*", "tiff"),
+)
+
+
+class UploadError(frappe.ValidationError):
+    pass
+
+
+def get_image_extension(header):
+    """File extension of an image from its first bytes, None if it is not a known image type"""
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "webp"
+    for signature, extension in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return extension
+    return None
+
+
+def save_uploaded_image(uploaded_file, maintenance_visit):
+    """
+    Store an uploaded image for a Maintenance Visit and return its file URL.
+
+    The upload is streamed to disk in chunks while its SHA-256 is computed, and
+    rejected past `fsm_max_upload_size` bytes (site config, default 10 MB). Files are
+    named after their hash, so an identical upload reuses the copy on disk and, for the
+    same visit, the existing File record.
+    """
+    max_size = frappe.conf.get("fsm_max_upload_size") or MAX_UPLOAD_SIZE
+    public_files_path = get_site_path("public", "files")
+    os.makedirs(public_files_path, exist_ok=True)
+
+    sha256 = hashlib.sha256()
+    size = 0
+    extension = None
+    fd, temp_path = tempfile.mkstemp(dir=public_files_path, prefix=".upload-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            while chunk := uploaded_file.stream.read(UPLOAD_CHUNK_SIZE):
+                if extension is None:
+                    extension = get_image_extension(chunk)
+                    if not extension:
+                        raise UploadError("Invalid image format")
+                size += len(chunk)
+                if size > max_size:
+                    raise UploadError(f"Image is larger than {max_size // (1024 * 1024)} MB")
+                sha256.update(chunk)
+                f.write(chunk)
+
+        if not size:
+            raise UploadError("Empty image file")
+
+        file_name = store_content_addressed(temp_path, sha256.hexdigest(), extension)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    file_url = get_or_create_file(file_name, maintenance_visit).file_url
+    enqueue_image_derivatives(file_url)
+    return file_url
+
+
+def store_content_addressed(path, digest, extension):
+    """Move a finished upload to public/files/<sha256>.<ext>, keeping the existing copy if there is one"""
+    file_name = f"{digest}.{extension}"
+    target = get_site_path("public", "files", file_name)
+    if not os.path.exists(target):
+        # temp files are created 0600, which the web server could not read once moved
+        os.chmod(path, get_public_file_mode())
+        os.replace(path, target)
+    return file_name
+
+
+def get_public_file_mode():
+    """Mode a regular file gets under the process umask (0644 with the usual 022)"""
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o644 & ~umask
+
+
+def get_or_create_file(file_name, maintenance_visit):
+    """File record of a public file attached to a Maintenance Visit"""
+    file_url = f"/files/{file_name}"
+    existing = frappe.db.get_value(
+        "File",
+        {
+            "file_url": file_url,
+            "attached_to_doctype": "Maintenance Visit",
+            "attached_to_name": maintenance_visit,
+        },
+        "name",
+    )
+    if existing:
+        return frappe.get_doc("File", existing)
+
+    file_doc = frappe.get_doc({
+        "doctype": "File",
+        "file_name": file_name,
+        "file_url": file_url,
+        "attached_to_doctype": "Maintenance Visit",
+        "attached_to_name": maintenance_visit,
+        "is_private": 0  # Make the file publicly accessible
+    })
+    file_doc.insert(ignore_permissions=True)
+    return file_doc
+
+
+def create_visit_attachment(maintenance_visit, file_url, caption=None):
+    """
+    Row of the Attachments child table of a Maintenance Visit. Uploading the same image
+    again returns the existing row, with the new caption if one is given.
+    """
+    existing = frappe.db.get_value(
+        "Attachments",
+        {"parent": maintenance_visit, "parenttype": "Maintenance Visit", "image": file_url},
+        "name",
+    )
+    if existing:
+        attachment = frappe.get_doc("Attachments", existing)
+        if caption and attachment.caption != caption:
+            attachment.db_set("caption", caption)
+        return attachment
+
+    new_attachment = frappe.get_doc({
+        "doctype": "Attachments",
+        "parent": maintenance_visit,
+        "parenttype": "Maintenance Visit",
+        "parentfield": "attachments",
+        "maintenance_visit": maintenance_visit,
+        "image": file_url,
+        "caption": caption
+    })
+    new_attachment.insert(ignore_permissions=True)
+    return new_attachment
+
+
+# Thumbnails
+# ----------
+# Next to every public image /files/<name>.<ext> a background job writes
+# <name>_thumb.jpg (fixed THUMBNAIL_SIZE, center-cropped) and <name>_web.jpg
+# (at most WEB_IMAGE_MAX_SIZE, recompressed). Payloads show the thumbnail and
+# keep the original URL for download. Images PIL cannot read are marked in
+# Redis and not retried for IMAGE_DERIVATIVES_RETRY_AFTER.
+
+
+def get_derived_image_url(file_url, suffix):
+    if not file_url or not file_url.startswith("/files/"):
+        return None
+    return os.path.splitext(file_url)[0] + suffix
+
+
+def get_public_file_path(file_url):
+    return get_site_path("public", "files", file_url[len("/files/"):])
+
+
+def enqueue_image_derivatives(file_url, after_commit=True):
+    if not get_derived_image_url(file_url, THUMBNAIL_SUFFIX):
+        return
+    frappe.enqueue(
+        "field_service_management.uploads.make_image_derivatives",
+        queue="short",
+        job_id=f"fsm_image_derivatives:{file_url}",
+        deduplicate=True,
+        enqueue_after_commit=after_commit,
+        file_url=file_url,
+    )
+
+
+def make_image_derivatives(file_url):
+    """Background job: write the thumbnail and web version of a public image"""
+    from PIL import Image, ImageOps
+
+    thumbnail_url = get_derived_image_url(file_url, THUMBNAIL_SUFFIX)
+    web_url = get_derived_image_url(file_url, WEB_IMAGE_SUFFIX)
+    path = get_public_file_path(file_url)
+    if not thumbnail_url or not os.path.exists(path):
+        return
+
+    try:
+        with Image.open(path) as image:
+            image = ImageOps.exif_transpose(image).convert("RGB")
+
+            thumbnail = ImageOps.fit(image, THUMBNAIL_SIZE, Image.LANCZOS)
+            save_derived_image(thumbnail, thumbnail_url, quality=WEB_IMAGE_QUALITY)
+
+            image.thumbnail(WEB_IMAGE_MAX_SIZE, Image.LANCZOS)
+            save_derived_image(image, web_url, quality=WEB_IMAGE_QUALITY, progressive=True)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        # corrupt or unsupported (e.g. HEIC) images keep being shown as the original
+        frappe.cache().set_value(
+            IMAGE_DERIVATIVES_FAILED_CACHE_KEY + file_url, 1, expires_in_sec=IMAGE_DERIVATIVES_RETRY_AFTER
+        )
+        frappe.log_error(frappe.get_traceback(), f"Image derivatives failed for {file_url}")
+        return
+
+    frappe.db.set_value("File", {"file_url": file_url}, "thumbnail_url", thumbnail_url, update_modified=False)
+
+
+def save_derived_image(image, file_url, **options):
+    # write then rename, so readers never serve a half-written file
+    path = get_public_file_path(file_url)
+    temp_path = f"{path}.tmp"
+    image.save(temp_path, "JPEG", optimize=True, **options)
+    os.replace(temp_path, path)
+
+
+def get_thumbnail_url(file_url):
+    """Thumbnail of an image if it was generated, else the image itself (and queue its generation)"""
+    thumbnail_url = get_derived_image_url(file_url, THUMBNAIL_SUFFIX)
+    if not thumbnail_url:
+        return file_url
+    if os.path.exists(get_public_file_path(thumbnail_url)):
+        return thumbnail_url
+    if os.path.exists(get_public_file_path(file_url)) and not frappe.cache().get_value(
+        IMAGE_DERIVATIVES_FAILED_CACHE_KEY + file_url
+    ):
+        # read-only requests do not commit, so do not wait for one
+        enqueue_image_derivatives(file_url, after_commit=False)
+    return file_url
+
+
+def get_web_image_url(file_url):
+    """Recompressed version of an image if it was generated, else the image itself"""
+    web_url = get_derived_image_url(file_url, WEB_IMAGE_SUFFIX)
+    if web_url and os.path.exists(get_public_file_path(web_url)):
+        return web_url
+    return file_url
+
+
+def add_thumbnail_urls(rows, fieldname="image"):
+    """Set `<fieldname>_thumbnail` and `<fieldname>_web` on rows that have an image in `fieldname`"""
+    for row in rows:
+        file_url = row.get(fieldname)
+        if file_url:
+            row[f"{fieldname}_thumbnail"] = get_thumbnail_url(file_url)
+            row[f"{fieldname}_web"] = get_web_image_url(file_url)
+    return rows
+
+
+# Resumable uploads
+# -----------------
+# The app opens a session, sends the file in chunks at increasing offsets and
+# finalizes it. Received bytes are appended to private/fsm_uploads/<id>.part and
+# the session (owner, visit, offset) lives in Redis until it expires.
+
+
+def get_upload_sessions_path(*path):
+    return get_site_path("private", "fsm_uploads", *path)
+
+
+def create_upload_session(user, maintenance_visit, caption=None, size=None):
+    max_size = frappe.conf.get("fsm_max_upload_size") or MAX_UPLOAD_SIZE
+    if size and int(size) > max_size:
+        raise UploadError(f"Image is larger than {max_size // (1024 * 1024)} MB")
+
+    upload_id = frappe.generate_hash(length=20)
+    os.makedirs(get_upload_sessions_path(), exist_ok=True)
+    open(get_upload_sessions_path(f"{upload_id}.part"), "wb").close()
+
+    session = {
+        "upload_id": upload_id,
+        "user": user,
+        "maintenance_visit": maintenance_visit,
+        "caption": caption,
+        "size": int(size) if size else None,
+        "offset": 0,
+    }
+    save_upload_session(session)
+    return session
+
+
+def get_upload_session(upload_id, user):
+    session = frappe.cache().get_value(UPLOAD_SESSION_CACHE_KEY + str(upload_id))
+    if not session or session["user"] != user:
+        raise UploadError("Upload session not found or expired")
+    return session
+
+
+def save_upload_session(session):
+    frappe.cache().set_value(
+        UPLOAD_SESSION_CACHE_KEY + session["upload_id"], session, expires_in_sec=UPLOAD_SESSION_TTL
+    )
+
+
+def get_upload_session_lock(upload_id):
+    """Redis lock serializing chunk writes and finalization of one upload"""
+    cache = frappe.cache()
+    return cache.lock(cache.make_key(UPLOAD_SESSION_CACHE_KEY + f"{upload_id}:lock"), timeout=60)
+
+
+def append_upload_chunk(upload_id, user, offset, stream):
+    """
+    Append a chunk at `offset` and return the new offset. A chunk sent at any other
+    offset than the one received so far is refused; the app resumes from the session offset.
+    """
+    lock = get_upload_session_lock(upload_id)
+    if not lock.acquire(blocking_timeout=10):
+        raise UploadError("Another chunk of this upload is being written")
+
+    try:
+        session = get_upload_session(upload_id, user)
+        if session.get("file_url"):
+            raise UploadError("Upload already finalized")
+        if int(offset) != session["offset"]:
+            raise UploadError(f"Expected offset {session['offset']}")
+
+        max_size = frappe.conf.get("fsm_max_upload_size") or MAX_UPLOAD_SIZE
+        size = session["offset"]
+        with open(get_upload_sessions_path(f"{upload_id}.part"), "r+b") as f:
+            # drop bytes of an earlier attempt of this chunk that were written but not recorded
+            f.truncate(size)
+            f.seek(size)
+            while chunk := stream.read(UPLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    raise UploadError(f"Image is larger than {max_size // (1024 * 1024)} MB")
+                f.write(chunk)
+
+        session["offset"] = size
+        save_upload_session(session)
+        return size
+    finally:
+        lock.release()
+
+
+def finalize_upload_session(upload_id, user, sha256=None):
+    """
+    Turn a complete upload into a File and an Attachments row of the visit, like `api.attachment`.
+    Returns the file URL.
+
+    The session is kept, marked with the file URL, until it expires, so finalizing again
+    (a retry after a timeout) returns the same URL without attaching the file twice.
+    """
+    lock = get_upload_session_lock(upload_id)
+    if not lock.acquire(blocking_timeout=10):
+        raise UploadError("This upload is being finalized")
+
+    try:
+        session = get_upload_session(upload_id, user)
+        if session.get("file_url"):
+            return session["file_url"]
+
+        path = get_upload_sessions_path(f"{upload_id}.part")
+        if session["size"] and session["offset"] != session["size"]:
+            raise UploadError(f"Upload incomplete, {session['offset']} of {session['size']} bytes received")
+        if not session["offset"]:
+            raise UploadError("Empty image file")
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            extension = get_image_extension(f.read(16))
+            f.seek(0)
+            while chunk := f.read(UPLOAD_CHUNK_SIZE):
+                digest.update(chunk)
+        if not extension:
+            raise UploadError("Invalid image format")
+        if sha256 and sha256.lower() != digest.hexdigest():
+            raise UploadError("Checksum mismatch")
+
+        os.makedirs(get_site_path("public", "files"), exist_ok=True)
+        file_name = store_content_addressed(path, digest.hexdigest(), extension)
+        file_url = get_or_create_file(file_name, session["maintenance_visit"]).file_url
+        enqueue_image_derivatives(file_url)
+        create_visit_attachment(session["maintenance_visit"], file_url, session["caption"])
+
+        session["file_url"] = file_url
+        save_upload_session(session)
+        if os.path.exists(path):
+            os.remove(path)
+        # the records above are gone on rollback, so the marker must go too; the app uploads again
+        frappe.db.after_rollback.add(lambda: discard_upload_session(upload_id))
+        return file_url
+    finally:
+        lock.release()
+
+
+def discard_upload_session(upload_id):
+    frappe.cache().delete_value(UPLOAD_SESSION_CACHE_KEY + upload_id)
+    path = get_upload_sessions_path(f"{upload_id}.part")
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def remove_abandoned_upload_sessions():
+    """Scheduled job: delete partial uploads whose session expired or that saw no chunk for a day"""
+    path = get_upload_sessions_path()
+    if not os.path.isdir(path):
+        return
+
+    for file_name in os.listdir(path):
+        upload_id, extension = os.path.splitext(file_name)
+        if extension != ".part":
+            continue
+        file_path = os.path.join(path, file_name)
+        expired = not frappe.cache().get_value(UPLOAD_SESSION_CACHE_KEY + upload_id)
+        if expired or os.path.getmtime(file_path) < time.time() - UPLOAD_SESSION_TTL:
+            discard_upload_session(upload_id)